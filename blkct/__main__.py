@@ -12,13 +12,16 @@ from gettext import gettext as _
 from typing import TYPE_CHECKING, TypeVar, cast
 
 from .blackcat import Blackcat
+from .content_store.content import Content
 from .logging import init_logging, logger, set_session_id_to_log
+from .ratelimit import parse_host_limit
 from .setup import merge_setups
 from .utils import make_new_session_id
 
 if TYPE_CHECKING:
     from typing import Any, Callable, Dict, List, Optional, Tuple, Union, Sequence
 
+    from .content_store.codec import Codec
     from .typing import (
         ContentStoreFactory,
         ContentStore,
@@ -42,7 +45,9 @@ CONTEXT_STORE_FACTORIES: Dict[
 
 # AsyncIOScheduler
 def _make_asyncio_scheduler_argparser() -> argparse.ArgumentParser:
-    return make_argument_parser(prog="AsyncIO Scheduler")
+    parser = make_argument_parser(prog="AsyncIO Scheduler")
+    parser.add_argument("--num-workers", type=int, default=default_or_environ("BLKCT_NUM_WORKERS", 1))
+    return parser
 
 
 def _make_asyncio_scheduler(args: argparse.Namespace) -> Scheduler:
@@ -52,19 +57,108 @@ def _make_asyncio_scheduler(args: argparse.Namespace) -> Scheduler:
     """
     from .scheduler.asyncio_scheduler import AsyncIOScheduler
 
-    logger.info("make AsyncIOScheduler")
+    logger.info("make AsyncIOScheduler", num_workers=args.num_workers)
 
-    return AsyncIOScheduler()
+    return AsyncIOScheduler(num_workers=args.num_workers)
 
 
 SCHEDULER_FACTORIES["asyncio"] = (_make_asyncio_scheduler_argparser, _make_asyncio_scheduler)
 
 
+# PriorityScheduler
+def _make_priority_scheduler_argparser() -> argparse.ArgumentParser:
+    parser = make_argument_parser(prog="Priority Scheduler")
+    parser.add_argument("--num-workers", type=int, default=default_or_environ("BLKCT_NUM_WORKERS", 1))
+    return parser
+
+
+def _make_priority_scheduler(args: argparse.Namespace) -> Scheduler:
+    """
+    dispatchのpriority optionの順に処理するスケジューラを作成する
+    """
+    from .scheduler.priority_scheduler import PriorityScheduler
+
+    logger.info("make PriorityScheduler", num_workers=args.num_workers)
+
+    return PriorityScheduler(num_workers=args.num_workers)
+
+
+SCHEDULER_FACTORIES["priority"] = (_make_priority_scheduler_argparser, _make_priority_scheduler)
+
+
+# SQLiteScheduler
+def _make_sqlite_scheduler_argparser() -> argparse.ArgumentParser:
+    parser = make_argument_parser(prog="SQLite Scheduler")
+    parser.add_argument("--num-workers", type=int, default=default_or_environ("BLKCT_NUM_WORKERS", 1))
+    parser.add_argument(
+        "--queue-db-path", default=default_or_environ("BLKCT_QUEUE_DB_PATH", "/tmp/blkct-queue.sqlite3")
+    )
+    return parser
+
+
+def _make_sqlite_scheduler(args: argparse.Namespace) -> Scheduler:
+    """
+    dispatchをSQLiteに記録し、同じsession idで動かし直すと続きから処理するスケジューラを作成する
+    """
+    from .scheduler.sqlite_scheduler import SQLiteScheduler
+
+    logger.info("make SQLiteScheduler", db_path=args.queue_db_path, num_workers=args.num_workers)
+
+    return SQLiteScheduler(args.queue_db_path, num_workers=args.num_workers)
+
+
+SCHEDULER_FACTORIES["sqlite"] = (_make_sqlite_scheduler_argparser, _make_sqlite_scheduler)
+
+
+# MultiprocessScheduler
+def _make_multiprocess_scheduler_argparser() -> argparse.ArgumentParser:
+    parser = make_argument_parser(prog="Multiprocess Scheduler")
+    parser.add_argument("--num-processes", type=int, default=default_or_environ("BLKCT_NUM_PROCESSES"))
+    parser.add_argument("--num-workers", type=int, default=default_or_environ("BLKCT_NUM_WORKERS", 1))
+    return parser
+
+
+def _make_multiprocess_scheduler(args: argparse.Namespace) -> Scheduler:
+    """
+    forkした複数のプロセスでplannerを処理するスケジューラを作成する
+
+    各プロセスがContext Storeを開くので、`--context-store file`とは組み合わせられない
+    """
+    from .scheduler.multiprocess_scheduler import MultiprocessScheduler
+
+    logger.info("make MultiprocessScheduler", num_processes=args.num_processes, num_workers=args.num_workers)
+
+    return MultiprocessScheduler(num_processes=args.num_processes, num_workers=args.num_workers)
+
+
+SCHEDULER_FACTORIES["multiprocess"] = (_make_multiprocess_scheduler_argparser, _make_multiprocess_scheduler)
+
+
 # AWSBatchScheduler
 def _make_awsbatch_scheduler_argparser() -> argparse.ArgumentParser:
     parser = make_argument_parser(prog="AWSBatch Scheduler")
     parser.add_argument("--job-definition", default=default_or_environ("BLKCT_AWSBATCH_JOB_DEFINITION"))
     parser.add_argument("--job-queue", default=default_or_environ("BLKCT_AWSBATCH_JOB_QUEUE"))
+    parser.add_argument(
+        "--max-concurrent-submissions",
+        type=int,
+        default=default_or_environ("BLKCT_AWSBATCH_MAX_CONCURRENT_SUBMISSIONS", 8),
+    )
+    parser.add_argument(
+        "--submit-max-retries", type=int, default=default_or_environ("BLKCT_AWSBATCH_SUBMIT_MAX_RETRIES", 8)
+    )
+    parser.add_argument(
+        "--pack-size",
+        type=int,
+        default=default_or_environ("BLKCT_AWSBATCH_PACK_SIZE", 1),
+        help="run up to this many dispatched planners in one job",
+    )
+    parser.add_argument(
+        "--pack-wait",
+        type=float,
+        default=default_or_environ("BLKCT_AWSBATCH_PACK_WAIT", 1.0),
+        help="seconds to wait for a pack to fill up",
+    )
     return parser
 
 
@@ -74,18 +168,63 @@ def _make_awsbatch_scheduler(args: argparse.Namespace) -> Scheduler:
     """
     from .scheduler.awsbatch_scheduler import AWSBatchScheduler
 
-    logger.info("make AWSBatchScheduler", job_definition=args.job_definition, job_queue=args.job_queue)
+    logger.info(
+        "make AWSBatchScheduler",
+        job_definition=args.job_definition,
+        job_queue=args.job_queue,
+        pack_size=args.pack_size,
+    )
 
-    return AWSBatchScheduler(args.job_definition, args.job_queue)
+    return AWSBatchScheduler(
+        args.job_definition,
+        args.job_queue,
+        max_concurrent_submissions=args.max_concurrent_submissions,
+        max_retries=args.submit_max_retries,
+        pack_size=args.pack_size,
+        pack_wait=args.pack_wait,
+    )
 
 
 SCHEDULER_FACTORIES["awsbatch"] = (_make_awsbatch_scheduler_argparser, _make_awsbatch_scheduler)
 
 
+def _add_content_codec_arguments(parser: argparse.ArgumentParser) -> None:
+    """ContentStoreの圧縮方式のoptionを追加する"""
+    parser.add_argument("--content-codec", default=default_or_environ("BLKCT_CONTENT_CODEC", "identity"))
+    parser.add_argument("--content-codec-level", type=int, default=default_or_environ("BLKCT_CONTENT_CODEC_LEVEL"))
+
+
+def _add_content_addressing_arguments(parser: argparse.ArgumentParser) -> None:
+    """ContentStoreのcontent addressed modeのoptionを追加する"""
+    parser.add_argument(
+        "--content-addressed",
+        action="store_true",
+        default=flag_from_environ("BLKCT_CONTENT_ADDRESSED"),
+        help="store bodies once by their hash and share them between sessions",
+    )
+    parser.add_argument(
+        "--read-through-window",
+        type=float,
+        default=default_or_environ("BLKCT_READ_THROUGH_WINDOW"),
+        help="reuse contents saved by other sessions within this many seconds",
+    )
+
+
+def _make_content_codec(args: argparse.Namespace) -> Codec:
+    from .content_store.codec import get_codec
+
+    return get_codec(args.content_codec, args.content_codec_level)
+
+
 # FileContentStore
 def _make_file_content_store_argparser() -> argparse.ArgumentParser:
     parser = make_argument_parser(prog="File Content Store")
     parser.add_argument("--content-store-path", default=default_or_environ("BLKCT_CONTENT_STORE_PATH", "/tmp/blkct"))
+    parser.add_argument(
+        "--content-store-io-workers", type=int, default=default_or_environ("BLKCT_CONTENT_STORE_IO_WORKERS", 4)
+    )
+    _add_content_codec_arguments(parser)
+    _add_content_addressing_arguments(parser)
 
     return parser
 
@@ -97,9 +236,21 @@ def _make_file_content_store(args: argparse.Namespace) -> ContentStore:
     """
     from .content_store.file_content_store import FileContentStore
 
-    logger.info("make FileContentStore", path=args.content_store_path)
+    logger.info(
+        "make FileContentStore",
+        path=args.content_store_path,
+        io_workers=args.content_store_io_workers,
+        codec=args.content_codec,
+        content_addressed=args.content_addressed,
+    )
 
-    return FileContentStore(store_root_path=args.content_store_path)
+    return FileContentStore(
+        store_root_path=args.content_store_path,
+        io_workers=args.content_store_io_workers,
+        codec=_make_content_codec(args),
+        content_addressed=args.content_addressed,
+        read_through_window=args.read_through_window,
+    )
 
 
 CONTENT_STORE_FACTORIES["file"] = (_make_file_content_store_argparser, _make_file_content_store)
@@ -110,6 +261,13 @@ def _make_s3_content_store_argparser() -> argparse.ArgumentParser:
     parser = make_argument_parser(prog="S3 Content Store")
     parser.add_argument("--s3-content-bucket", default=default_or_environ("BLKCT_S3_CONTENT_BUCKET"))
     parser.add_argument("--s3-content-prefix", default=default_or_environ("BLKCT_S3_CONTENT_PREFIX"))
+    parser.add_argument("--s3-endpoint-url", default=default_or_environ("BLKCT_S3_ENDPOINT_URL"))
+    parser.add_argument("--s3-max-connections", type=int, default=default_or_environ("BLKCT_S3_MAX_CONNECTIONS", 10))
+    parser.add_argument(
+        "--s3-max-concurrent-uploads", type=int, default=default_or_environ("BLKCT_S3_MAX_CONCURRENT_UPLOADS", 4)
+    )
+    _add_content_codec_arguments(parser)
+    _add_content_addressing_arguments(parser)
 
     return parser
 
@@ -120,14 +278,76 @@ def _make_s3_content_store(args: argparse.Namespace) -> ContentStore:
     """
     from .content_store.s3_content_store import S3ContentStore
 
-    logger.info("make S3ContentStore", bucket=args.s3_content_bucket, content_prefix=args.s3_content_prefix)
+    logger.info(
+        "make S3ContentStore",
+        bucket=args.s3_content_bucket,
+        content_prefix=args.s3_content_prefix,
+        endpoint_url=args.s3_endpoint_url,
+        codec=args.content_codec,
+        content_addressed=args.content_addressed,
+    )
 
-    return S3ContentStore(args.s3_content_bucket, args.s3_content_prefix)
+    return S3ContentStore(
+        args.s3_content_bucket,
+        args.s3_content_prefix,
+        endpoint_url=args.s3_endpoint_url,
+        max_connections=args.s3_max_connections,
+        max_concurrent_uploads=args.s3_max_concurrent_uploads,
+        codec=_make_content_codec(args),
+        content_addressed=args.content_addressed,
+        read_through_window=args.read_through_window,
+    )
 
 
 CONTENT_STORE_FACTORIES["s3"] = _make_s3_content_store_argparser, _make_s3_content_store
 
 
+# SegmentContentStore
+def _make_segment_content_store_argparser() -> argparse.ArgumentParser:
+    parser = make_argument_parser(prog="Segment Content Store")
+    parser.add_argument("--content-store-path", default=default_or_environ("BLKCT_CONTENT_STORE_PATH", "/tmp/blkct"))
+    parser.add_argument(
+        "--content-store-io-workers", type=int, default=default_or_environ("BLKCT_CONTENT_STORE_IO_WORKERS", 4)
+    )
+    parser.add_argument(
+        "--segment-size", type=int, default=default_or_environ("BLKCT_SEGMENT_SIZE", 256 * 1024 * 1024), help="bytes"
+    )
+    parser.add_argument("--segment-s3-bucket", default=default_or_environ("BLKCT_SEGMENT_S3_BUCKET"))
+    parser.add_argument("--segment-s3-prefix", default=default_or_environ("BLKCT_SEGMENT_S3_PREFIX"))
+    parser.add_argument("--s3-endpoint-url", default=default_or_environ("BLKCT_S3_ENDPOINT_URL"))
+    _add_content_codec_arguments(parser)
+
+    return parser
+
+
+def _make_segment_content_store(args: argparse.Namespace) -> ContentStore:
+    """
+    大きなsegmentファイルに追記していくContentStoreを作る
+    """
+    from .content_store.segment_content_store import SegmentContentStore
+
+    logger.info(
+        "make SegmentContentStore",
+        path=args.content_store_path,
+        segment_size=args.segment_size,
+        s3_bucket=args.segment_s3_bucket,
+        codec=args.content_codec,
+    )
+
+    return SegmentContentStore(
+        args.content_store_path,
+        segment_size=args.segment_size,
+        io_workers=args.content_store_io_workers,
+        codec=_make_content_codec(args),
+        s3_bucket=args.segment_s3_bucket,
+        s3_prefix=args.segment_s3_prefix,
+        endpoint_url=args.s3_endpoint_url,
+    )
+
+
+CONTENT_STORE_FACTORIES["segment"] = (_make_segment_content_store_argparser, _make_segment_content_store)
+
+
 # FileContextStore
 def _make_file_context_store_argparser() -> argparse.ArgumentParser:
     parser = make_argument_parser(prog="File Context Store")
@@ -156,6 +376,10 @@ CONTEXT_STORE_FACTORIES["file"] = (_make_file_context_store_argparser, _make_fil
 def _make_dynamodb_context_store_argparser() -> argparse.ArgumentParser:
     parser = make_argument_parser(prog="DynamoDB Context Store")
     parser.add_argument("--dynamodb-table-name", default=default_or_environ("BLKCT_DYNAMODB_TABLE_NAME"))
+    parser.add_argument("--dynamodb-endpoint-url", default=default_or_environ("BLKCT_DYNAMODB_ENDPOINT_URL"))
+    parser.add_argument(
+        "--dynamodb-batch-window", type=float, default=default_or_environ("BLKCT_DYNAMODB_BATCH_WINDOW", 0.0)
+    )
 
     return parser
 
@@ -166,9 +390,11 @@ def _make_dynamodb_context_store(args: argparse.Namespace) -> ContextStore:
     """
     from .context_store.dynamodb_context_store import DynamoDBContextStore
 
-    logger.info("make DynamoDBContextStore")
+    logger.info("make DynamoDBContextStore", table_name=args.dynamodb_table_name)
 
-    return DynamoDBContextStore(args.dynamodb_table_name)
+    return DynamoDBContextStore(
+        args.dynamodb_table_name, endpoint_url=args.dynamodb_endpoint_url, batch_window=args.dynamodb_batch_window
+    )
 
 
 CONTEXT_STORE_FACTORIES["dynamodb"] = (_make_dynamodb_context_store_argparser, _make_dynamodb_context_store)
@@ -226,6 +452,11 @@ def default_or_environ(env: str, default: Optional[DefaultT] = None) -> DefaultT
     return cast(DefaultT, os.environ.get(env, default))
 
 
+def flag_from_environ(env: str) -> bool:
+    """store_trueなoptionのデフォルト. `0`や`false`を真にしないように、決まった値だけ真にする"""
+    return os.environ.get(env, "").strip().lower() in ("1", "true", "yes", "on")
+
+
 # yapf: disable
 def parse_args(args: List[str]
                ) -> Tuple[argparse.Namespace, argparse.Namespace, argparse.Namespace, argparse.Namespace]:
@@ -242,6 +473,173 @@ def parse_args(args: List[str]
         '-v', action='store_true', dest='verbose', required=False, default=default_or_environ('BLKCT_VERBOSE', False)
     )
     main_parser.add_argument('--user-agent', default=default_or_environ('BLKCT_USER_AGENT'))
+    main_parser.add_argument(
+        '--request-interval', type=float, default=default_or_environ('BLKCT_REQUEST_INTERVAL', 2.5)
+    )
+    main_parser.add_argument(
+        '--max-requests-per-host', type=int, default=default_or_environ('BLKCT_MAX_REQUESTS_PER_HOST', 1)
+    )
+    main_parser.add_argument(
+        '--host-limit',
+        action='append',
+        dest='host_limits',
+        metavar='HOST[:PORT]=INTERVAL[/CONCURRENCY]',
+        default=default_or_environ('BLKCT_HOST_LIMITS', '').split(),  # 環境変数の場合は空白区切り
+    )
+    main_parser.add_argument(
+        '--context-write-through',
+        action='store_true',
+        default=flag_from_environ('BLKCT_CONTEXT_WRITE_THROUGH'),
+        help='save the context on every set'
+    )
+    main_parser.add_argument(
+        '--context-flush-interval', type=float, default=default_or_environ('BLKCT_CONTEXT_FLUSH_INTERVAL', 5.0)
+    )
+    main_parser.add_argument(
+        '--context-flush-threshold', type=int, default=default_or_environ('BLKCT_CONTEXT_FLUSH_THRESHOLD', 100)
+    )
+    main_parser.add_argument(
+        '--html-parser', default=default_or_environ('BLKCT_HTML_PARSER'), help='BeautifulSoup tree builder'
+    )
+    main_parser.add_argument(
+        '--max-body-size', type=int, default=default_or_environ('BLKCT_MAX_BODY_SIZE'), help='bytes'
+    )
+    main_parser.add_argument(
+        '--spool-threshold',
+        type=int,
+        default=default_or_environ('BLKCT_SPOOL_THRESHOLD', 1024 * 1024),
+        help='keep bodies up to this size in memory, larger ones in temporary files'
+    )
+    main_parser.add_argument(
+        '--revalidate',
+        action='store_true',
+        default=flag_from_environ('BLKCT_REVALIDATE'),
+        help='revalidate stored contents with ETag/Last-Modified'
+    )
+    main_parser.add_argument(
+        '--connection-limit',
+        type=int,
+        default=default_or_environ('BLKCT_CONNECTION_LIMIT', 100),
+        help='max open connections, 0 for unlimited'
+    )
+    main_parser.add_argument(
+        '--connection-limit-per-host',
+        type=int,
+        default=default_or_environ('BLKCT_CONNECTION_LIMIT_PER_HOST', 0),
+        help='max open connections per host, 0 for unlimited'
+    )
+    main_parser.add_argument(
+        '--connect-timeout',
+        type=float,
+        default=default_or_environ('BLKCT_CONNECT_TIMEOUT', 30.0),
+        help='seconds, 0 for no timeout'
+    )
+    main_parser.add_argument(
+        '--read-timeout',
+        type=float,
+        default=default_or_environ('BLKCT_READ_TIMEOUT', 60.0),
+        help='seconds between reads, 0 for no timeout'
+    )
+    main_parser.add_argument(
+        '--total-timeout',
+        type=float,
+        default=default_or_environ('BLKCT_TOTAL_TIMEOUT', 300.0),
+        help='seconds per request, 0 for no timeout'
+    )
+    main_parser.add_argument(
+        '--dns-cache-ttl',
+        type=int,
+        default=default_or_environ('BLKCT_DNS_CACHE_TTL', 10),
+        help='seconds, 0 to disable the cache'
+    )
+    main_parser.add_argument(
+        '--keepalive-timeout',
+        type=float,
+        default=default_or_environ('BLKCT_KEEPALIVE_TIMEOUT', 15.0),
+        help='seconds to keep idle connections, 0 to disable keep-alive'
+    )
+    main_parser.add_argument(
+        '--adaptive-throttle',
+        action='store_true',
+        default=flag_from_environ('BLKCT_ADAPTIVE_THROTTLE'),
+        help='adjust the request interval of each host by its responses (AIMD)'
+    )
+    main_parser.add_argument(
+        '--min-request-interval',
+        type=float,
+        default=default_or_environ('BLKCT_MIN_REQUEST_INTERVAL', 0.25),
+        help='lower bound of the adaptive request interval'
+    )
+    main_parser.add_argument(
+        '--max-request-interval',
+        type=float,
+        default=default_or_environ('BLKCT_MAX_REQUEST_INTERVAL', 60.0),
+        help='upper bound of the adaptive request interval'
+    )
+    main_parser.add_argument(
+        '--max-retries',
+        type=int,
+        default=default_or_environ('BLKCT_MAX_RETRIES', 2),
+        help='retries on connection errors, 429 and 5xx'
+    )
+    main_parser.add_argument(
+        '--retry-backoff',
+        type=float,
+        default=default_or_environ('BLKCT_RETRY_BACKOFF', 1.0),
+        help='base seconds of the jittered exponential backoff'
+    )
+    main_parser.add_argument(
+        '--circuit-breaker-threshold',
+        type=int,
+        default=default_or_environ('BLKCT_CIRCUIT_BREAKER_THRESHOLD', 5),
+        help='consecutive failures to stop accessing a host, 0 to disable'
+    )
+    main_parser.add_argument(
+        '--circuit-breaker-cooldown',
+        type=float,
+        default=default_or_environ('BLKCT_CIRCUIT_BREAKER_COOLDOWN', 60.0),
+        help='seconds to stop accessing a failing host'
+    )
+    main_parser.add_argument(
+        '--metrics-path',
+        default=default_or_environ('BLKCT_METRICS_PATH'),
+        help='write metrics in the Prometheus text format to this file'
+    )
+    main_parser.add_argument(
+        '--metrics-json-path',
+        default=default_or_environ('BLKCT_METRICS_JSON_PATH'),
+        help='write metrics as JSON to this file at the session close'
+    )
+    main_parser.add_argument(
+        '--metrics-host',
+        default=default_or_environ('BLKCT_METRICS_HOST', '127.0.0.1'),
+        help='address to serve /metrics on'
+    )
+    main_parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=default_or_environ('BLKCT_METRICS_PORT'),
+        help='serve metrics on http://HOST:PORT/metrics'
+    )
+    main_parser.add_argument(
+        '--metrics-interval',
+        type=float,
+        default=default_or_environ('BLKCT_METRICS_INTERVAL', 15.0),
+        help='seconds between writes of --metrics-path, 0 to write only at the end'
+    )
+    main_parser.add_argument(
+        '--profile',
+        dest='profile_dir',
+        metavar='DIR',
+        default=default_or_environ('BLKCT_PROFILE'),
+        help='profile planners with cProfile and write the stats per planner into DIR/SESSION_ID'
+    )
+    main_parser.add_argument(
+        '--profile-memory',
+        action='store_true',
+        default=flag_from_environ('BLKCT_PROFILE_MEMORY'),
+        help='also trace allocations of planners with tracemalloc (slow)'
+    )
     main_parser.add_argument('planner', metavar='PLANNER')
     main_parser.add_argument('argument', nargs='?', metavar='ARGUMENT')
     main_parser.add_argument('-h', '--help', action=BlackcatHelpAction, help=_('show this help message and exit'))
@@ -257,20 +655,30 @@ def parse_args(args: List[str]
             print(f'  {arg}', file=sys.stderr)
         sys.exit(1)
 
+    # workerプロセスが各自でdbmを開くことになる
+    if main_args.scheduler == 'multiprocess' and main_args.context_store == 'file':
+        main_parser.error('--scheduler multiprocess cannot be used with --context-store file')
+
     return main_args, scheduler_args, content_store_args, context_store_args
 
 
 def blackcat(
     scheduler_factory: SchedulerFactory, content_store_factory: ContentStoreFactory,
     context_store_factory: ContextStoreFactory, planner: str, argument: Dict[str, Any], modules: List[str],
-    session_id: Optional[str], verbose: bool, user_agent: Optional[str]
+    session_id: Optional[str], verbose: bool, user_agent: Optional[str], html_parser: Optional[str] = None,
+    **options: Any
 ) -> None:
     """
     blackcat
+
+    optionsはそのままBlackcatに渡す
     """
     init_logging(verbose=verbose)
     logging.getLogger('botocore').setLevel(logging.WARN)
 
+    if html_parser:
+        Content.html_parser = html_parser
+
     # load planners/parsers
     setups = []
     for path in modules:
@@ -293,6 +701,7 @@ def blackcat(
         content_store_factory=content_store_factory,
         context_store_factory=context_store_factory,
         user_agent=user_agent,
+        **options,
     )
 
     # make session id
@@ -301,7 +710,10 @@ def blackcat(
 
     # run
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(blackcat.run_with_session(planner, {} if argument is None else argument, session_id))
+    try:
+        loop.run_until_complete(blackcat.run_with_session(planner, {} if argument is None else argument, session_id))
+    finally:
+        loop.run_until_complete(blackcat.close())
 
 
 def main(args: Optional[List[str]] = None) -> None:
@@ -314,6 +726,8 @@ def main(args: Optional[List[str]] = None) -> None:
     if isinstance(modules, str):
         modules = modules.split(',')
 
+    host_limits = dict(parse_host_limit(spec) for spec in main_args.host_limits)
+
     argument = main_args.argument
     if argument:
         argument = json.loads(argument)
@@ -323,7 +737,38 @@ def main(args: Optional[List[str]] = None) -> None:
         lambda: SCHEDULER_FACTORIES[main_args.scheduler][1](scheduler_args),
         lambda: CONTENT_STORE_FACTORIES[main_args.content_store][1](content_store_args),
         lambda: CONTEXT_STORE_FACTORIES[main_args.context_store][1](context_store_args), main_args.planner, argument,
-        modules, main_args.session_id, main_args.verbose, main_args.user_agent
+        modules, main_args.session_id, main_args.verbose, main_args.user_agent,
+        html_parser=main_args.html_parser,
+        request_interval=main_args.request_interval,
+        max_requests_per_host=main_args.max_requests_per_host,
+        host_limits=host_limits,
+        context_write_through=bool(main_args.context_write_through),
+        context_flush_interval=main_args.context_flush_interval,
+        context_flush_threshold=main_args.context_flush_threshold,
+        max_body_size=main_args.max_body_size,
+        spool_threshold=main_args.spool_threshold,
+        revalidate=bool(main_args.revalidate),
+        connection_limit=main_args.connection_limit,
+        connection_limit_per_host=main_args.connection_limit_per_host,
+        connect_timeout=main_args.connect_timeout or None,
+        read_timeout=main_args.read_timeout or None,
+        total_timeout=main_args.total_timeout or None,
+        dns_cache_ttl=main_args.dns_cache_ttl,
+        keepalive_timeout=main_args.keepalive_timeout,
+        adaptive_throttle=bool(main_args.adaptive_throttle),
+        min_request_interval=main_args.min_request_interval,
+        max_request_interval=main_args.max_request_interval,
+        max_retries=main_args.max_retries,
+        retry_backoff=main_args.retry_backoff,
+        circuit_breaker_threshold=main_args.circuit_breaker_threshold,
+        circuit_breaker_cooldown=main_args.circuit_breaker_cooldown,
+        metrics_path=main_args.metrics_path,
+        metrics_json_path=main_args.metrics_json_path,
+        metrics_host=main_args.metrics_host,
+        metrics_port=main_args.metrics_port,
+        metrics_interval=main_args.metrics_interval,
+        profile_dir=main_args.profile_dir,
+        profile_memory=bool(main_args.profile_memory),
     )
 
 
@@ -0,0 +1,539 @@
+"""
+ローカルの合成サイトをクロールして、スケジューラとstoreの組み合わせ毎の性能を測る
+
+    python -m blkct.benchmark --pages 500 --schedulers asyncio,sqlite --output result.json
+
+S3とDynamoDBはmotoで代用する(motoが無ければその組み合わせは飛ばす)
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import boto3
+from aiohttp import web
+from yarl import URL
+
+from .blackcat import Blackcat
+from .content_store.content import StoredContent
+from .content_store.file_content_store import FileContentStore
+from .content_store.s3_content_store import S3ContentStore
+from .content_store.segment_content_store import SegmentContentStore
+from .context_store.dynamodb_context_store import DynamoDBContextStore
+from .context_store.file_context_store import FileContextStore
+from .exceptions import ContextNotFoundError, CrawlerError
+from .logging import logger
+from .metrics import (
+    CONTENT_STORE_LOOKUPS,
+    CONTENT_STORE_SECONDS,
+    CONTEXT_STORE_SECONDS,
+    HTTP_REQUESTS,
+    HTTP_REQUEST_SECONDS,
+    HTTP_RESPONSE_BYTES,
+    PLANNER_SECONDS,
+    Histogram,
+)
+from .scheduler.asyncio_scheduler import AsyncIOScheduler
+from .scheduler.multiprocess_scheduler import MultiprocessScheduler
+from .scheduler.priority_scheduler import PriorityScheduler
+from .scheduler.sqlite_scheduler import SQLiteScheduler
+from .typing import ContentStore, ContextStore
+
+try:
+    import moto
+
+    has_moto = True
+except ImportError:
+    has_moto = False
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Dict, List, Mapping, Optional
+
+    from .content_store.content import Content, FetchedContent
+    from .metrics import MetricsRegistry
+    from .session import BlackcatSession
+    from .typing import ContentStoreFactory, ContextStoreFactory, SchedulerFactory
+
+__all__ = ("SiteConfig", "SyntheticSite", "run_benchmark")
+
+SCHEDULERS = ("asyncio", "priority", "sqlite", "multiprocess")
+CONTENT_STORES = ("memory", "file", "segment", "s3")
+CONTEXT_STORES = ("memory", "file", "dynamodb")
+
+PAGE_PLANNER = "benchmark_page"
+CONTEXT_NAME = "benchmark"
+S3_BUCKET = "blkct-benchmark"
+DYNAMODB_TABLE = "blkct-benchmark"
+LINK_PATTERN = re.compile(rb'href="(/page/\d+)"')
+# 取れなかったページの数. error_rateの503がretryしても続いたもの
+FAILED_PAGES = "blkct_benchmark_failed_pages_total"
+
+
+class SiteConfig:
+    """
+    合成サイトの形
+
+    /page/0から始まる木で、/page/iは/page/(i * fanout + 1)から/page/(i * fanout + fanout)にリンクする.
+    各ページは平均latency秒待ってから返し、error_rateの確率で503を返す
+    """
+
+    def __init__(
+        self,
+        pages: int = 500,
+        fanout: int = 8,
+        page_size: int = 16 * 1024,
+        latency: float = 0.005,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        if pages < 1 or fanout < 1:
+            raise ValueError("pages and fanout must be >= 1")
+        self.pages = pages
+        self.fanout = fanout
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+
+    def to_json(self) -> Dict[str, Any]:
+        return dict(vars(self))
+
+    def get_links(self, page: int) -> List[int]:
+        first = page * self.fanout + 1
+        return list(range(first, min(first + self.fanout, self.pages)))
+
+
+class SyntheticSite:
+    """SiteConfigのサイトを、別スレッドのevent loopでlocalhostに立てる"""
+
+    loop: Optional[asyncio.AbstractEventLoop]
+    thread: Optional[threading.Thread]
+
+    def __init__(self, config: SiteConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.loop = None
+        self.thread = None
+
+    @property
+    def root_url(self) -> str:
+        host, port = self.socket.getsockname()
+        return f"http://{host}:{port}/page/0"
+
+    def start(self) -> None:
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.serve, args=(started,), name="blkct-benchmark-site", daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self) -> None:
+        if self.loop and self.thread:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop = self.thread = None
+
+    # private
+    def serve(self, started: threading.Event) -> None:
+        self.loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_get("/page/{page:\\d+}", self.handle_page)
+        runner = web.AppRunner(app, access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.SockSite(runner, self.socket).start())
+        started.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+
+    async def handle_page(self, request: web.Request) -> web.Response:
+        config = self.config
+        page = int(request.match_info["page"])
+        if page >= config.pages:
+            raise web.HTTPNotFound()
+
+        if config.latency > 0:
+            await asyncio.sleep(self.random.uniform(0, 2 * config.latency))
+        if self.random.random() < config.error_rate:
+            return web.Response(status=503)
+
+        links = "".join(f'<a href="/page/{link}">{link}</a>\n' for link in config.get_links(page))
+        html = f"<html><body><h1>{page}</h1>\n{links}<p>"
+        padding = "x" * max(0, config.page_size - len(html) - len("</p></body></html>"))
+        return web.Response(text=f"{html}{padding}</p></body></html>", content_type="text/html")
+
+
+# 測る側. spawnした別プロセスで動かす
+class MemoryContentStore(ContentStore):
+    def __init__(self, contents: Dict[URL, StoredContent]):
+        self.contents = contents
+
+    async def pull_content(self, session: BlackcatSession, url: URL) -> Optional[StoredContent]:
+        return self.contents.get(url)
+
+    async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
+        self.contents[url] = StoredContent(content.content_type, content.body, content.size, content.metadata)
+
+
+class MemoryContextStore(ContextStore):
+    def __init__(self, data: Dict[str, Mapping[str, Any]]):
+        self.data = data
+
+    async def close(self) -> None:
+        pass
+
+    async def load(self, session: BlackcatSession, key: str) -> Mapping[str, Any]:
+        if key not in self.data:
+            raise ContextNotFoundError()
+        return self.data[key]
+
+    async def save(self, session: BlackcatSession, key: str, data: Mapping[str, Any]) -> None:
+        self.data[key] = dict(data)
+
+
+def parse_links(url: URL, params: Dict[str, str], content: Content) -> List[str]:
+    return [str(url.join(URL(link.decode("ascii")))) for link in LINK_PATTERN.findall(content.body)]
+
+
+async def benchmark_page(session: BlackcatSession, url: str) -> None:
+    try:
+        links = await session.crawl(url, parser=parse_links)
+    except CrawlerError as exc:
+        # 失敗を再現するためのerror_rateなので、止めずに数える
+        logger.info("Benchmark page failed", url=url, error=repr(exc))
+        session.blackcat.metrics.inc(FAILED_PAGES)
+        return
+    context = await session.get_context(CONTEXT_NAME)
+    await context.set(url, len(links))
+    for link in links:
+        await session.dispatch(PAGE_PLANNER, {"url": link})
+
+
+def run_case(case: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    1つの組み合わせで、空の状態から(cold)と、同じsession idでもう1回(warm)クロールする
+
+    warmはContent Storeに残っているものを読むだけになる. それが測れない組み合わせはwarm_skippedに理由を入れる
+    """
+    with contextlib.ExitStack() as stack:
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="blkct-benchmark-"))
+        if {case["content_store"], case["context_store"]} & {"s3", "dynamodb"}:
+            stack.enter_context(mock_aws())
+
+        content_store_factory = make_content_store_factory(case["content_store"], workdir)
+        context_store_factory = make_context_store_factory(case["context_store"], workdir)
+        result: Dict[str, Any] = {}
+        warm_skip_reason = get_warm_skip_reason(case["scheduler"], case["content_store"], case["context_store"])
+        if warm_skip_reason:
+            result["warm_skipped"] = warm_skip_reason
+        for run in ("cold",) if warm_skip_reason else ("cold", "warm"):
+            blackcat = Blackcat(
+                planners={PAGE_PLANNER: benchmark_page},
+                content_parsers=[],
+                scheduler_factory=make_scheduler_factory(case, os.path.join(workdir, f"{run}.sqlite3")),
+                content_store_factory=content_store_factory,
+                context_store_factory=context_store_factory,
+                request_interval=0,
+                max_requests_per_host=case["concurrency"],
+                retry_backoff=case["retry_backoff"],
+                # error_rateの503でホスト全体を止めないように、circuit breakerは使わない
+                circuit_breaker_threshold=0,
+                connection_limit=case["concurrency"] * case["processes"],
+            )
+            start = time.perf_counter()
+            asyncio.run(run_session(blackcat, case["root_url"]))
+            result[run] = summarize(blackcat.metrics, time.perf_counter() - start)
+
+    result["peak_rss"] = get_peak_rss()
+    return result
+
+
+async def run_session(blackcat: Blackcat, root_url: str) -> None:
+    try:
+        await blackcat.run_with_session(PAGE_PLANNER, {"url": root_url}, "benchmark")
+    finally:
+        await blackcat.close()
+
+
+@contextlib.contextmanager
+def mock_aws() -> Any:
+    os.environ.update(AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing", AWS_DEFAULT_REGION="us-east-1")
+    with moto.mock_aws():
+        boto3.client("s3").create_bucket(Bucket=S3_BUCKET)
+        boto3.client("dynamodb").create_table(
+            TableName=DYNAMODB_TABLE,
+            KeySchema=[{"AttributeName": "key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield
+
+
+def make_scheduler_factory(case: Mapping[str, Any], db_path: str) -> SchedulerFactory:
+    name, concurrency = case["scheduler"], case["concurrency"]
+    if name == "asyncio":
+        return lambda: AsyncIOScheduler(num_workers=concurrency)
+    if name == "priority":
+        return lambda: PriorityScheduler(num_workers=concurrency)
+    if name == "sqlite":
+        # warmでも全て処理するように、runの度に新しいdbにする
+        return lambda: SQLiteScheduler(db_path, num_workers=concurrency)
+    if name == "multiprocess":
+        return lambda: MultiprocessScheduler(num_processes=case["processes"], num_workers=concurrency)
+    raise ValueError(f"unknown scheduler `{name}`")
+
+
+def make_content_store_factory(name: str, workdir: str) -> ContentStoreFactory:
+    if name == "memory":
+        contents: Dict[URL, StoredContent] = {}
+        return lambda: MemoryContentStore(contents)
+    if name == "file":
+        return lambda: FileContentStore(os.path.join(workdir, "contents"))
+    if name == "segment":
+        return lambda: SegmentContentStore(os.path.join(workdir, "segments"))
+    if name == "s3":
+        return lambda: S3ContentStore(S3_BUCKET, "contents/")
+    raise ValueError(f"unknown content store `{name}`")
+
+
+def make_context_store_factory(name: str, workdir: str) -> ContextStoreFactory:
+    if name == "memory":
+        data: Dict[str, Mapping[str, Any]] = {}
+        return lambda: MemoryContextStore(data)
+    if name == "file":
+        return lambda: FileContextStore(os.path.join(workdir, "context.db"))
+    if name == "dynamodb":
+        return lambda: DynamoDBContextStore(DYNAMODB_TABLE)
+    raise ValueError(f"unknown context store `{name}`")
+
+
+def summarize(metrics: MetricsRegistry, seconds: float) -> Dict[str, Any]:
+    """1回のクロールのメトリクスから、比べたい数字を取り出す"""
+    pages = get_histogram(metrics, PLANNER_SECONDS, planner=PAGE_PLANNER).count
+    latency = get_histogram(metrics, HTTP_REQUEST_SECONDS)
+    requests = get_counter(metrics, HTTP_REQUESTS)
+    push = get_histogram(metrics, CONTENT_STORE_SECONDS, operation="push")
+    pull = get_histogram(metrics, CONTENT_STORE_SECONDS, operation="pull")
+    save = get_histogram(metrics, CONTEXT_STORE_SECONDS, operation="save")
+    bytes_fetched = get_counter(metrics, HTTP_RESPONSE_BYTES)
+    return {
+        "seconds": seconds,
+        "pages": pages,
+        "pages_per_sec": pages / seconds,
+        "failed_pages": get_counter(metrics, FAILED_PAGES),
+        "requests": requests,
+        "failed_requests": requests - get_counter(metrics, HTTP_REQUESTS, status="200"),
+        "fetch_latency_p50": latency.quantile(0.5) if latency.count else None,
+        "fetch_latency_p99": latency.quantile(0.99) if latency.count else None,
+        "bytes_fetched": bytes_fetched,
+        # storeの数字は1回の操作あたり(並行に動いた分は足さない)
+        "content_store": {
+            "hits": get_counter(metrics, CONTENT_STORE_LOOKUPS, result="hit"),
+            "misses": get_counter(metrics, CONTENT_STORE_LOOKUPS, result="miss"),
+            "pulls_per_sec": per_sec(pull.count, pull.sum),
+            "pushes_per_sec": per_sec(push.count, push.sum),
+            "push_bytes_per_sec": per_sec(bytes_fetched, push.sum) if push.count else None,
+        },
+        "context_store": {"saves": save.count, "saves_per_sec": per_sec(save.count, save.sum)},
+    }
+
+
+def get_counter(metrics: MetricsRegistry, name: str, **labels: str) -> float:
+    """labelsを含むものを全て足す"""
+    return sum(
+        value
+        for (metric_name, metric_labels), value in metrics.counters.items()
+        if metric_name == name and labels.items() <= dict(metric_labels).items()
+    )
+
+
+def get_histogram(metrics: MetricsRegistry, name: str, **labels: str) -> Histogram:
+    """labelsを含むものを全て足したHistogram"""
+    total = Histogram()
+    for (metric_name, metric_labels), histogram in metrics.histograms.items():
+        if metric_name == name and labels.items() <= dict(metric_labels).items():
+            total.counts = [a + b for a, b in zip(total.counts, histogram.counts)]
+            total.sum += histogram.sum
+            total.count += histogram.count
+    return total
+
+
+def per_sec(count: float, seconds: float) -> Optional[float]:
+    return count / seconds if seconds > 0 else None
+
+
+def get_peak_rss() -> int:
+    """このプロセスと、待ち終わった子プロセスの最大RSS(bytes)"""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # Linuxはkilobytes, macOSはbytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# 全体
+def get_skip_reason(scheduler: str, content_store: str, context_store: str) -> Optional[str]:
+    if not has_moto and (content_store == "s3" or context_store == "dynamodb"):
+        return "moto is not installed"
+    if scheduler == "multiprocess" and context_store == "file":
+        return "dbm file can not be shared by processes"
+    return None
+
+
+def get_warm_skip_reason(scheduler: str, content_store: str, context_store: str) -> Optional[str]:
+    # memory storeとmotoはプロセスのメモリにあるので、workerプロセスが書いたものは次のrunから見えない
+    if scheduler == "multiprocess" and {content_store, context_store} & {"memory", "s3", "dynamodb"}:
+        return "stores written by worker processes are not visible to the next run"
+    return None
+
+
+def run_benchmark(
+    site_config: SiteConfig,
+    schedulers: List[str],
+    content_stores: List[str],
+    context_stores: List[str],
+    concurrency: int = 8,
+    processes: int = 2,
+    retry_backoff: float = 0.05,
+    label: Optional[str] = None,
+    progress: Optional[Callable[[Mapping[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """
+    全ての組み合わせを測って、結果をJSONにできるdictで返す
+
+    組み合わせ毎に新しいプロセスで動かすので、ピークのRSSやmotoの状態は混ざらない
+    """
+    site = SyntheticSite(site_config)
+    site.start()
+    cases: List[Dict[str, Any]] = []
+    try:
+        for scheduler in schedulers:
+            for content_store in content_stores:
+                for context_store in context_stores:
+                    case: Dict[str, Any] = {
+                        "scheduler": scheduler,
+                        "content_store": content_store,
+                        "context_store": context_store,
+                    }
+                    skip_reason = get_skip_reason(scheduler, content_store, context_store)
+                    if skip_reason:
+                        case["skipped"] = skip_reason
+                    else:
+                        options = dict(
+                            case,
+                            root_url=site.root_url,
+                            concurrency=concurrency,
+                            processes=processes,
+                            retry_backoff=retry_backoff,
+                        )
+                        try:
+                            case.update(run_case_in_process(options))
+                        except Exception as exc:
+                            # 1つの組み合わせが失敗しても、残りは測る
+                            case["error"] = repr(exc)
+                    cases.append(case)
+                    if progress:
+                        progress(case)
+    finally:
+        site.stop()
+
+    return {
+        "label": label,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "site": site_config.to_json(),
+        "concurrency": concurrency,
+        "processes": processes,
+        "cases": cases,
+    }
+
+
+def run_case_in_process(case: Mapping[str, Any]) -> Dict[str, Any]:
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_case, case).result()
+
+
+def parse_names(value: str) -> List[str]:
+    return [name for name in value.split(",") if name]
+
+
+def main(args: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m blkct.benchmark", description=__doc__)
+    parser.add_argument("--pages", type=int, default=500)
+    parser.add_argument("--fanout", type=int, default=8)
+    parser.add_argument("--page-size", type=int, default=16 * 1024, help="bytes")
+    parser.add_argument("--latency", type=float, default=0.005, help="mean seconds the site waits per page")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability the site returns 503")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--schedulers", type=parse_names, default=list(SCHEDULERS))
+    parser.add_argument("--content-stores", type=parse_names, default=list(CONTENT_STORES))
+    parser.add_argument("--context-stores", type=parse_names, default=list(CONTEXT_STORES))
+    parser.add_argument("--concurrency", type=int, default=8, help="workers (per process)")
+    parser.add_argument("--processes", type=int, default=2, help="processes of the multiprocess scheduler")
+    parser.add_argument("--retry-backoff", type=float, default=0.05)
+    parser.add_argument("--label", help="e.g. the version or commit being measured")
+    parser.add_argument("--output", help="JSON file to write, stdout if omitted")
+    parsed = parser.parse_args(args)
+
+    for names, known in (
+        (parsed.schedulers, SCHEDULERS),
+        (parsed.content_stores, CONTENT_STORES),
+        (parsed.context_stores, CONTEXT_STORES),
+    ):
+        for name in names:
+            if name not in known:
+                parser.error(f"unknown `{name}`, choose from {', '.join(known)}")
+
+    def progress(case: Mapping[str, Any]) -> None:
+        name = f"{case['scheduler']}/{case['content_store']}/{case['context_store']}"
+        if "skipped" in case:
+            print(f"{name}: skipped ({case['skipped']})", file=sys.stderr)
+        elif "error" in case:
+            print(f"{name}: failed ({case['error']})", file=sys.stderr)
+        else:
+            print(f"{name}: {case['cold']['pages_per_sec']:.1f} pages/sec", file=sys.stderr)
+
+    result = run_benchmark(
+        SiteConfig(parsed.pages, parsed.fanout, parsed.page_size, parsed.latency, parsed.error_rate, parsed.seed),
+        parsed.schedulers,
+        parsed.content_stores,
+        parsed.context_stores,
+        concurrency=parsed.concurrency,
+        processes=parsed.processes,
+        retry_backoff=parsed.retry_backoff,
+        label=parsed.label,
+        progress=progress,
+    )
+    text = json.dumps(result, indent=2)
+    if parsed.output:
+        with open(parsed.output, "w") as fp:
+            fp.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
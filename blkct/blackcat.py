@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import asyncio
 import contextlib
+import weakref
 from typing import TYPE_CHECKING, cast
 
 import aiohttp
@@ -8,89 +10,260 @@ import aiohttp
 from yarl import URL
 
 from .logging import logger
+from .metrics import MetricsExporter, MetricsRegistry
+from .profiling import PlannerProfiler
+from .ratelimit import HostRateLimiter
+from .router import ContentParserRouter
 from .session import BlackcatSession
 from .setup import ContentParserEntry
+from .typing import Scheduler
 
 if TYPE_CHECKING:
     from types import TracebackType
-    from typing import Any, AsyncGenerator, Dict, List, Mapping, Optional, Tuple, Type
+    from typing import Any, AsyncGenerator, Dict, List, Mapping, Optional, Tuple, Type, Union
 
+    from .ratelimit import HostLimit
     from .typing import ContentParserType, ContentStoreFactory, ContextStoreFactory, PlannerType, SchedulerFactory
 
 
 class Blackcat:
-    content_parsers: List[ContentParserEntry]
+    connector_sessions: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, int]  # connectorを使っているsessionの数
+    connectors: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aiohttp.TCPConnector]
+    content_parser_router: ContentParserRouter
+    metrics: MetricsRegistry
     # content_store_factory: ContentStoreFactory
     planners: Dict[str, PlannerType]
+    profiler: Optional[PlannerProfiler]
     # scheduler_factory: SchedulerFactory
     session: Optional[BlackcatSession]
 
     def __init__(
         self,
         planners: Dict[str, PlannerType],
-        content_parsers: List[ContentParserEntry],
+        content_parsers: Union[List[ContentParserEntry], ContentParserRouter],
         scheduler_factory: SchedulerFactory,
         content_store_factory: ContentStoreFactory,
         context_store_factory: ContextStoreFactory,
         user_agent: Optional[str] = None,
+        request_interval: float = 2.5,
+        max_requests_per_host: int = 1,
+        host_limits: Optional[Mapping[str, HostLimit]] = None,
+        context_write_through: bool = False,
+        context_flush_interval: Optional[float] = 5.0,
+        context_flush_threshold: int = 100,
+        max_body_size: Optional[int] = None,
+        spool_threshold: int = 1024 * 1024,
+        revalidate: bool = False,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 0,
+        connect_timeout: Optional[float] = 30.0,
+        read_timeout: Optional[float] = 60.0,
+        total_timeout: Optional[float] = 300.0,
+        dns_cache_ttl: Optional[int] = 10,
+        keepalive_timeout: float = 15.0,
+        adaptive_throttle: bool = False,
+        min_request_interval: float = 0.25,
+        max_request_interval: float = 60.0,
+        max_retries: int = 2,
+        retry_backoff: float = 1.0,
+        circuit_breaker_threshold: int = 5,
+        circuit_breaker_cooldown: float = 60.0,
+        metrics_path: Optional[str] = None,
+        metrics_json_path: Optional[str] = None,
+        metrics_host: str = "127.0.0.1",
+        metrics_port: Optional[int] = None,
+        metrics_interval: float = 15.0,
+        profile_dir: Optional[str] = None,
+        profile_memory: bool = False,
     ):
         self.planners = planners
-        self.content_parsers = content_parsers
+        if not isinstance(content_parsers, ContentParserRouter):
+            content_parsers = ContentParserRouter(content_parsers)
+        self.content_parser_router = content_parsers
         self.scheduler_factory = scheduler_factory
         self.content_store_factory = content_store_factory
         self.context_store_factory = context_store_factory
         self.session = None
         self.user_agent = user_agent or "blkct crawler"
-        self.request_interval = 2.5
+        self.request_interval = request_interval
+        self.max_requests_per_host = max_requests_per_host
+        self.host_limits = dict(host_limits or {})
+        self.context_write_through = context_write_through
+        self.context_flush_interval = context_flush_interval
+        self.context_flush_threshold = context_flush_threshold
+        self.max_body_size = max_body_size
+        self.spool_threshold = spool_threshold
+        self.revalidate = revalidate
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.adaptive_throttle = adaptive_throttle
+        self.min_request_interval = min_request_interval
+        self.max_request_interval = max_request_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_cooldown = circuit_breaker_cooldown
+        self.connectors = weakref.WeakKeyDictionary()
+        self.connector_sessions = weakref.WeakKeyDictionary()
+        self.metrics = MetricsRegistry()
+        self.metrics_path = metrics_path
+        self.metrics_json_path = metrics_json_path
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval
+        self.profiler = PlannerProfiler(profile_dir, memory=profile_memory) if profile_dir else None
 
     # public
     @contextlib.asynccontextmanager
     async def start_session(self, session_id: str) -> AsyncGenerator[BlackcatSession, None]:
         if self.session:
             raise ValueError("session is already started")
-        self.session = BlackcatSession(
-            self,
-            self.scheduler_factory(),
-            self.content_store_factory(),
-            self.context_store_factory(),
-            session_id=session_id,
-        )
+        scheduler = self.scheduler_factory()
+        # Schedulerを継承していないものにはstart/closeが無い
+        started = isinstance(scheduler, Scheduler)
+        if started:
+            await scheduler.start(self, session_id)
+        try:
+            self.session = BlackcatSession(
+                self,
+                scheduler,
+                self.content_store_factory(),
+                self.context_store_factory(),
+                session_id=session_id,
+            )
+        except BaseException:
+            if started:
+                await scheduler.close()
+            raise
         logger.info("Start session", session_id=self.session.session_id)
+        exporter = MetricsExporter(
+            self.metrics,
+            prometheus_path=self.metrics_path,
+            json_path=self.metrics_json_path,
+            host=self.metrics_host,
+            port=self.metrics_port,
+            interval=self.metrics_interval,
+        )
+        await exporter.start()
         try:
             yield self.session
         finally:
-            if self.session:
-                await self.session.close()
-            self.session = None
+            try:
+                try:
+                    if self.session:
+                        await self.session.close()
+                    self.session = None
+                finally:
+                    if started:
+                        await scheduler.close()
+            finally:
+                # sessionを閉じるまでの分も含めて書き出す
+                await exporter.stop()
+                if self.profiler:
+                    self.profiler.stop()
+                    self.profiler.write_stats(session_id)
+                    self.profiler.write_summary(session_id)
 
     async def run_with_session(self, planner: str, args: Mapping[str, Any], session_id: str) -> None:
         async with self.start_session(session_id=session_id) as session:
             await session.dispatch(planner, args)
             await session.scheduler.run()
 
+    async def close(self) -> None:
+        """
+        このevent loopで使っていたconnection poolを閉じる
+
+        最後のsessionを閉じた時にも閉じるので、呼ばなくてもよい
+        """
+        loop = asyncio.get_event_loop()
+        self.connector_sessions.pop(loop, None)
+        connector = self.connectors.pop(loop, None)
+        if connector:
+            await connector.close()
+
     # internal
     def get_content_parsers_by_url(self, url: URL) -> Tuple[ContentParserType, Dict[str, str]]:
         if url.scheme not in ("http", "https"):
             raise ValueError(f"Bad URL `{url}`")
 
-        found = []
-        for pattern, parser in self.content_parsers:
-            mo = pattern.match(str(url))
-            if mo:
-                found.append((mo, parser))
+        return self.content_parser_router.match(url)
+
+    def make_rate_limiter(self) -> HostRateLimiter:
+        """ホスト毎のアクセス制限をするHostRateLimiterを作って返す"""
+        return HostRateLimiter(
+            self.request_interval, self.max_requests_per_host, self.host_limits, **self.throttle_options
+        )
 
-        if len(found) > 2:
-            raise Exception(f"Multiple parser found for url `{url}`")
-        elif not found:
-            raise Exception(f"No parser found for url `{url}`")
-        mo, parser = found[0]
-        return parser, mo.groupdict()
+    @property
+    def throttle_options(self) -> Dict[str, Any]:
+        """HostRateLimiterに渡す、アクセス間隔の調整とcircuit breakerの設定"""
+        return {
+            "adaptive": self.adaptive_throttle,
+            "min_interval": self.min_request_interval,
+            "max_interval": self.max_request_interval,
+            "breaker_threshold": self.circuit_breaker_threshold,
+            "breaker_cooldown": self.circuit_breaker_cooldown,
+        }
 
     def make_aio_session(self) -> aiohttp.ClientSession:
-        """aiohttp.ClientSessionを作って返す"""
-        session = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(), headers={"User-Agent": self.user_agent})
+        """
+        aiohttp.ClientSessionを作って返す
+
+        cookieはsession毎だが、connection poolは同じevent loopの全sessionで共有する.
+        close_aio_sessionで閉じる
+        """
+        connector = self.get_connector()
+        loop = asyncio.get_event_loop()
+        self.connector_sessions[loop] = self.connector_sessions.get(loop, 0) + 1
+        session = aiohttp.ClientSession(
+            connector=connector,
+            connector_owner=False,
+            timeout=aiohttp.ClientTimeout(
+                total=self.total_timeout, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            ),
+            cookie_jar=aiohttp.CookieJar(),
+            headers={"User-Agent": self.user_agent},
+        )
         return session
 
+    async def close_aio_session(self, session: aiohttp.ClientSession) -> None:
+        """make_aio_sessionで作ったものを閉じる. このevent loopで最後のものならconnection poolも閉じる"""
+        await session.close()
+        loop = asyncio.get_event_loop()
+        count = self.connector_sessions.get(loop, 0) - 1
+        if count > 0:
+            self.connector_sessions[loop] = count
+        else:
+            await self.close()
+
+    def get_connector(self) -> aiohttp.TCPConnector:
+        """
+        event loop毎のconnection poolを返す
+
+        forkした子プロセスなどで別のevent loopから呼ばれたら、そのloop用のものを作る
+        """
+        loop = asyncio.get_event_loop()
+        connector = self.connectors.get(loop)
+        if connector is None or connector.closed:
+            options: Dict[str, Any] = {}
+            if self.keepalive_timeout > 0:
+                options["keepalive_timeout"] = self.keepalive_timeout
+            else:
+                options["force_close"] = True
+            connector = self.connectors[loop] = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit_per_host,
+                use_dns_cache=self.dns_cache_ttl != 0,
+                ttl_dns_cache=self.dns_cache_ttl,
+                **options,
+            )
+        return connector
+
 
 def reraise(exc_type: Type[BaseException], exc_value: Exception, tb: Optional[TracebackType] = None) -> None:
     if exc_value.__traceback__ is not tb:
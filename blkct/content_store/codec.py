@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import abc
+import gzip
+import shutil
+import zlib
+from typing import Dict, IO, Optional, Type, cast
+
+try:
+    import zstandard
+
+    has_zstandard = True
+except ImportError:
+    has_zstandard = False
+
+__all__ = ("Codec", "CODECS", "get_codec", "is_compressible", "select_codec")
+
+# ファイルを読み書きする単位
+COPY_CHUNK_SIZE = 64 * 1024
+
+# 既に圧縮されているので、圧縮しないcontent type
+UNCOMPRESSIBLE_TYPE_PREFIXES = ("image/", "video/", "audio/", "font/woff")
+UNCOMPRESSIBLE_TYPES = frozenset(
+    (
+        "application/gzip",
+        "application/x-gzip",
+        "application/zip",
+        "application/x-7z-compressed",
+        "application/x-bzip2",
+        "application/x-xz",
+        "application/x-rar-compressed",
+        "application/zstd",
+    )
+)
+
+
+class Codec(metaclass=abc.ABCMeta):
+    """Content Storeに保存するbodyの圧縮方式"""
+
+    name: str
+    extension: str  # ファイル名につける拡張子
+
+    def __init__(self, level: Optional[int] = None):
+        self.level = level
+
+    @abc.abstractmethod
+    def compress_stream(self, src: IO[bytes], dst: IO[bytes]) -> int:
+        """srcを圧縮してdstに書く. 読んだ(圧縮前の)バイト数を返す"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def open_file(self, path: str) -> IO[bytes]:
+        """圧縮されたファイルを開いて、展開しながら読むfile objectを返す"""
+        raise NotImplementedError
+
+
+class IdentityCodec(Codec):
+    """圧縮しない"""
+
+    name = "identity"
+    extension = ""
+
+    def compress_stream(self, src: IO[bytes], dst: IO[bytes]) -> int:
+        start = dst.tell()
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        return dst.tell() - start
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def open_file(self, path: str) -> IO[bytes]:
+        return open(path, "rb")
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    extension = ".gz"
+
+    def compress_stream(self, src: IO[bytes], dst: IO[bytes]) -> int:
+        size = 0
+        # mtimeを固定して、同じbodyは同じバイト列にする
+        level = 6 if self.level is None else self.level
+        with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=level, mtime=0) as fp:
+            for chunk in iter(lambda: src.read(COPY_CHUNK_SIZE), b""):
+                fp.write(chunk)
+                size += len(chunk)
+        return size
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    def open_file(self, path: str) -> IO[bytes]:
+        return cast(IO[bytes], gzip.open(path, "rb"))
+
+
+class ZstdCodec(Codec):
+    name = "zstd"
+    extension = ".zst"
+
+    def compress_stream(self, src: IO[bytes], dst: IO[bytes]) -> int:
+        compressor = zstandard.ZstdCompressor(level=3 if self.level is None else self.level)
+        read, written = compressor.copy_stream(src, dst, read_size=COPY_CHUNK_SIZE)
+        return read
+
+    def decompress(self, data: bytes) -> bytes:
+        # copy_streamはframeにサイズを書かないので、decompressobjで展開する
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+    def open_file(self, path: str) -> IO[bytes]:
+        return cast(IO[bytes], zstandard.open(path, "rb"))
+
+
+CODECS: Dict[str, Type[Codec]] = {"identity": IdentityCodec, "gzip": GzipCodec}
+if has_zstandard:
+    CODECS["zstd"] = ZstdCodec
+
+
+def get_codec(name: Optional[str], level: Optional[int] = None) -> Codec:
+    """名前からCodecを作る. Noneはidentity"""
+    try:
+        return CODECS[name or "identity"](level)
+    except KeyError:
+        raise ValueError(f"unknown codec `{name}`, available: {', '.join(sorted(CODECS))}")
+
+
+def is_compressible(content_type: str) -> bool:
+    """圧縮する意味のあるcontent typeならTrue"""
+    mime_type = content_type.split(";", 1)[0].strip().lower()
+    if mime_type == "image/svg+xml":
+        return True
+    return not (mime_type.startswith(UNCOMPRESSIBLE_TYPE_PREFIXES) or mime_type in UNCOMPRESSIBLE_TYPES)
+
+
+def select_codec(codec: Codec, content_type: str) -> Codec:
+    """content typeが圧縮済みのものならidentity、そうでなければcodecを返す"""
+    return codec if is_compressible(content_type) else IdentityCodec()
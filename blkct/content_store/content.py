@@ -1,19 +1,32 @@
 from __future__ import annotations
 
 import abc
+import hashlib
+import importlib.util
+import io
 import os
-from typing import Any, Optional
+import time
+from typing import Any, Callable, ClassVar, Dict, FrozenSet, IO, Iterable, Mapping, Optional, Tuple, Union, cast
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 from multidict import CIMultiDictProxy
 
 from yarl import URL
 
 DEFAULT_MIME_TYPE = "application/octet-stream"
+# Content Storeにbodyと一緒に保存するレスポンスヘッダ
+METADATA_HEADERS = ("Content-Type", "ETag", "Last-Modified", "Cache-Control", "Expires", "Date")
+# lxmlがあればそちらの方がhtml.parserよりずっと速い
+DEFAULT_HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
 
 
 class Content(metaclass=abc.ABCMeta):
+    # parsed_htmlで使うBeautifulSoupのtree builder
+    html_parser: ClassVar[str] = DEFAULT_HTML_PARSER
+
+    _parsed_html_cache: Dict[Optional[FrozenSet[str]], Any]
+
     @property
     def body(self) -> bytes:
         raise NotImplementedError
@@ -22,37 +35,136 @@ class Content(metaclass=abc.ABCMeta):
     def content_type(self) -> str:
         raise NotImplementedError
 
+    @property
+    def size(self) -> int:
+        return len(self.body)
+
+    @property
+    def metadata(self) -> Mapping[str, Any]:
+        """
+        bodyと一緒にContent Storeに保存するレスポンスの情報
+
+        `status`, `headers`(METADATA_HEADERSのみ), `fetched_at`(epoch秒)を持つ. 分からない項目は無い
+        """
+        return {}
+
+    @property
+    def revalidation_headers(self) -> Dict[str, str]:
+        """このContentが更新されているか確かめるためのリクエストヘッダ(If-None-Match/If-Modified-Since)"""
+        headers = self.metadata.get("headers", {})
+        rv = {}
+        if "ETag" in headers:
+            rv["If-None-Match"] = headers["ETag"]
+        if "Last-Modified" in headers:
+            rv["If-Modified-Since"] = headers["Last-Modified"]
+        return rv
+
+    def open_body(self) -> IO[bytes]:
+        """
+        bodyを先頭から読むfile objectを返す
+
+        大きなbodyもメモリに載せずに読める. 読み終わったらcloseすること
+        """
+        return io.BytesIO(self.body)
+
     @property
     def parsed_html(self) -> Any:
+        return self.parse_html()
+
+    def parse_html(self, only: Optional[Iterable[str]] = None) -> Any:
+        """
+        bodyをBeautifulSoupでparseして返す
+
+        onlyにtag名を渡すと、そのtagだけをparseする(SoupStrainer).
+        結果はContent毎にキャッシュするので、treeを書き換える場合は注意
+        """
         if self.content_type != "text/html":
             raise ValueError("content is not html")
 
-        return BeautifulSoup(self.body, "html.parser")
+        key = frozenset(only) if only is not None else None
+        try:
+            cache = self._parsed_html_cache
+        except AttributeError:
+            cache = self._parsed_html_cache = {}
+
+        if key not in cache:
+            parse_only = SoupStrainer(list(key)) if key is not None else None
+            cache[key] = BeautifulSoup(self.body, self.html_parser, parse_only=parse_only)
+        return cache[key]
 
 
 class StoredContent(Content):
-    """Content Storeから取ってきたContent"""
+    """
+    Content Storeから取ってきたContent
+
+    bodyの代わりにbodyを開く関数を渡すと、bodyが必要になるまで読まない
+    """
+
+    _body: Optional[bytes]
+    _body_opener: Optional[Callable[[], IO[bytes]]]
+    _metadata: Mapping[str, Any]
 
-    def __init__(self, content_type: Optional[str], body: bytes):
+    def __init__(
+        self,
+        content_type: Optional[str],
+        body: Union[bytes, Callable[[], IO[bytes]]],
+        size: Optional[int] = None,
+        metadata: Optional[Mapping[str, Any]] = None,
+    ):
         self._content_type = content_type or DEFAULT_MIME_TYPE
-        self._body = body
+        self._metadata = metadata or {}
+        if isinstance(body, bytes):
+            self._body, self._body_opener = body, None
+        else:
+            self._body, self._body_opener = None, body
+        self._size = size
 
     @property
     def body(self) -> bytes:
+        if self._body is None:
+            with self.open_body() as fp:
+                self._body = fp.read()
         return self._body
 
     @property
     def content_type(self) -> str:
         return self._content_type
 
+    @property
+    def size(self) -> int:
+        if self._body is None and self._size is not None:
+            return self._size
+        return len(self.body)
+
+    @property
+    def metadata(self) -> Mapping[str, Any]:
+        return self._metadata
+
+    def open_body(self) -> IO[bytes]:
+        if self._body is None and self._body_opener:
+            return self._body_opener()
+        return super().open_body()
+
 
 class FetchedContent(Content):
-    """Content Storeから取ってきたContent"""
+    """
+    HTTPで取ってきたContent
 
-    def __init__(self, status_code: int, headers: CIMultiDictProxy, body: bytes):
+    bodyはbytesか、一時ファイルなどのfile object(先頭から読める状態のもの)で持つ.
+    file objectの場合はbodyが必要になるまでメモリに載せず、メモリに読んだらfile objectは閉じる
+    """
+
+    _body: Optional[bytes]
+    _body_file: Optional[IO[bytes]]
+
+    def __init__(self, status_code: int, headers: CIMultiDictProxy, body: Union[bytes, IO[bytes]]):
         self._status_code = status_code
         self._headers = headers
-        self._body = body
+        self._fetched_at = time.time()
+        if isinstance(body, bytes):
+            self._body, self._body_file = body, None
+        else:
+            self._body, self._body_file = None, body
 
     @property
     def status_code(self) -> int:
@@ -60,13 +172,79 @@ class FetchedContent(Content):
 
     @property
     def body(self) -> bytes:
+        if self._body is None:
+            self.load_body()
+            assert self._body is not None
         return self._body
 
+    @property
+    def headers(self) -> CIMultiDictProxy:
+        return self._headers
+
+    @property
+    def metadata(self) -> Mapping[str, Any]:
+        return {
+            "status": self._status_code,
+            "headers": {name: self._headers[name] for name in METADATA_HEADERS if name in self._headers},
+            "fetched_at": self._fetched_at,
+        }
+
+    @property
+    def size(self) -> int:
+        if self._body is None:
+            assert self._body_file
+            return self._body_file.seek(0, io.SEEK_END)
+        return len(self._body)
+
+    def open_body(self) -> IO[bytes]:
+        if self._body is None:
+            assert self._body_file
+            self._body_file.seek(0)
+            return cast(IO[bytes], UnclosableReader(self._body_file))
+        return super().open_body()
+
+    def load_body(self) -> None:
+        """file objectのbodyをメモリに読み、file objectを閉じる"""
+        if self._body_file:
+            self._body_file.seek(0)
+            self._body = self._body_file.read()
+            self.close()
+
+    def close(self) -> None:
+        """一時ファイルを消す. bodyをメモリに読んでいなければ、以降は読めない"""
+        if self._body_file:
+            self._body_file.close()
+            self._body_file = None
+
     @property
     def content_type(self) -> str:
         return self._headers.get("Content-Type", DEFAULT_MIME_TYPE)
 
 
+class UnclosableReader(io.RawIOBase):
+    """closeしても元のfile objectを閉じない読み込み用のwrapper"""
+
+    def __init__(self, fp: IO[bytes]):
+        self._fp = fp
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._fp.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._fp.tell()
+
+    def readinto(self, b: Any) -> int:
+        data = self._fp.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
 # utility
 def url_to_path(base_dir_path: str, url: URL, extension: Optional[str] = None) -> str:
     if url.scheme not in ("http", "https") or not url.host or not url.port:
@@ -80,3 +258,14 @@ def url_to_path(base_dir_path: str, url: URL, extension: Optional[str] = None) -
         filepath += extension
 
     return os.path.join(base_dir_path, f"{url.scheme}:{url.host}:{url.port}", filepath)
+
+
+def digest_body(body: IO[bytes]) -> Tuple[str, int]:
+    """bodyのsha256(hex)とサイズを返す. 読んだ後は先頭に戻す"""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: body.read(64 * 1024), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    body.seek(0)
+    return digest.hexdigest(), size
@@ -1,11 +1,19 @@
 from __future__ import annotations
 
-import glob
+import abc
+import asyncio
+import io
+import json
 import mimetypes
 import os
-from typing import Optional, TYPE_CHECKING
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Generic, IO, List, Mapping, NamedTuple, Optional, TYPE_CHECKING, Tuple, TypeVar
 
-from .content import FetchedContent, StoredContent, url_to_path
+from .codec import CODECS, Codec, IdentityCodec, get_codec, select_codec
+from .content import DEFAULT_MIME_TYPE, FetchedContent, StoredContent, digest_body, url_to_path
 from ..logging import logger
 from ..typing import ContentStore
 
@@ -14,42 +22,314 @@ if TYPE_CHECKING:
 
     from ..session import BlackcatSession
 
+INDEX_FILENAME = "index.jsonl"
+# content addressedで、bodyをhashで置くdirectory
+OBJECTS_DIR = "_objects"
+# content addressedで、全sessionを通してURL毎に最後に保存したものを指すファイルを置くdirectory
+LATEST_DIR = "_latest"
+LATEST_EXTENSION = ".json"
+# これより大きいファイルはbodyが必要になるまで読まない
+EAGER_READ_SIZE = 1024 * 1024
+
 
 class FileContentStore(ContentStore):
-    """fileに貯めるストア"""
+    """
+    fileに貯めるストア
+
+    ファイルの読み書きはevent loopを止めないように、io_workers個のスレッドで行う.
+    bodyはcodecで圧縮して保存する(圧縮済みのcontent typeはそのまま).
+
+    content_addressedなら、bodyはsha256で`_objects`に1つだけ置き、sessionのindexはそれを指すだけにする.
+    さらにread_through_windowを指定すると、今のsessionに無いURLでも、
+    その秒数以内に他のsessionで保存したものがあれば使う.
+    URL毎に最後に保存したものは`_latest`にURL毎のファイルで置き、保存の度に書き換える
+    """
 
+    codec: Codec
+    content_addressed: bool
+    executor: ThreadPoolExecutor
+    indexes: Dict[str, FileContentIndex]
+    indexes_lock: threading.Lock
+    read_through_window: Optional[float]
     store_root_path: str
 
-    def __init__(self, store_root_path: str):
+    def __init__(
+        self,
+        store_root_path: str,
+        io_workers: int = 4,
+        codec: Optional[Codec] = None,
+        content_addressed: bool = False,
+        read_through_window: Optional[float] = None,
+    ):
         self.store_root_path = store_root_path
+        self.codec = codec or IdentityCodec()
+        self.content_addressed = content_addressed
+        self.read_through_window = read_through_window
+        self.executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="blkct-file-content-store")
+        self.indexes = {}
+        self.indexes_lock = threading.Lock()
 
+    # override
     async def pull_content(self, session: BlackcatSession, url: URL) -> Optional[StoredContent]:
-        filepathpattern = url_to_path(os.path.join(self.store_root_path, session.session_id), url) + ".*"
-        files = glob.glob(filepathpattern)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.read_content, session.session_id, url)
 
-        if not files:
-            return None
+    async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
+        loop = asyncio.get_event_loop()
+        with content.open_body() as body:
+            await loop.run_in_executor(
+                self.executor,
+                self.write_content,
+                session.session_id,
+                url,
+                content.content_type,
+                body,
+                content.metadata,
+            )
+
+    async def close(self) -> None:
+        self.executor.shutdown(wait=True)
 
-        if len(files) > 1:
-            logger.warning("multiple content file found %r", files)
+    # private (executorのスレッドで呼ばれる)
+    def read_content(self, session_id: str, url: URL) -> Optional[StoredContent]:
+        index = self.get_index(session_id)
+        key = url_to_path("", url)
+        entry = index.get(key)
+        if not entry and self.read_through_window is not None:
+            entry = self.read_through(index, key)
+        if not entry:
+            return None
 
-        filepath = files[0]
-        dirpath, filename = os.path.split(filepath)
-        content_type, encoding = mimetypes.guess_type(filename)
+        filepath = os.path.join(index.session_dir_path, entry.path)
+        codec = get_codec(entry.codec)
+        if entry.size > EAGER_READ_SIZE:
+            return StoredContent(entry.content_type, lambda: codec.open_file(filepath), entry.size, entry.metadata)
 
         with open(filepath, "rb") as fp:
-            return StoredContent(content_type, fp.read())
+            return StoredContent(entry.content_type, codec.decompress(fp.read()), metadata=entry.metadata)
 
-    async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
-        ext = mimetypes.guess_extension(content.content_type) or ".bin"
-        assert ext and ext.startswith(".")
-        filepath = url_to_path(os.path.join(self.store_root_path, session.session_id), url, ext)
-        dirpath, filename = os.path.split(filepath)
-        logger.info("Save content", url=url, to=filepath)
+    def write_content(
+        self, session_id: str, url: URL, content_type: str, body: IO[bytes], metadata: Mapping[str, Any]
+    ) -> None:
+        codec = select_codec(self.codec, content_type)
+        index = self.get_index(session_id)
+        key = url_to_path("", url)
+
+        digest = None
+        if self.content_addressed:
+            digest, size = digest_body(body)
+            filepath = os.path.join(self.store_root_path, OBJECTS_DIR, digest[:2], digest + codec.extension)
+            if os.path.exists(filepath):
+                logger.info("Reuse content", url=url, to=filepath)
+            else:
+                logger.info("Save content", url=url, to=filepath)
+                self.write_file(filepath, codec, body)
+        else:
+            ext = mimetypes.guess_extension(content_type) or ".bin"
+            assert ext and ext.startswith(".")
+            filepath = url_to_path(index.session_dir_path, url, ext + codec.extension)
+            logger.info("Save content", url=url, to=filepath)
+            size = self.write_file(filepath, codec, body)
+
+        entry = IndexEntry(
+            str(url),
+            os.path.relpath(filepath, index.session_dir_path),
+            content_type,
+            size,
+            dict(metadata),
+            codec.name,
+            digest,
+        )
+        index.add(key, entry)
+        if self.content_addressed:
+            self.write_latest(key, entry._replace(path=os.path.relpath(filepath, self.store_root_path)))
+
+    def write_file(self, filepath: str, codec: Codec, body: IO[bytes]) -> int:
+        """bodyをcodecで圧縮してfilepathに書く. 圧縮前のサイズを返す"""
+        dirpath = os.path.dirname(filepath)
 
         # prepare directory
-        if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
+        os.makedirs(dirpath, exist_ok=True)
+
+        # 書きかけのファイルを読まれないように、一時ファイルに書いてからrenameする
+        fd, temppath = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirpath)
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                size = codec.compress_stream(body, fp)
+            os.chmod(temppath, 0o644)  # mkstempは0600で作るので戻す
+            os.replace(temppath, filepath)
+        except BaseException:
+            os.unlink(temppath)
+            raise
+        return size
+
+    def read_through(self, index: FileContentIndex, key: str) -> Optional[IndexEntry]:
+        """他のsessionでread_through_window秒以内に保存したものがあれば、今のsessionのindexに入れて返す"""
+        assert self.read_through_window is not None
+        entry = self.read_latest(key)
+        if not entry:
+            return None
+
+        fetched_at = (entry.metadata or {}).get("fetched_at")
+        if fetched_at is None or time.time() - fetched_at > self.read_through_window:
+            return None
+
+        logger.debug("Read through", key=key, path=entry.path)
+        filepath = os.path.join(self.store_root_path, entry.path)
+        entry = entry._replace(path=os.path.relpath(filepath, index.session_dir_path))
+        index.add(key, entry)
+        return entry
+
+    def read_latest(self, key: str) -> Optional[IndexEntry]:
+        """URLで最後に保存したもののentryを返す. pathはstore_root_pathからの相対パス"""
+        try:
+            with open(self.get_latest_path(key), encoding="utf-8") as fp:
+                return IndexEntry(*json.load(fp))
+        except FileNotFoundError:
+            return None
+
+    def write_latest(self, key: str, entry: IndexEntry) -> None:
+        data = json.dumps(list(entry)).encode("utf-8")
+        self.write_file(self.get_latest_path(key), IdentityCodec(), io.BytesIO(data))
+
+    def get_latest_path(self, key: str) -> str:
+        return os.path.join(self.store_root_path, LATEST_DIR, key + LATEST_EXTENSION)
+
+    def get_index(self, session_id: str) -> FileContentIndex:
+        with self.indexes_lock:
+            index = self.indexes.get(session_id)
+            if index is None:
+                index = self.indexes[session_id] = FileContentIndex(os.path.join(self.store_root_path, session_id))
+            return index
+
+
+class IndexEntry(NamedTuple):
+    url: Optional[str]  # indexを作り直した場合はNone
+    path: str  # session dirからの相対パス
+    content_type: str
+    size: int  # 圧縮前のサイズ. indexを作り直した場合はファイルのサイズ
+    metadata: Optional[Dict[str, Any]] = None  # レスポンスのstatus, headers, fetched_at
+    codec: Optional[str] = None  # Noneはidentity
+    digest: Optional[str] = None  # content addressedの場合、圧縮前のbodyのsha256
+
+
+IndexEntryT = TypeVar("IndexEntryT", bound=Tuple[Any, ...])
+
+
+class JsonLinesIndex(Generic[IndexEntryT], metaclass=abc.ABCMeta):
+    """
+    session dir毎の、URLから保存した場所へのindex
+
+    url_to_pathの拡張子なしのパスをキーにして、session dirの`index.jsonl`に追記していく.
+    全体をメモリに載せるので、見つからない場合もファイルシステムを探さない.
+    他のプロセスが追記した分は、見つからなかった時にファイルが伸びていれば読み足す
+    """
+
+    entries: Dict[str, IndexEntryT]
+    entry_type: Callable[..., IndexEntryT]
+    index_file_path: str
+    loaded_size: int
+    lock: threading.Lock
+    session_dir_path: str
+
+    def __init__(self, session_dir_path: str):
+        self.session_dir_path = session_dir_path
+        self.index_file_path = os.path.join(session_dir_path, INDEX_FILENAME)
+        self.entries = {}
+        self.loaded_size = 0
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.index_file_path) and os.path.isdir(session_dir_path):
+            self.rebuild()
+        self.refresh()
+
+    # public
+    def get(self, key: str) -> Optional[IndexEntryT]:
+        entry = self.entries.get(key)
+        if entry is None:
+            with self.lock:
+                if self.refresh():
+                    entry = self.entries.get(key)
+        return entry
+
+    def add(self, key: str, entry: IndexEntryT) -> None:
+        with self.lock:
+            self.entries[key] = entry
+            self.append([(key, entry)])
+
+    # private
+    def refresh(self) -> bool:
+        """indexファイルの、まだ読んでいない部分を読む. 読み足したらTrue"""
+        try:
+            size = os.path.getsize(self.index_file_path)
+        except FileNotFoundError:
+            return False
+        if size <= self.loaded_size:
+            return False
+
+        with open(self.index_file_path, "rb") as fp:
+            fp.seek(self.loaded_size)
+            data = fp.read(size - self.loaded_size)
+
+        # 書き込み途中の行は次回に回す
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line:
+                key, *entry = json.loads(line)
+                self.entries[key] = self.entry_type(*entry)
+        self.loaded_size += end
+        return end > 0
+
+    @abc.abstractmethod
+    def rebuild(self) -> None:
+        """indexの無い古いsession dirから、保存したものを走査してindexを作る"""
+        raise NotImplementedError
+
+    def append(self, items: List[Tuple[str, IndexEntryT]]) -> None:
+        if not items:
+            return
+        os.makedirs(self.session_dir_path, exist_ok=True)
+
+        # 他のプロセスと混ざらないように1回のwriteで追記する
+        data = "".join(json.dumps([key, *entry]) + "\n" for key, entry in items).encode("utf-8")
+        with open(self.index_file_path, "ab") as fp:
+            fp.write(data)
+
+
+class FileContentIndex(JsonLinesIndex[IndexEntry]):
+    """FileContentStoreの、URLから保存したファイルへのindex"""
+
+    entry_type = IndexEntry
+
+    def rebuild(self) -> None:
+        """indexの無い古いsession dirから、ファイルを走査してindexを作る"""
+        logger.info("Rebuild content index", path=self.session_dir_path)
+
+        found = []
+        for host_dir in os.scandir(self.session_dir_path):
+            if not host_dir.is_dir():
+                continue
+            for file in os.scandir(host_dir.path):
+                name, codec = file.name, None
+                for codec_class in CODECS.values():
+                    if codec_class.extension and name.endswith(codec_class.extension):
+                        name, codec = name[: -len(codec_class.extension)], codec_class.name
+                        break
 
-        with open(filepath, "wb") as fp:
-            fp.write(content.body)
+                stem, ext = os.path.splitext(name)
+                if not ext or file.name.startswith(".") or not file.is_file():
+                    continue
+                content_type, encoding = mimetypes.guess_type(name)
+                found.append(
+                    (
+                        os.path.join(host_dir.name, stem),
+                        IndexEntry(
+                            None,
+                            os.path.join(host_dir.name, file.name),
+                            content_type or DEFAULT_MIME_TYPE,
+                            file.stat().st_size,
+                            codec=codec,
+                        ),
+                    )
+                )
+        self.append(found)
@@ -1,13 +1,20 @@
 from __future__ import annotations
 
-import io
-from typing import Any, Optional, TYPE_CHECKING
+import asyncio
+import json
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, IO, Mapping, Optional, TYPE_CHECKING, cast
 
 import boto3
 
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-from .content import FetchedContent, StoredContent, url_to_path
+from .codec import Codec, IdentityCodec, get_codec, select_codec
+from .content import FetchedContent, StoredContent, digest_body, url_to_path
+from ..logging import logger
 from ..typing import ContentStore
 
 if TYPE_CHECKING:
@@ -15,42 +22,224 @@ if TYPE_CHECKING:
 
     from ..session import BlackcatSession
 
+# レスポンスの情報(Content.metadata)をJSONで入れるuser metadataのキー
+METADATA_KEY = "blkct-metadata"
+# bodyの圧縮方式を入れるuser metadataのキー
+CODEC_KEY = "blkct-codec"
+# content addressedのpointer objectに、指すbodyのhashを入れるuser metadataのキー
+DIGEST_KEY = "blkct-digest"
+# content addressedで、bodyをhashで置くprefix
+OBJECTS_PREFIX = "_objects/"
+# content addressedで、全sessionを通してURL毎に最後に保存したものを指すpointerのprefix
+LATEST_PREFIX = "_latest"
+# 圧縮したbodyをメモリに置く上限. 超えたら一時ファイルに置く
+SPOOL_SIZE = 1024 * 1024
 
-class S3ContentStore(ContentStore):
-    """s3に貯めるストア"""
-
-    bucket: Any
 
-    def __init__(self, bucket: str, key_prefix: str):
+class S3ContentStore(ContentStore):
+    """
+    s3に貯めるストア
+
+    clientとconnection poolは使い回し、転送はevent loopを止めないようにスレッドで行う.
+    endpoint_urlを指定すればS3互換のサーバ(MinIOなど)も使える.
+    bodyはcodecで圧縮して保存する(圧縮済みのcontent typeはそのまま).
+
+    content_addressedなら、bodyはsha256で`_objects/`に1つだけ置き、URLのkeyにはそれを指すpointerだけを置く.
+    さらにread_through_windowを指定すると、今のsessionに無いURLでも、
+    その秒数以内に他のsessionで保存したものがあれば使う
+    """
+
+    bucket: str
+    client: Any
+    codec: Codec
+    content_addressed: bool
+    executor: ThreadPoolExecutor
+    key_prefix: str
+    read_through_window: Optional[float]
+    upload_semaphore: asyncio.Semaphore
+
+    def __init__(
+        self,
+        bucket: str,
+        key_prefix: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        max_connections: int = 10,
+        max_concurrent_uploads: int = 4,
+        codec: Optional[Codec] = None,
+        content_addressed: bool = False,
+        read_through_window: Optional[float] = None,
+    ):
+        if not bucket:
+            raise ValueError("bucket required")
         self.bucket = bucket
-        self.key_prefix = key_prefix
+        self.key_prefix = key_prefix or ""
+        self.codec = codec or IdentityCodec()
+        self.content_addressed = content_addressed
+        self.read_through_window = read_through_window
+        # boto3のclientはスレッドセーフだが、Sessionはそうではないので専用のものを作る
+        self.client = boto3.session.Session().client(
+            "s3", endpoint_url=endpoint_url, config=Config(max_pool_connections=max_connections)
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="blkct-s3-content-store")
+        self.upload_semaphore = asyncio.Semaphore(max_concurrent_uploads)
 
     # override
     async def pull_content(self, session: BlackcatSession, url: URL) -> Optional[StoredContent]:
-        # TODO:blockしている
-        obj = self.get_obj(session, url)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.read_content, session.session_id, url)
 
-        try:
-            with io.BytesIO() as fp:
-                obj.download_fileobj(fp)
+    async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
+        key = self.make_key(session, url)
+        logger.info("Save content", url=url, to=f"s3://{self.bucket}/{key}")
+
+        loop = asyncio.get_event_loop()
+        async with self.upload_semaphore:
+            with content.open_body() as body:
+                if self.content_addressed:
+                    await loop.run_in_executor(
+                        self.executor,
+                        self.put_content_addressed,
+                        key,
+                        self.make_latest_key(url),
+                        content.content_type,
+                        body,
+                        content.metadata,
+                    )
+                else:
+                    await loop.run_in_executor(
+                        self.executor, self.put_object, key, content.content_type, body, content.metadata
+                    )
+
+    async def close(self) -> None:
+        self.executor.shutdown(wait=True)
 
-                return StoredContent(obj.content_type, fp.getvalue())
+    # private
+    def make_key(self, session: BlackcatSession, url: URL) -> str:
+        return self.make_session_key(session.session_id, url)
+
+    def make_session_key(self, session_id: str, url: URL) -> str:
+        return self.key_prefix + url_to_path(session_id, url)
+
+    def make_latest_key(self, url: URL) -> str:
+        return self.key_prefix + url_to_path(LATEST_PREFIX, url)
+
+    def make_object_key(self, digest: str, codec_name: str) -> str:
+        return f"{self.key_prefix}{OBJECTS_PREFIX}{digest}{get_codec(codec_name).extension}"
+
+    def read_content(self, session_id: str, url: URL) -> Optional[StoredContent]:
+        content = self.get_object(self.make_session_key(session_id, url))
+        if content is None and self.read_through_window is not None:
+            content = self.read_through(session_id, url)
+        return content
+
+    def read_through(self, session_id: str, url: URL) -> Optional[StoredContent]:
+        """他のsessionでread_through_window秒以内に保存したものがあれば、今のsessionにpointerを置いて返す"""
+        assert self.read_through_window is not None
+        resp = self.fetch_object(self.make_latest_key(url))
+        if resp is None or DIGEST_KEY not in resp.get("Metadata", {}):
+            return None
+
+        pointer = json.loads(resp["Body"].read())
+        fetched_at = (pointer.get("metadata") or {}).get("fetched_at")
+        if fetched_at is None or time.time() - fetched_at > self.read_through_window:
+            return None
+
+        logger.debug("Read through", url=url, digest=pointer["digest"])
+        content = self.resolve_pointer(pointer)
+        if content is not None:
+            self.put_pointer(self.make_session_key(session_id, url), pointer)
+        return content
+
+    def fetch_object(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return cast(Dict[str, Any], self.client.get_object(Bucket=self.bucket, Key=key))
         except ClientError as exc:
-            if exc.response["Error"]["Code"] == "404":
+            if exc.response["Error"]["Code"] in ("404", "NoSuchKey"):
                 # no content
                 return None
             raise
 
-    async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
-        # TODO:blockしている
-        obj = self.get_obj(session, url)
-
-        with io.BytesIO(content.body) as fp:
-            obj.upload_fileobj(fp, {"ContentType": content.content_type})
-
-    # private
-    def make_key(self, session: BlackcatSession, url: URL) -> str:
-        return self.key_prefix + url_to_path(session.session_id, url)
-
-    def get_obj(self, session: BlackcatSession, url: URL) -> Any:
-        return boto3.resource("s3").Object(self.bucket, self.make_key(session, url))
+    def get_object(self, key: str) -> Optional[StoredContent]:
+        resp = self.fetch_object(key)
+        if resp is None:
+            return None
+
+        user_metadata = resp.get("Metadata", {})
+        if DIGEST_KEY in user_metadata:
+            return self.resolve_pointer(json.loads(resp["Body"].read()))
+
+        metadata = user_metadata.get(METADATA_KEY)
+        codec = get_codec(user_metadata.get(CODEC_KEY))
+        return StoredContent(
+            resp.get("ContentType"),
+            codec.decompress(resp["Body"].read()),
+            metadata=json.loads(metadata) if metadata else None,
+        )
+
+    def put_object(self, key: str, content_type: str, body: IO[bytes], metadata: Mapping[str, Any]) -> None:
+        codec = select_codec(self.codec, content_type)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as fp:
+            if isinstance(codec, IdentityCodec):
+                data: IO[bytes] = body
+            else:
+                codec.compress_stream(body, fp)
+                fp.seek(0)
+                data = fp
+
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=data,
+                ContentType=content_type,
+                # user metadataはASCIIのみ
+                Metadata={METADATA_KEY: json.dumps(metadata, ensure_ascii=True), CODEC_KEY: codec.name},
+            )
+
+    def put_content_addressed(
+        self, key: str, latest_key: str, content_type: str, body: IO[bytes], metadata: Mapping[str, Any]
+    ) -> None:
+        codec = select_codec(self.codec, content_type)
+        digest, size = digest_body(body)
+        object_key = self.make_object_key(digest, codec.name)
+        if self.object_exists(object_key):
+            logger.debug("Reuse content", key=key, object_key=object_key)
+        else:
+            self.put_object(object_key, content_type, body, {})
+
+        pointer = {
+            "digest": digest,
+            "content_type": content_type,
+            "codec": codec.name,
+            "size": size,
+            "metadata": dict(metadata),
+        }
+        self.put_pointer(key, pointer)
+        self.put_pointer(latest_key, pointer)
+
+    def put_pointer(self, key: str, pointer: Mapping[str, Any]) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(pointer).encode("utf-8"),
+            ContentType="application/json",
+            Metadata={DIGEST_KEY: pointer["digest"]},
+        )
+
+    def resolve_pointer(self, pointer: Mapping[str, Any]) -> Optional[StoredContent]:
+        resp = self.fetch_object(self.make_object_key(pointer["digest"], pointer["codec"]))
+        if resp is None:
+            return None
+        return StoredContent(
+            pointer["content_type"],
+            get_codec(pointer["codec"]).decompress(resp["Body"].read()),
+            metadata=pointer.get("metadata"),
+        )
+
+    def object_exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
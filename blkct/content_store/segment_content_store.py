@@ -0,0 +1,405 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import io
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, IO, List, Mapping, NamedTuple, Optional, TYPE_CHECKING, Tuple
+
+from yarl import URL
+
+from .codec import Codec, IdentityCodec, get_codec, select_codec
+from .content import DEFAULT_MIME_TYPE, FetchedContent, StoredContent, url_to_path
+from .file_content_store import EAGER_READ_SIZE, INDEX_FILENAME, JsonLinesIndex
+from .warc import (
+    CODEC_FIELD,
+    METADATA_FIELD,
+    SIZE_FIELD,
+    filter_metadata_headers,
+    make_http_response_head,
+    make_warc_fields,
+    parse_warc_date,
+    read_warc_records,
+    scan_warc_records,
+    unpack_http_response,
+    write_warc_record,
+)
+from ..logging import logger
+from ..typing import ContentStore
+
+if TYPE_CHECKING:
+    from ..session import BlackcatSession
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".warc"
+# segmentがこのサイズを超えたら閉じて、次のsegmentに書く
+DEFAULT_SEGMENT_SIZE = 256 * 1024 * 1024
+# 圧縮したbodyをメモリに置く上限. 超えたら一時ファイルに置く
+SPOOL_SIZE = 1024 * 1024
+
+
+class SegmentIndexEntry(NamedTuple):
+    url: Optional[str]
+    segment: str  # segmentのファイル名
+    offset: int  # segment内のbodyの位置
+    length: int  # 保存した(圧縮後の)bodyのバイト数
+    content_type: str
+    size: int  # 圧縮前のサイズ
+    metadata: Optional[Dict[str, Any]] = None  # レスポンスのstatus, headers, fetched_at
+    codec: Optional[str] = None  # Noneはidentity
+
+
+class SegmentIndex(JsonLinesIndex[SegmentIndexEntry]):
+    """SegmentContentStoreの、URLからsegment内の位置へのindex"""
+
+    entry_type = SegmentIndexEntry
+
+    def rebuild(self) -> None:
+        """indexの無いsession dirから、segmentのrecordを走査してindexを作る"""
+        logger.info("Rebuild segment index", path=self.session_dir_path)
+
+        found = []
+        for name in sorted(list_segments(self.session_dir_path)):
+            with open(os.path.join(self.session_dir_path, name), "rb") as fp:
+                for fields, offset, length in scan_warc_records(fp):
+                    url = fields.get("WARC-Target-URI")
+                    if fields.get("WARC-Type") != "resource" or not url:
+                        continue
+                    metadata = fields.get(METADATA_FIELD)
+                    found.append(
+                        (
+                            url_to_path("", URL(url)),
+                            SegmentIndexEntry(
+                                url,
+                                name,
+                                offset,
+                                length,
+                                fields.get("Content-Type", DEFAULT_MIME_TYPE),
+                                int(fields.get(SIZE_FIELD, length)),
+                                json.loads(metadata) if metadata else None,
+                                fields.get(CODEC_FIELD),
+                            ),
+                        )
+                    )
+        self.append(found)
+
+
+class SegmentWriter:
+    """
+    session毎の書き込み中のsegment
+
+    segmentは書いたプロセスだけが追記するので、ファイル名にはランダムな部分を入れる.
+    segment_sizeを超えたら閉じ(seal)、以降は変更しない
+    """
+
+    fp: Optional[IO[bytes]]
+    lock: threading.Lock
+    name: Optional[str]
+    segment_size: int
+    session_dir_path: str
+
+    def __init__(self, session_dir_path: str, segment_size: int):
+        self.session_dir_path = session_dir_path
+        self.segment_size = segment_size
+        self.fp = None
+        self.name = None
+        self.lock = threading.Lock()
+
+    def write(self, fields: List[Tuple[str, str]], block: IO[bytes]) -> Tuple[str, int, Optional[str]]:
+        """
+        recordを1つ追記する
+
+        書いたsegmentの名前と、bodyのoffset, このrecordでsealしたならそのsegmentの名前を返す
+        """
+        with self.lock:
+            if self.fp is None:
+                self.open()
+            assert self.fp and self.name
+            name = self.name
+            offset = write_warc_record(self.fp, fields, block)
+            # mmapで読めるように、indexに入れる前にOSに渡す
+            self.fp.flush()
+
+            sealed = None
+            if self.fp.tell() >= self.segment_size:
+                sealed = self.seal()
+            return name, offset, sealed
+
+    def seal(self) -> Optional[str]:
+        """書き込み中のsegmentを閉じて、その名前を返す"""
+        if self.fp is None:
+            return None
+        self.fp.close()
+        name, self.fp, self.name = self.name, None, None
+        return name
+
+    def open(self) -> None:
+        os.makedirs(self.session_dir_path, exist_ok=True)
+        self.name = f"{SEGMENT_PREFIX}{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}"
+        self.fp = open(os.path.join(self.session_dir_path, self.name), "xb")
+
+
+class SegmentContentStore(ContentStore):
+    """
+    大きなsegmentファイルにrecordを追記していくストア
+
+    URL毎にファイルを作らないので、大きなsessionでもファイル数が増えない.
+    segmentはWARC形式で、bodyはcodecで圧縮して保存する(圧縮済みのcontent typeはそのまま).
+    読むときはindexのoffsetからmmapで読む.
+    s3_bucketを指定すると、sealしたsegmentとindexをS3に1つのobjectとしてuploadする
+    """
+
+    codec: Codec
+    executor: ThreadPoolExecutor
+    indexes: Dict[str, SegmentIndex]
+    lock: threading.Lock
+    maps: Dict[str, mmap.mmap]
+    maps_lock: threading.Lock
+    s3_bucket: Optional[str]
+    s3_client: Any
+    s3_prefix: str
+    segment_size: int
+    store_root_path: str
+    uploads: List[Future[None]]
+    writers: Dict[str, SegmentWriter]
+
+    def __init__(
+        self,
+        store_root_path: str,
+        segment_size: int = DEFAULT_SEGMENT_SIZE,
+        io_workers: int = 4,
+        codec: Optional[Codec] = None,
+        s3_bucket: Optional[str] = None,
+        s3_prefix: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+    ):
+        self.store_root_path = store_root_path
+        self.segment_size = segment_size
+        self.codec = codec or IdentityCodec()
+        self.executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="blkct-segment-content-store")
+        self.indexes = {}
+        self.writers = {}
+        self.lock = threading.Lock()
+        self.maps = {}
+        self.maps_lock = threading.Lock()
+        self.uploads = []
+
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix or ""
+        self.s3_client = None
+        if s3_bucket:
+            import boto3
+
+            self.s3_client = boto3.session.Session().client("s3", endpoint_url=endpoint_url)
+
+    # override
+    async def pull_content(self, session: BlackcatSession, url: URL) -> Optional[StoredContent]:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.read_content, session.session_id, url)
+
+    async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
+        loop = asyncio.get_event_loop()
+        with content.open_body() as body:
+            await loop.run_in_executor(
+                self.executor,
+                self.write_content,
+                session.session_id,
+                url,
+                content.content_type,
+                body,
+                content.metadata,
+            )
+
+    async def close(self) -> None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.seal_all)
+        self.executor.shutdown(wait=True)
+
+        with self.maps_lock:
+            for mm in self.maps.values():
+                mm.close()
+            self.maps.clear()
+
+        for future in self.uploads:
+            future.result()
+
+    # public (同期. スクリプトから使う)
+    def export_warc(self, session_id: str, fp: IO[bytes]) -> int:
+        """
+        sessionのcontentを、展開して普通のWARC(record毎にgzip)に書き出す. 書いたrecord数を返す
+
+        metadataにstatusがあればresponse、無ければresource recordにする
+        """
+        index = self.get_index(session_id)
+        index.refresh()
+        count = 0
+        for entry in list(index.entries.values()):
+            if entry.url is None:
+                continue
+            body = get_codec(entry.codec).decompress(self.read_range(index, entry))
+            metadata = entry.metadata or {}
+            timestamp = metadata.get("fetched_at") or time.time()
+            if "status" in metadata:
+                block = make_http_response_head(metadata, entry.content_type, len(body)) + body
+                fields = make_warc_fields(
+                    "response", entry.url, "application/http;msgtype=response", len(block), timestamp
+                )
+            else:
+                block = body
+                fields = make_warc_fields("resource", entry.url, entry.content_type, len(block), timestamp)
+
+            with gzip.GzipFile(fileobj=fp, mode="wb", mtime=0) as member:
+                write_warc_record(member, fields, io.BytesIO(block))  # type: ignore
+            count += 1
+        return count
+
+    def import_warc(self, session_id: str, fp: IO[bytes]) -> int:
+        """WARC(.warc.gzも可)のstatus 200のresponseとresource recordを取り込む. 取り込んだ数を返す"""
+        count = 0
+        for fields, block in read_warc_records(fp):
+            record_type, url = fields.get("WARC-Type"), fields.get("WARC-Target-URI")
+            if not url:
+                continue
+
+            fetched_at = parse_warc_date(fields.get("WARC-Date", ""))
+            if record_type == "response":
+                status, headers, body = unpack_http_response(block)
+                if status != 200:
+                    continue
+                content_type = headers.get("Content-Type", DEFAULT_MIME_TYPE)
+                metadata: Dict[str, Any] = {"status": status, "headers": filter_metadata_headers(headers)}
+            elif record_type == "resource":
+                body, content_type, metadata = block, fields.get("Content-Type", DEFAULT_MIME_TYPE), {}
+            else:
+                continue
+            if fetched_at is not None:
+                metadata["fetched_at"] = fetched_at
+
+            self.write_content(session_id, URL(url), content_type, io.BytesIO(body), metadata)
+            count += 1
+        return count
+
+    # private (executorのスレッドで呼ばれる)
+    def read_content(self, session_id: str, url: URL) -> Optional[StoredContent]:
+        index = self.get_index(session_id)
+        entry = index.get(url_to_path("", url))
+        if not entry:
+            return None
+
+        codec = get_codec(entry.codec)
+        if entry.size > EAGER_READ_SIZE:
+            return StoredContent(
+                entry.content_type,
+                lambda: io.BytesIO(codec.decompress(self.read_range(index, entry))),
+                entry.size,
+                entry.metadata,
+            )
+        return StoredContent(
+            entry.content_type, codec.decompress(self.read_range(index, entry)), metadata=entry.metadata
+        )
+
+    def read_range(self, index: SegmentIndex, entry: SegmentIndexEntry) -> bytes:
+        path = os.path.join(index.session_dir_path, entry.segment)
+        end = entry.offset + entry.length
+        # sliceはGILを持ったままコピーするので、lockの中で読んでも遅くならない
+        with self.maps_lock:
+            mm = self.maps.get(path)
+            if mm is None or len(mm) < end:
+                # 書き込み中のsegmentは伸びているので、mapし直す
+                if mm is not None:
+                    mm.close()
+                with open(path, "rb") as fp:
+                    mm = self.maps[path] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            return mm[entry.offset:end]
+
+    def write_content(
+        self, session_id: str, url: URL, content_type: str, body: IO[bytes], metadata: Mapping[str, Any]
+    ) -> None:
+        codec = select_codec(self.codec, content_type)
+        index = self.get_index(session_id)
+
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as spool:
+            if isinstance(codec, IdentityCodec):
+                block: IO[bytes] = body
+                size = length = body.seek(0, io.SEEK_END)
+                body.seek(0)
+            else:
+                size = codec.compress_stream(body, spool)
+                length = spool.tell()
+                spool.seek(0)
+                block = spool
+
+            codec_name = None if isinstance(codec, IdentityCodec) else codec.name
+            fields = make_warc_fields(
+                "resource", str(url), content_type, length, metadata.get("fetched_at") or time.time()
+            )
+            if codec_name:
+                fields.append((CODEC_FIELD, codec_name))
+            fields.append((SIZE_FIELD, str(size)))
+            fields.append((METADATA_FIELD, json.dumps(metadata, ensure_ascii=True)))
+
+            segment, offset, sealed = self.get_writer(session_id).write(fields, block)
+
+        logger.info("Save content", url=url, to=os.path.join(index.session_dir_path, segment), offset=offset)
+        index.add(
+            url_to_path("", url),
+            SegmentIndexEntry(str(url), segment, offset, length, content_type, size, dict(metadata), codec_name),
+        )
+        if sealed:
+            self.on_sealed(session_id, sealed)
+
+    def get_index(self, session_id: str) -> SegmentIndex:
+        with self.lock:
+            index = self.indexes.get(session_id)
+            if index is None:
+                index = self.indexes[session_id] = SegmentIndex(os.path.join(self.store_root_path, session_id))
+            return index
+
+    def get_writer(self, session_id: str) -> SegmentWriter:
+        with self.lock:
+            writer = self.writers.get(session_id)
+            if writer is None:
+                writer = self.writers[session_id] = SegmentWriter(
+                    os.path.join(self.store_root_path, session_id), self.segment_size
+                )
+            return writer
+
+    def seal_all(self) -> None:
+        """書き込み中のsegmentを全て閉じる. 閉じたsessionのindexもuploadする"""
+        with self.lock:
+            writers = list(self.writers.items())
+            self.writers.clear()
+
+        for session_id, writer in writers:
+            with writer.lock:
+                sealed = writer.seal()
+            if sealed:
+                self.on_sealed(session_id, sealed)
+            if self.s3_client:
+                self.uploads.append(self.executor.submit(self.upload, session_id, INDEX_FILENAME))
+
+    def on_sealed(self, session_id: str, name: str) -> None:
+        logger.info("Seal segment", session_id=session_id, segment=name)
+        if self.s3_client:
+            self.uploads.append(self.executor.submit(self.upload, session_id, name))
+
+    def upload(self, session_id: str, name: str) -> None:
+        key = f"{self.s3_prefix}{session_id}/{name}"
+        logger.info("Upload segment", to=f"s3://{self.s3_bucket}/{key}")
+        # 大きいファイルはmultipart uploadになる
+        self.s3_client.upload_file(os.path.join(self.store_root_path, session_id, name), self.s3_bucket, key)
+
+
+def list_segments(session_dir_path: str) -> List[str]:
+    try:
+        names = os.listdir(session_dir_path)
+    except FileNotFoundError:
+        return []
+    return [name for name in names if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
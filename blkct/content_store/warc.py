@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import gzip
+import http.client
+import shutil
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import IO, Iterator, List, Mapping, Optional, Sequence, TYPE_CHECKING, Tuple, cast
+
+from multidict import CIMultiDict
+
+from .codec import COPY_CHUNK_SIZE
+from .content import METADATA_HEADERS
+
+if TYPE_CHECKING:
+    from typing import Any
+
+__all__ = (
+    "WARC_VERSION",
+    "format_warc_date",
+    "make_warc_fields",
+    "make_http_response_head",
+    "parse_warc_date",
+    "read_warc_records",
+    "scan_warc_records",
+    "unpack_http_response",
+    "write_warc_record",
+)
+
+WARC_VERSION = "WARC/1.1"
+# recordの後ろに付ける区切り
+RECORD_TRAILER = b"\r\n\r\n"
+
+# blkct独自のfield. WARCを扱う他のツールは無視する
+CODEC_FIELD = "WARC-Blkct-Codec"  # blockの圧縮方式. identityなら無い
+SIZE_FIELD = "WARC-Blkct-Size"  # 圧縮前のサイズ
+METADATA_FIELD = "WARC-Blkct-Metadata"  # Content.metadataのJSON
+
+
+def format_warc_date(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def parse_warc_date(value: str) -> Optional[float]:
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            pass
+    return None
+
+
+def make_warc_fields(
+    record_type: str, url: str, content_type: str, length: int, timestamp: float
+) -> List[Tuple[str, str]]:
+    """recordに必ず付けるfieldを作る"""
+    return [
+        ("WARC-Type", record_type),
+        ("WARC-Record-ID", f"<urn:uuid:{uuid.uuid4()}>"),
+        ("WARC-Date", format_warc_date(timestamp)),
+        ("WARC-Target-URI", url),
+        ("Content-Type", content_type),
+        ("Content-Length", str(length)),
+    ]
+
+
+def write_warc_record(fp: IO[bytes], fields: Sequence[Tuple[str, str]], block: IO[bytes]) -> int:
+    """
+    recordを1つ書く. bodyの先頭のoffsetを返す
+
+    blockはContent-Lengthのバイト数だけ読めること
+    """
+    head = [WARC_VERSION] + [f"{name}: {value}" for name, value in fields]
+    fp.write(("\r\n".join(head) + "\r\n\r\n").encode("utf-8"))
+    offset = fp.tell()
+    shutil.copyfileobj(block, fp, COPY_CHUNK_SIZE)
+    fp.write(RECORD_TRAILER)
+    return offset
+
+
+def read_warc_header(fp: IO[bytes]) -> Optional[CIMultiDict[str]]:
+    """recordのheaderを読む. ファイルの終わりならNone"""
+    line = fp.readline()
+    while line in (b"\r\n", b"\n"):  # 前のrecordの区切りが余っている場合
+        line = fp.readline()
+    if not line:
+        return None
+    if not line.startswith(b"WARC/"):
+        raise ValueError(f"invalid WARC record: {line[:32]!r}")
+
+    fields: CIMultiDict[str] = CIMultiDict()
+    for line in iter(fp.readline, b""):
+        line = line.rstrip(b"\r\n")
+        if not line:
+            break
+        name, _, value = line.decode("utf-8").partition(":")
+        fields.add(name.strip(), value.strip())
+    return fields
+
+
+def read_warc_records(fp: IO[bytes]) -> Iterator[Tuple[CIMultiDict[str], bytes]]:
+    """
+    seekできるWARCファイルを先頭から読んで、recordのheaderとblockを返す
+
+    record毎にgzipしたもの(.warc.gz)も読める
+    """
+    magic = fp.read(2)
+    fp.seek(0)
+    if magic == b"\x1f\x8b":
+        fp = cast(IO[bytes], gzip.GzipFile(fileobj=fp, mode="rb"))
+    while True:
+        fields = read_warc_header(fp)
+        if fields is None:
+            return
+        yield fields, fp.read(int(fields["Content-Length"]))
+
+
+def scan_warc_records(fp: IO[bytes]) -> Iterator[Tuple[CIMultiDict[str], int, int]]:
+    """
+    seekできる非圧縮のWARCファイルから、recordのheaderとblockのoffset, 長さを返す
+
+    書きかけで途切れたrecordは返さない
+    """
+    end = fp.seek(0, 2)
+    fp.seek(0)
+    while True:
+        try:
+            fields = read_warc_header(fp)
+        except ValueError:
+            return
+        if fields is None or "Content-Length" not in fields:
+            return
+        offset, length = fp.tell(), int(fields["Content-Length"])
+        if offset + length > end:
+            return
+        yield fields, offset, length
+        fp.seek(offset + length)
+
+
+def make_http_response_head(metadata: Mapping[str, Any], content_type: str, length: int) -> bytes:
+    """保存したmetadataから、responseレコード用のHTTPレスポンスのheader部分を作り直す"""
+    status = metadata["status"]
+    lines = [f"HTTP/1.1 {status} {http.client.responses.get(status, '')}".rstrip()]
+    headers = dict(metadata.get("headers") or {})
+    headers.setdefault("Content-Type", content_type)
+    headers["Content-Length"] = str(length)
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def unpack_http_response(block: bytes) -> Tuple[int, CIMultiDict[str], bytes]:
+    """
+    responseレコードのblockを、status, headers, bodyに分ける
+
+    bodyのTransfer-Encoding: chunkedとContent-Encoding: gzip/deflateは戻す
+    """
+    head, _, body = block.partition(b"\r\n\r\n")
+    status_line, *header_lines = head.decode("latin-1").split("\r\n")
+    status = int(status_line.split(None, 2)[1])
+
+    headers: CIMultiDict[str] = CIMultiDict()
+    for line in header_lines:
+        name, _, value = line.partition(":")
+        headers.add(name.strip(), value.strip())
+
+    if headers.get("Transfer-Encoding", "").lower() == "chunked":
+        body = dechunk(body)
+    encoding = headers.get("Content-Encoding", "").lower()
+    if encoding in ("gzip", "x-gzip"):
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        body = zlib.decompress(body)
+
+    return status, headers, body
+
+
+def dechunk(data: bytes) -> bytes:
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        end = data.index(b"\r\n", pos)
+        size = int(data[pos:end].split(b";", 1)[0], 16)
+        if size == 0:
+            break
+        chunks.append(data[end + 2:end + 2 + size])
+        pos = end + 2 + size + 2
+    return b"".join(chunks)
+
+
+def filter_metadata_headers(headers: Mapping[str, str]) -> Mapping[str, str]:
+    """Content.metadataに入れるheaderだけ取り出す"""
+    return {name: headers[name] for name in METADATA_HEADERS if name in headers}
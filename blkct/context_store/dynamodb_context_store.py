@@ -1,38 +1,159 @@
 from __future__ import annotations
 
-from typing import Any, Mapping, TYPE_CHECKING, cast
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Mapping, Optional, TYPE_CHECKING, cast
 
 import boto3
 
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
 from ..exceptions import ContextNotFoundError
+from ..logging import logger
 from ..typing import ContextStore
 
 if TYPE_CHECKING:
     from ..session import BlackcatSession
 
+# BatchWriteItemで一度に書けるItem数
+BATCH_WRITE_LIMIT = 25
+# UnprocessedItemsを書き直す回数
+BATCH_WRITE_RETRIES = 8
+
+
+class PendingBatch:
+    """まとめて書き込むsaveの集まり. 同じkeyは後勝ち"""
+
+    items: Dict[str, Mapping[str, Any]]
+    done: asyncio.Future[None]
+
+    def __init__(self) -> None:
+        self.items = {}
+        self.done = asyncio.get_event_loop().create_future()
+
 
 class DynamoDBContextStore(ContextStore):
-    table: Any
+    """
+    DynamoDBにContextを保存する
+
+    APIはevent loopを止めないようにスレッドで呼ぶ.
+    saveは書き込み中に来たものやbatch_window秒以内に来たものをまとめ、同じkeyは最後の1つだけをBatchWriteItemで書く.
+    saveは自分の分が書き込まれるまで待つ
+    """
+
+    batch_window: float
+    client: Any
+    deserializer: TypeDeserializer
+    executor: ThreadPoolExecutor
+    flusher: Optional[asyncio.Future[None]]
+    pending: Optional[PendingBatch]
+    serializer: TypeSerializer
+    table_name: str
+    writing: Optional[PendingBatch]
 
-    def __init__(self, table: str):
-        self.table = boto3.resource("dynamodb").Table(table)
+    def __init__(self, table: str, endpoint_url: Optional[str] = None, batch_window: float = 0.0):
+        if not table:
+            raise ValueError("table required")
+        self.table_name = table
+        self.batch_window = batch_window
+        self.client = boto3.session.Session().client("dynamodb", endpoint_url=endpoint_url)
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="blkct-dynamodb-context-store")
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+        self.flusher = None
+        self.pending = None
+        self.writing = None
 
     async def close(self) -> None:
-        pass
+        if self.flusher:
+            await self.flusher
+        self.executor.shutdown(wait=True)
 
     async def load(self, session: BlackcatSession, key: str) -> Mapping[str, Any]:
-        # TODO:blockしている
-        rv = self.table.get_item(Key={"key": key})
+        # まだ書き込んでいないものがあればそれを返す
+        for batch in (self.pending, self.writing):
+            if batch and key in batch.items:
+                return dict(batch.items[key])
+
+        loop = asyncio.get_event_loop()
+        rv = await loop.run_in_executor(
+            self.executor, lambda: self.client.get_item(TableName=self.table_name, Key={"key": {"S": key}})
+        )
         assert rv["ResponseMetadata"]["HTTPStatusCode"] == 200
         if "Item" not in rv:
             raise ContextNotFoundError()
 
-        assert rv["Item"]["key"] == key
+        assert rv["Item"]["key"]["S"] == key
 
-        return cast(Mapping[str, Any], rv["Item"]["payload"])
+        return cast(Mapping[str, Any], self.deserializer.deserialize(rv["Item"]["payload"]))
 
     async def save(self, session: BlackcatSession, key: str, data: Mapping[str, Any]) -> None:
-        # TODO:blockしている
-        rv = self.table.put_item(Item={"key": key, "payload": dict(data)})
-        if rv["ResponseMetadata"]["HTTPStatusCode"] != 200:
-            raise Exception("DynamoDB put failed %r", rv)
+        if self.pending is None:
+            self.pending = PendingBatch()
+        batch = self.pending
+        batch.items[key] = dict(data)
+
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.run_flusher())
+            self.flusher.add_done_callback(self.on_flusher_done)
+
+        await asyncio.shield(batch.done)
+
+    # private
+    async def run_flusher(self) -> None:
+        """pendingが無くなるまで、1batchずつ書き込む"""
+        loop = asyncio.get_event_loop()
+        try:
+            while self.pending is not None:
+                if self.batch_window:
+                    await asyncio.sleep(self.batch_window)
+
+                self.writing, self.pending = self.pending, None
+                try:
+                    await loop.run_in_executor(self.executor, self.write_items, self.writing.items)
+                except Exception as exc:
+                    self.writing.done.set_exception(exc)
+                    self.writing.done.exception()  # 待っている側が居なくても警告を出さない
+                else:
+                    self.writing.done.set_result(None)
+                self.writing = None
+        finally:
+            self.abort_batches()
+
+    def on_flusher_done(self, task: asyncio.Future[None]) -> None:
+        # 始まる前にcancelされると、run_flusherのfinallyは動かない
+        if self.flusher is task:
+            self.abort_batches()
+
+    def abort_batches(self) -> None:
+        """書けていないものを待っているsaveを止める. cancelなどでflusherが途中で終わった時のため"""
+        for batch in (self.writing, self.pending):
+            if batch and not batch.done.done():
+                batch.done.cancel()
+        self.flusher = self.writing = self.pending = None
+
+    def write_items(self, items: Mapping[str, Mapping[str, Any]]) -> None:
+        requests = [
+            {"PutRequest": {"Item": {"key": {"S": key}, "payload": self.serializer.serialize(data)}}}
+            for key, data in items.items()
+        ]
+        for i in range(0, len(requests), BATCH_WRITE_LIMIT):
+            self.batch_write(requests[i:i + BATCH_WRITE_LIMIT])
+
+    def batch_write(self, requests: List[Dict[str, Any]]) -> None:
+        for retry in range(BATCH_WRITE_RETRIES):
+            if retry:
+                # 書けなかった分はexponential backoffしてから書き直す
+                time.sleep(0.05 * 2 ** retry)
+
+            rv = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            if rv["ResponseMetadata"]["HTTPStatusCode"] != 200:
+                raise Exception("DynamoDB batch write failed %r", rv)
+
+            requests = rv.get("UnprocessedItems", {}).get(self.table_name, [])
+            if not requests:
+                return
+            logger.debug("DynamoDB unprocessed items", count=len(requests))
+
+        raise Exception("DynamoDB batch write failed, %d items unprocessed", len(requests))
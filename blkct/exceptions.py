@@ -13,9 +13,21 @@ class BadStatusCode(CrawlerError):
     pass
 
 
+class ContentTooLarge(CrawlerError):
+    pass
+
+
 class ParserError(CrawlerError):
     pass
 
 
 class ContextNotFoundError(CrawlerError):
     pass
+
+
+class JobSubmissionError(CrawlerError):
+    pass
+
+
+class HostUnavailable(CrawlerError):
+    pass
@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+from aiohttp import web
+
+from .logging import logger
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+
+    LabelsT = Tuple[Tuple[str, str], ...]
+
+__all__ = ("Histogram", "MetricsExporter", "MetricsRegistry")
+
+# sessionやstoreが更新するメトリクス
+HTTP_REQUESTS = "blkct_http_requests_total"
+HTTP_REQUEST_SECONDS = "blkct_http_request_seconds"
+HTTP_RESPONSE_BYTES = "blkct_http_response_bytes_total"
+CONTENT_STORE_LOOKUPS = "blkct_content_store_lookups_total"
+CONTENT_STORE_SECONDS = "blkct_content_store_seconds"
+PARSE_SECONDS = "blkct_parse_seconds"
+PLANNER_SECONDS = "blkct_planner_seconds"
+PLANNER_QUEUE_DEPTH = "blkct_planner_queue_depth"
+CONTEXT_STORE_SECONDS = "blkct_context_store_seconds"
+
+METRIC_HELP = {
+    HTTP_REQUESTS: "HTTP requests by host and status",
+    HTTP_REQUEST_SECONDS: "seconds until the response headers arrive",
+    HTTP_RESPONSE_BYTES: "bytes of fetched response bodies",
+    CONTENT_STORE_LOOKUPS: "content store pull_content results (hit or miss)",
+    CONTENT_STORE_SECONDS: "seconds spent in the content store",
+    PARSE_SECONDS: "seconds spent in content parsers",
+    PLANNER_SECONDS: "seconds spent in planners",
+    PLANNER_QUEUE_DEPTH: "dispatched plans not yet started",
+    CONTEXT_STORE_SECONDS: "seconds spent in the context store",
+}
+
+# 秒のhistogramのデフォルトのbucket
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Histogram:
+    """bucket毎の数と合計. countsの最後は最大のbucketを超えたもの"""
+
+    buckets: Tuple[float, ...]
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        qの分位点のおおよその値
+
+        PrometheusのHistogram_quantileと同じく、bucketの中は一様に分布しているとして補間する.
+        最大のbucketを超えたらinf
+        """
+        rank = q * self.count
+        total = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            if count and total + count >= rank:
+                if bound == float("inf"):
+                    return bound
+                return lower + (bound - lower) * (rank - total) / count
+            total += count
+            lower = bound
+        return 0.0
+
+
+class MetricsRegistry:
+    """
+    counter, gauge, histogramを(名前, ラベル)毎に持つ
+
+    Prometheusのtext形式とJSONで書き出せる. JSONは別のプロセスのものをmergeできる
+    """
+
+    counters: Dict[Tuple[str, LabelsT], float]
+    gauges: Dict[Tuple[str, LabelsT], float]
+    histograms: Dict[Tuple[str, LabelsT], Histogram]
+
+    def __init__(self) -> None:
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    # public
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, make_labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def add_gauge(self, name: str, value: float, **labels: str) -> None:
+        key = (name, make_labels(labels))
+        self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: str) -> None:
+        self.gauges[(name, make_labels(labels))] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, make_labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """ブロックにかかった秒数をhistogramに記録する. 例外で抜けても記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_prometheus(self) -> str:
+        lines: List[str] = []
+        for name, metric_type, samples in self.iter_families():
+            if name in METRIC_HELP:
+                lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    total = 0
+                    for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                        total += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {total}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value.sum!r}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value!r}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            "gauges": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self.gauges.items())
+            ],
+            "histograms": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "buckets": list(histogram.buckets),
+                    "counts": histogram.counts,
+                    "sum": histogram.sum,
+                    "count": histogram.count,
+                }
+                for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0])
+            ],
+        }
+
+    def merge(self, data: Mapping[str, Any]) -> None:
+        """to_jsonしたものを足し込む. gaugeも足す"""
+        for item in data["counters"]:
+            self.inc(item["name"], item["value"], **item["labels"])
+        for item in data["gauges"]:
+            self.add_gauge(item["name"], item["value"], **item["labels"])
+        for item in data["histograms"]:
+            key = (item["name"], make_labels(item["labels"]))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(item["buckets"])
+            if list(histogram.buckets) != item["buckets"]:
+                raise ValueError(f"histogram buckets of `{item['name']}` differ")
+            histogram.counts = [a + b for a, b in zip(histogram.counts, item["counts"])]
+            histogram.sum += item["sum"]
+            histogram.count += item["count"]
+
+    def write_prometheus(self, path: str) -> None:
+        # node_exporterのtextfile collectorが書きかけを読まないように、置き換える
+        write_file_atomically(path, self.to_prometheus())
+
+    def write_json(self, path: str) -> None:
+        write_file_atomically(path, json.dumps(self.to_json(), indent=2))
+
+    # private
+    def iter_families(self) -> Iterator[Tuple[str, str, List[Tuple[LabelsT, Any]]]]:
+        for metric_type, metrics in (
+            ("counter", self.counters),
+            ("gauge", self.gauges),
+            ("histogram", self.histograms),
+        ):
+            families: Dict[str, List[Tuple[LabelsT, Any]]] = {}
+            for (name, labels), value in sorted(metrics.items(), key=lambda item: item[0]):
+                families.setdefault(name, []).append((labels, value))
+            for name, samples in families.items():
+                yield name, metric_type, samples
+
+
+class MetricsExporter:
+    """
+    MetricsRegistryを書き出す
+
+    prometheus_pathがあればinterval秒毎とstop時にPrometheusのtext形式で書き、
+    portがあればhost:portの/metricsで返す. json_pathがあればstop時にJSONで書く
+    """
+
+    runner: Optional[web.AppRunner]
+    task: Optional[asyncio.Future[None]]
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        prometheus_path: Optional[str] = None,
+        json_path: Optional[str] = None,
+        host: str = "127.0.0.1",
+        port: Optional[int] = None,
+        interval: float = 15.0,
+    ):
+        self.registry = registry
+        self.prometheus_path = prometheus_path
+        self.json_path = json_path
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.runner = None
+        self.task = None
+
+    async def start(self) -> None:
+        if self.prometheus_path and self.interval > 0:
+            self.task = asyncio.ensure_future(self.write_periodically())
+        if self.port:
+            app = web.Application()
+            app.router.add_get("/metrics", self.handle_metrics)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            logger.info("Serve metrics", host=self.host, port=self.port)
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+        if self.prometheus_path:
+            self.registry.write_prometheus(self.prometheus_path)
+        if self.json_path:
+            self.registry.write_json(self.json_path)
+
+    # private
+    async def write_periodically(self) -> None:
+        assert self.prometheus_path
+        while True:
+            await asyncio.sleep(self.interval)
+            self.registry.write_prometheus(self.prometheus_path)
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.to_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+def make_labels(labels: Mapping[str, Any]) -> LabelsT:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: LabelsT) -> str:
+    if not labels:
+        return ""
+    escaped = ((k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def write_file_atomically(path: str, text: str) -> None:
+    dirpath = os.path.dirname(os.path.abspath(path))
+    fd, temppath = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dirpath)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fp:
+            fp.write(text)
+        os.chmod(temppath, 0o644)  # mkstempは0600で作るので戻す
+        os.replace(temppath, path)
+    except BaseException:
+        os.unlink(temppath)
+        raise
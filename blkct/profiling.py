@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import re
+import time
+import tracemalloc
+from typing import Generic, TYPE_CHECKING, TypeVar
+
+from .logging import logger
+
+if TYPE_CHECKING:
+    from typing import Any, Awaitable, Dict, Generator, List, Optional
+
+T = TypeVar("T")
+
+__all__ = ("PlannerProfiler",)
+
+SUMMARY_FILENAME = "summary.txt"
+# tracemallocの集計から外すもの
+IGNORED_ALLOCATION_FILES = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<unknown>")
+# 今有効にしているProfile. 有効にできるprofilerは同時に1つだけ(3.12からは2つ目のenableがValueError)
+active_profile: Optional[cProfile.Profile] = None
+
+
+class PlannerProfiler:
+    """
+    planner名毎にcProfileとtracemallocの結果を集める
+
+    plannerのcoroutineが動いている間だけ、そのplanner名のProfileを有効にするので、
+    並行に動くplannerやevent loop自身の時間は混ざらない(executorのスレッドの時間は入らない).
+    時間はCPU時間(process_time)で測る.
+    memoryなら各plannerの前後でtracemallocのsnapshotを取り、増えた分を確保した行毎に足す.
+    こちらは並行に動く他のplannerの分も混ざる
+
+    結果は`directory/<session id>/`に、planner毎のpstatsファイルと、全プロセス分をまとめたsummary.txtで書く
+    """
+
+    allocations: Dict[str, Dict[str, List[int]]]  # planner -> 行 -> [増えたbytes, 増えた数]
+    calls: Dict[str, int]
+    profiles: Dict[str, cProfile.Profile]
+    tracing: bool  # 自分でtracemallocを始めたか
+    wall_times: Dict[str, float]
+
+    def __init__(self, directory: str, memory: bool = False, top: int = 20):
+        self.directory = directory
+        self.memory = memory
+        self.top = top
+        self.tracing = False
+        self.reset()
+
+    def reset(self) -> None:
+        """集めたものを捨てる. forkした先で親の分を書かないようにする"""
+        self.profiles = {}
+        self.calls = {}
+        self.wall_times = {}
+        self.allocations = {}
+
+    async def profile(self, planner: str, awaitable: Awaitable[T]) -> T:
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        before = self.take_snapshot() if self.memory else None
+
+        profile = self.profiles.get(planner)
+        if profile is None:
+            profile = self.profiles[planner] = cProfile.Profile(time.process_time)
+
+        start = time.perf_counter()
+        try:
+            return await ProfiledAwaitable(awaitable, profile)
+        finally:
+            self.calls[planner] = self.calls.get(planner, 0) + 1
+            self.wall_times[planner] = self.wall_times.get(planner, 0.0) + time.perf_counter() - start
+            if before is not None:
+                self.add_allocations(planner, before)
+
+    def stop(self) -> None:
+        """自分で始めたtracemallocを止める. 動いている間は全ての確保が遅くなる"""
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def write_stats(self, session_id: str) -> None:
+        """このプロセスの分を書く. ファイル名にpidを入れるので、複数のプロセスで同じディレクトリに書ける"""
+        directory = self.get_session_directory(session_id)
+        os.makedirs(directory, exist_ok=True)
+        pid = os.getpid()
+        for planner, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, f"{safe_filename(planner)}.{pid}.pstats"))
+
+        with open(os.path.join(directory, f"planners.{pid}.json"), "w") as fp:
+            json.dump(
+                {
+                    planner: {
+                        "calls": self.calls.get(planner, 0),
+                        "wall_time": self.wall_times.get(planner, 0.0),
+                        "allocations": self.allocations.get(planner, {}),
+                    }
+                    for planner in self.profiles
+                },
+                fp,
+            )
+
+    def write_summary(self, session_id: str) -> str:
+        """ディレクトリにある全プロセス分をplanner名毎にまとめて、summary.txtを書く. そのpathを返す"""
+        directory = self.get_session_directory(session_id)
+        planners: Dict[str, Dict[str, Any]] = {}
+        for path in sorted(glob.glob(os.path.join(directory, "planners.*.json"))):
+            with open(path) as fp:
+                for planner, data in json.load(fp).items():
+                    total = planners.setdefault(planner, {"calls": 0, "wall_time": 0.0, "allocations": {}})
+                    total["calls"] += data["calls"]
+                    total["wall_time"] += data["wall_time"]
+                    for site, (size, count) in data["allocations"].items():
+                        site_total = total["allocations"].setdefault(site, [0, 0])
+                        site_total[0] += size
+                        site_total[1] += count
+
+        out = io.StringIO()
+        stats: Dict[str, pstats.Stats] = {}
+        for planner in sorted(planners):
+            # `a`の分に`a.b`のものが混ざらないように、`<planner>.<pid>.pstats`だけを選ぶ
+            pattern = re.compile(re.escape(safe_filename(planner)) + r"\.\d+\.pstats")
+            paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if pattern.fullmatch(name))
+            if paths:
+                stats[planner] = pstats.Stats(*paths, stream=out)
+
+        out.write(f"{'planner':<40} {'calls':>8} {'wall(s)':>12} {'cpu(s)':>12}\n")
+        for planner, data in sorted(planners.items()):
+            cpu = getattr(stats.get(planner), "total_tt", 0.0)
+            out.write(f"{planner:<40} {data['calls']:>8} {data['wall_time']:>12.3f} {cpu:>12.3f}\n")
+
+        for planner, data in sorted(planners.items()):
+            if planner in stats:
+                out.write(f"\n== {planner}: top functions ==\n")
+                stats[planner].sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+            if data["allocations"]:
+                out.write(f"\n== {planner}: top allocation sites ==\n")
+                out.write(f"{'bytes':>14} {'blocks':>10}  site\n")
+                sites = sorted(data["allocations"].items(), key=lambda item: item[1][0], reverse=True)
+                for site, (size, count) in sites[: self.top]:
+                    out.write(f"{size:>14} {count:>10}  {site}\n")
+
+        path = os.path.join(directory, SUMMARY_FILENAME)
+        with open(path, "w") as fp:
+            fp.write(out.getvalue())
+        logger.info("Write profile", path=path)
+        return path
+
+    # private
+    def get_session_directory(self, session_id: str) -> str:
+        return os.path.join(self.directory, safe_filename(session_id))
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, filename) for filename in IGNORED_ALLOCATION_FILES]
+        )
+
+    def add_allocations(self, planner: str, before: tracemalloc.Snapshot) -> None:
+        allocations = self.allocations.setdefault(planner, {})
+        for stat in self.take_snapshot().compare_to(before, "lineno"):
+            if stat.size_diff <= 0:
+                continue
+            frame = stat.traceback[0]
+            site = allocations.setdefault(f"{frame.filename}:{frame.lineno}", [0, 0])
+            site[0] += stat.size_diff
+            site[1] += stat.count_diff
+
+
+class ProfiledAwaitable(Generic[T]):
+    """
+    awaitable(plannerのcoroutine)を1歩ずつ進める間だけprofileを有効にするawaitable
+
+    awaitで止まっている間(他のtaskやevent loopが動いている間)は無効にする.
+    plannerの中で別のplannerを直接awaitした場合は、その間だけ外側のprofileを止めて内側のものに切り替える
+    """
+
+    def __init__(self, awaitable: Awaitable[T], profile: cProfile.Profile):
+        self.awaitable = awaitable
+        self.profile = profile
+
+    def __await__(self) -> Generator[Any, Any, T]:
+        steps = self.awaitable.__await__()
+        value: Any = None
+        error: Optional[BaseException] = None
+        while True:
+            previous = self.activate()
+            try:
+                if error is None:
+                    yielded = steps.send(value)
+                else:
+                    yielded = steps.throw(error)
+            except StopIteration as stop:
+                result: T = stop.value
+                return result
+            finally:
+                self.deactivate(previous)
+
+            try:
+                value, error = (yield yielded), None
+            except BaseException as exc:
+                # cancelなど、待っている間に投げ込まれたものはcoroutineに渡す
+                value, error = None, exc
+
+    def activate(self) -> Optional[cProfile.Profile]:
+        """外側のprofileを止めて、自分のものを有効にする. 外側のものを返す"""
+        global active_profile
+        previous = active_profile
+        if previous is not None:
+            previous.disable()
+        active_profile = enable_profile(self.profile)
+        return previous
+
+    def deactivate(self, previous: Optional[cProfile.Profile]) -> None:
+        """自分のprofileを止めて、外側のものに戻す"""
+        global active_profile
+        if active_profile is not None:
+            active_profile.disable()
+        active_profile = enable_profile(previous) if previous is not None else None
+
+
+def enable_profile(profile: cProfile.Profile) -> Optional[cProfile.Profile]:
+    """profileを有効にして返す. 他のprofiler(debuggerなど)が動いていて有効にできなければNone"""
+    try:
+        profile.enable()
+    except ValueError:
+        logger.debug("Skip profiling, another profiler is active")
+        return None
+    return profile
+
+
+def safe_filename(name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", name)
@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import email.utils
+import multiprocessing
+import time
+import zlib
+from typing import NamedTuple, TYPE_CHECKING
+
+from .exceptions import HostUnavailable
+from .logging import logger
+
+if TYPE_CHECKING:
+    from typing import Any, AsyncIterator, Dict, Mapping, Optional, Tuple
+
+    from yarl import URL
+
+    HostKey = Tuple[str, int]
+
+__all__ = (
+    "AdaptiveThrottle",
+    "CircuitBreaker",
+    "HostLimit",
+    "HostRateLimiter",
+    "SharedHostRateLimiter",
+    "parse_host_limit",
+    "parse_retry_after",
+)
+
+# 投げ直す価値のあるステータス
+RETRYABLE_STATUSES = frozenset((429, 500, 502, 503, 504))
+# サーバーが混んでいると言っているステータス. アクセス間隔を広げる
+THROTTLE_STATUSES = frozenset((429, 503))
+# 応答時間の指数移動平均の重み
+LATENCY_EWMA_ALPHA = 0.2
+# 応答時間が平均のこの倍を超えたら遅くなったとみなす. ただしSLOW_LATENCY_MIN秒以下は気にしない
+SLOW_LATENCY_RATIO = 2.0
+SLOW_LATENCY_MIN = 1.0
+# Retry-Afterの上限(秒)
+MAX_RETRY_AFTER = 600.0
+
+
+class HostLimit(NamedTuple):
+    """ホスト毎のアクセス制限. Noneの項目はデフォルト値を使う"""
+
+    interval: Optional[float] = None
+    concurrency: Optional[int] = None
+
+
+class AdaptiveThrottle:
+    """
+    応答を見てアクセス間隔をAIMDで調整する
+
+    速く正常に応答する間はstep秒ずつ縮め、429/503や接続エラー、応答時間の増加があればfactor倍に広げる.
+    間隔はmin_interval以上max_interval以下
+    """
+
+    latency: Optional[float]  # 応答時間の指数移動平均
+
+    def __init__(self, min_interval: float, max_interval: float, step: float = 0.1, factor: float = 2.0):
+        if min_interval < 0 or max_interval < min_interval:
+            raise ValueError("0 <= min_interval <= max_interval required")
+        if step <= 0 or factor <= 1:
+            raise ValueError("step must be > 0 and factor must be > 1")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.step = step
+        self.factor = factor
+        self.latency = None
+
+    def update(self, interval: float, status: Optional[int], latency: float) -> float:
+        """応答を1つ反映して、新しいアクセス間隔を返す. statusがNoneなら接続エラー"""
+        slow = (
+            self.latency is not None and latency > SLOW_LATENCY_MIN and latency > self.latency * SLOW_LATENCY_RATIO
+        )
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += (latency - self.latency) * LATENCY_EWMA_ALPHA
+
+        if status is None or status in THROTTLE_STATUSES or slow:
+            return min(self.max_interval, max(interval * self.factor, self.step, self.min_interval))
+        if status in RETRYABLE_STATUSES:
+            # サーバーのエラーは混雑とは限らないので、間隔はそのまま
+            return interval
+        return max(self.min_interval, interval - self.step)
+
+
+class CircuitBreaker:
+    """
+    連続してthreshold回失敗したホストを、cooldown秒の間アクセスさせない
+
+    cooldownが過ぎたら1つだけ試しに通し(half-open)、成功すれば元に戻す. 失敗すればまたcooldown秒止める
+    """
+
+    failures: int
+    open_until: float
+
+    def __init__(self, threshold: int, cooldown: float):
+        if threshold < 1:
+            raise ValueError("threshold must be >= 1")
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def allow(self, now: float) -> bool:
+        """アクセスしてよければTrue. half-openならこの1つを通し、結果が出るまで他は止める"""
+        if self.is_open(now):
+            return False
+        if self.failures >= self.threshold:
+            self.open_until = now + self.cooldown
+        return True
+
+    def record(self, ok: bool, now: float) -> None:
+        if ok:
+            self.failures = 0
+            self.open_until = 0.0
+            return
+
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.failures == self.threshold:
+                logger.warning("Circuit breaker opened", cooldown=self.cooldown)
+            self.open_until = now + self.cooldown
+
+
+class HostSlot:
+    """
+    1ホスト分のアクセス間隔と同時接続数を管理する
+
+    throttleがあれば応答に合わせて間隔を変え、breakerがあれば失敗が続いたホストへのアクセスを止める
+    """
+
+    interval: float
+    semaphore: asyncio.Semaphore
+    next_request_time: float
+
+    def __init__(
+        self,
+        interval: float,
+        concurrency: int,
+        throttle: Optional[AdaptiveThrottle] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.interval = interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.next_request_time = 0.0
+        self.throttle = throttle
+        self.breaker = breaker
+
+    async def wait_turn(self) -> None:
+        """
+        前のリクエストからintervalあくまで待つ
+
+        待つ前に次の枠を予約するので、同時に呼ばれても間隔は守られる
+        """
+        now = asyncio.get_event_loop().time()
+        start = self.reserve(now)
+        if start > now:
+            logger.debug(f"sleep {start - now} secs")
+            await asyncio.sleep(start - now)
+
+    def reserve(self, now: float) -> float:
+        """次の枠を予約して、その開始時刻を返す"""
+        start = max(now, self.next_request_time)
+        self.next_request_time = start + self.interval
+        return start
+
+    def defer(self, until: float) -> None:
+        """次の枠をuntil以降にする"""
+        self.next_request_time = max(self.next_request_time, until)
+
+    def feedback(self, status: Optional[int], latency: float, retry_after: Optional[float] = None) -> None:
+        """
+        リクエストの結果を伝える. statusがNoneなら接続エラーやタイムアウト
+
+        latencyはレスポンスヘッダが返るまでの秒数, retry_afterはRetry-Afterの秒数
+        """
+        now = asyncio.get_event_loop().time()
+        if self.breaker:
+            self.breaker.record(status is not None and status not in RETRYABLE_STATUSES, now)
+        if retry_after is not None:
+            self.defer(now + min(retry_after, MAX_RETRY_AFTER))
+        if self.throttle:
+            interval = self.throttle.update(self.interval, status, latency)
+            if interval != self.interval:
+                logger.debug("Change request interval", interval=interval, status=status, latency=latency)
+                self.interval = interval
+
+
+class SharedHostSlot(HostSlot):
+    """
+    アクセス間隔の予約をプロセス間で共有するHostSlot
+
+    予約はSharedHostRateLimiterの共有メモリの表に置く. 同時接続数はプロセス毎
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        concurrency: int,
+        table: Any,
+        index: int,
+        throttle: Optional[AdaptiveThrottle] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(interval, concurrency, throttle, breaker)
+        self.table = table
+        self.index = index
+
+    def reserve(self, now: float) -> float:
+        with self.table.get_lock():
+            start: float = max(now, self.table[self.index])
+            self.table[self.index] = start + self.interval
+        return start
+
+    def defer(self, until: float) -> None:
+        with self.table.get_lock():
+            self.table[self.index] = max(self.table[self.index], until)
+
+
+class HostRateLimiter:
+    """
+    (host, port)毎にアクセス間隔と同時接続数を制限する
+
+    ホストが違えば並行にアクセスできる.
+    adaptiveなら、host_limitsで間隔を指定していないホストはAdaptiveThrottleで間隔を調整する.
+    breaker_thresholdが1以上なら、ホスト毎にCircuitBreakerを置く
+    """
+
+    interval: float
+    concurrency: int
+    host_limits: Mapping[str, HostLimit]
+    slots: Dict[HostKey, HostSlot]
+
+    def __init__(
+        self,
+        interval: float,
+        concurrency: int = 1,
+        host_limits: Optional[Mapping[str, HostLimit]] = None,
+        adaptive: bool = False,
+        min_interval: float = 0.25,
+        max_interval: float = 60.0,
+        breaker_threshold: int = 0,
+        breaker_cooldown: float = 60.0,
+    ):
+        if interval < 0:
+            raise ValueError("interval must be >= 0")
+        if concurrency < 1:
+            raise ValueError("concurrency must be >= 1")
+        self.interval = interval
+        self.concurrency = concurrency
+        self.host_limits = dict(host_limits or {})
+        self.adaptive = adaptive
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.slots = {}
+
+    # public
+    @contextlib.asynccontextmanager
+    async def acquire(self, url: URL) -> AsyncIterator[HostSlot]:
+        """
+        urlのホストにアクセスしてよくなるまで待つ. ブロックを抜けるまで接続枠を確保する
+
+        返したslotのfeedbackに結果を伝えること. breakerが開いているホストならHostUnavailable
+        """
+        if not url.host or not url.port:
+            raise ValueError(f"url not supported: {url!r}")
+
+        slot = self.get_slot((url.host, url.port))
+        # 止めているホストのために接続枠を待たない
+        if slot.breaker and slot.breaker.is_open(asyncio.get_event_loop().time()):
+            raise HostUnavailable(url.host)
+
+        async with slot.semaphore:
+            await slot.wait_turn()
+            if slot.breaker and not slot.breaker.allow(asyncio.get_event_loop().time()):
+                raise HostUnavailable(url.host)
+            yield slot
+
+    def get_limit(self, host_key: HostKey) -> HostLimit:
+        """`host:port`, `host`の順にhost_limitsを探して、デフォルトで埋めたものを返す"""
+        limit = self.get_limit_spec(host_key)
+        return HostLimit(
+            self.interval if limit.interval is None else limit.interval,
+            self.concurrency if limit.concurrency is None else limit.concurrency,
+        )
+
+    # private
+    def get_limit_spec(self, host_key: HostKey) -> HostLimit:
+        host, port = host_key
+        return self.host_limits.get(f"{host}:{port}") or self.host_limits.get(host) or HostLimit()
+
+    def get_slot(self, host_key: HostKey) -> HostSlot:
+        slot = self.slots.get(host_key)
+        if slot is None:
+            limit = self.get_limit(host_key)
+            assert limit.interval is not None and limit.concurrency is not None
+            slot = self.slots[host_key] = self.make_slot(host_key, limit.interval, limit.concurrency)
+        return slot
+
+    def make_slot(self, host_key: HostKey, interval: float, concurrency: int) -> HostSlot:
+        return HostSlot(interval, concurrency, self.make_throttle(host_key), self.make_breaker())
+
+    def make_throttle(self, host_key: HostKey) -> Optional[AdaptiveThrottle]:
+        # 間隔を明示したホストは調整しない
+        if not self.adaptive or self.get_limit_spec(host_key).interval is not None:
+            return None
+        return AdaptiveThrottle(self.min_interval, self.max_interval)
+
+    def make_breaker(self) -> Optional[CircuitBreaker]:
+        if self.breaker_threshold < 1:
+            return None
+        return CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+
+
+class SharedHostRateLimiter(HostRateLimiter):
+    """
+    forkした複数のプロセスで、ホスト毎のアクセス間隔を共有するHostRateLimiter
+
+    forkする前に作ること. 予約の時刻はホストのhashで引く固定長の共有メモリの表に置くので、
+    hashが衝突したホスト同士は間隔を共有する(間隔が長くなる方にしかずれない).
+    時刻はevent loopの時計(time.monotonic)で、同じマシンのプロセス間で共通
+    """
+
+    table: Any
+
+    def __init__(
+        self,
+        interval: float,
+        concurrency: int = 1,
+        host_limits: Optional[Mapping[str, HostLimit]] = None,
+        table_size: int = 4096,
+        **kwargs: Any,
+    ):
+        super().__init__(interval, concurrency, host_limits, **kwargs)
+        self.table = multiprocessing.get_context("fork").Array("d", table_size)
+
+    def make_slot(self, host_key: HostKey, interval: float, concurrency: int) -> HostSlot:
+        # str.hashはプロセス毎に変わりうるので使わない
+        index = zlib.crc32(f"{host_key[0]}:{host_key[1]}".encode("utf-8")) % len(self.table)
+        return SharedHostSlot(
+            interval, concurrency, self.table, index, self.make_throttle(host_key), self.make_breaker()
+        )
+
+
+def parse_host_limit(spec: str) -> Tuple[str, HostLimit]:
+    """
+    `HOST[:PORT]=INTERVAL[/CONCURRENCY]` 形式の指定をparseする
+
+    INTERVALを空にするとデフォルトの間隔を使う (例: `example.com=/4`)
+    """
+    host, sep, value = spec.partition("=")
+    if not sep or not host:
+        raise ValueError(f"bad host limit `{spec}`")
+
+    interval, _, concurrency = value.partition("/")
+    try:
+        return (
+            host.lower(),
+            HostLimit(float(interval) if interval else None, int(concurrency) if concurrency else None),
+        )
+    except ValueError:
+        raise ValueError(f"bad host limit `{spec}`")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-Afterヘッダ(秒数かHTTP-date)を、今から待つ秒数にする. 読めなければNone"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        return None
+    return max(0.0, when.timestamp() - time.time())
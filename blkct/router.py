@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import functools
+from typing import Dict, List, Optional, TYPE_CHECKING, Tuple, Union
+
+try:
+    from re import _parser as sre_parse  # type: ignore  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Iterable, Pattern
+
+    from yarl import URL
+
+    from .setup import ContentParserEntry
+    from .typing import ContentParserType
+
+    # 見つからない/曖昧な場合はエラーメッセージ
+    RouteResult = Union[Tuple[ContentParserType, Dict[str, str]], str]
+
+__all__ = ("ContentParserRouter",)
+
+# schemeに使える文字. ここに`:`が無いことで、最初の`://`がschemeの区切りだとわかる
+SCHEME_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+-.")
+
+
+class ContentParserRouter:
+    """
+    URLからContentParserを探す
+
+    patternはURLのauthority(`host[:port]`)が固定ならそのbucketに入れ、それ以外は全URLで試す.
+    結果はURL毎にLRUキャッシュする
+    """
+
+    entries: List[ContentParserEntry]
+    buckets: Dict[str, List[Tuple[int, ContentParserEntry]]]
+    generic: List[Tuple[int, ContentParserEntry]]
+    resolve: Callable[[str], RouteResult]
+
+    def __init__(self, entries: Iterable[ContentParserEntry], cache_size: int = 10000):
+        self.entries = list(entries)
+        self.buckets = {}
+        self.generic = []
+
+        seen: Dict[Tuple[str, int], ContentParserEntry] = {}
+        for order, entry in enumerate(self.entries):
+            # 全く同じpatternは必ず曖昧になるので、ここで弾く
+            key = (entry.pattern.pattern, entry.pattern.flags)
+            if key in seen:
+                raise ValueError(f"content parser pattern `{entry.pattern.pattern}` is registered twice")
+            seen[key] = entry
+
+            authority = pattern_authority(entry.pattern)
+            if authority is None:
+                self.generic.append((order, entry))
+            else:
+                self.buckets.setdefault(authority, []).append((order, entry))
+
+        self.resolve = functools.lru_cache(maxsize=cache_size)(self.resolve_uncached)
+
+    def __iter__(self) -> Any:
+        return iter(self.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    # public
+    def match(self, url: URL) -> Tuple[ContentParserType, Dict[str, str]]:
+        rv = self.resolve(str(url))
+        if isinstance(rv, str):
+            # 例外をキャッシュするとraiseする度にtracebackが伸びるので、毎回作る
+            raise Exception(rv)
+        parser, params = rv
+        return parser, dict(params)
+
+    # private
+    def resolve_uncached(self, url: str) -> RouteResult:
+        candidates = self.buckets.get(url_authority(url), [])
+        if self.generic:
+            # 登録順を保つ
+            candidates = sorted(candidates + self.generic, key=lambda x: x[0])
+
+        found = []
+        for order, (pattern, parser) in candidates:
+            mo = pattern.match(url)
+            if mo:
+                found.append((mo, parser))
+
+        if len(found) > 1:
+            return f"Multiple parser found for url `{url}`"
+        elif not found:
+            return f"No parser found for url `{url}`"
+        mo, parser = found[0]
+        return parser, mo.groupdict()
+
+
+def url_authority(url: str) -> str:
+    """`scheme://authority/...` のauthorityを小文字で返す"""
+    _, sep, rest = url.partition("://")
+    if not sep:
+        return ""
+    for i, c in enumerate(rest):
+        if c in "/?#":
+            return rest[:i].lower()
+    return rest.lower()
+
+
+def pattern_authority(pattern: Pattern[str]) -> Optional[str]:
+    """
+    patternにマッチするURLのauthorityが1つに決まるなら、それを小文字で返す
+
+    `://`の前はschemeに使える文字だけ、`://`から次の`/`までは全てリテラルの場合だけ決まる
+    """
+    try:
+        items = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    except Exception:
+        return None
+
+    text: List[str] = []
+    for op, av in items:
+        if op is sre_parse.AT and av is sre_parse.AT_BEGINNING and not text:
+            continue
+        elif op is sre_parse.LITERAL:
+            text.append(chr(av))
+        elif "://" not in "".join(text) and is_scheme_like(op, av):
+            text.append("\0")
+        else:
+            break
+
+    _, sep, rest = "".join(text).partition("://")
+    authority, slash, _ = rest.partition("/")
+    if not sep or not slash or "\0" in authority:
+        return None
+    return authority.lower()
+
+
+def is_scheme_like(op: Any, av: Any) -> bool:
+    """opがschemeに使える文字にしかマッチしないならTrue"""
+    if op is sre_parse.LITERAL:
+        return chr(av) in SCHEME_CHARS
+    elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+        return all(is_scheme_like(*item) for item in av[2])
+    elif op is sre_parse.SUBPATTERN:
+        return all(is_scheme_like(*item) for item in av[-1])
+    elif op is sre_parse.BRANCH:
+        return all(is_scheme_like(*item) for branch in av[1] for item in branch)
+    elif op is sre_parse.IN:
+        return all(is_scheme_like(o, a) for o, a in av)
+    elif op is sre_parse.RANGE:
+        return all(chr(c) in SCHEME_CHARS for c in range(av[0], av[1] + 1))
+    return False
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import asyncio
-from typing import Any, Dict, Mapping
+from typing import Any, Dict, List, Mapping, cast
 
+from ..metrics import PLANNER_QUEUE_DEPTH
 from ..session import BlackcatSession
 from ..typing import PlannerQueueEntry, Scheduler
 
@@ -10,23 +11,61 @@ RUN_PLANNER = object()
 
 
 class AsyncIOScheduler(Scheduler):
-    planner_queue: asyncio.Queue[PlannerQueueEntry]
+    num_workers: int
+    planner_queue: asyncio.Queue[Any]
 
     def __init__(self, num_workers: int = 1):
-        # TODO: num_workersを使ってない
+        if num_workers < 1:
+            raise ValueError("num_workers must be >= 1")
+        self.num_workers = num_workers
         self.planner_queue = asyncio.Queue()
 
     async def dispatch(
         self, session: BlackcatSession, planner: str, args: Mapping[str, Any], options: Dict[str, Any]
     ) -> None:
-        await self.planner_queue.put((session, planner, args))
+        await self.put_entry((session, planner, args), options)
 
     async def run(self) -> None:
         """
-        asyncio.Queueで順番に処理する
+        num_workers個のworkerでasyncio.Queueを並行に処理する
 
-        Queueが空になるまで回す
+        実行中のplannerがdispatchしたものも含めて、全てのplannerが終わる(Queue.join())まで回す。
+        どれかのplannerが例外を投げたら、他のworkerを止めてその例外を投げ直す
         """
-        while not self.planner_queue.empty():
-            session, planner, args = self.planner_queue.get_nowait()
-            await session.handle_planner(planner, args)
+        workers: List[asyncio.Future[None]] = [
+            asyncio.ensure_future(self.worker()) for _ in range(self.num_workers)
+        ]
+        joined = asyncio.ensure_future(self.planner_queue.join())
+        try:
+            done, _ = await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not joined:
+                    task.result()
+        finally:
+            for task in [joined, *workers]:
+                task.cancel()
+            await asyncio.gather(joined, *workers, return_exceptions=True)
+
+    # protected
+    async def put_entry(self, entry: PlannerQueueEntry, options: Dict[str, Any]) -> None:
+        session, planner, _ = entry
+        await self.planner_queue.put(entry)
+        count_queued(session, planner, 1)
+
+    async def get_entry(self) -> PlannerQueueEntry:
+        return cast(PlannerQueueEntry, await self.planner_queue.get())
+
+    # private
+    async def worker(self) -> None:
+        while True:
+            session, planner, args = await self.get_entry()
+            count_queued(session, planner, -1)
+            try:
+                await session.handle_planner(planner, args)
+            finally:
+                self.planner_queue.task_done()
+
+
+def count_queued(session: BlackcatSession, planner: str, value: int) -> None:
+    """queueに入っているplannerの数(PLANNER_QUEUE_DEPTH)を増減する"""
+    session.blackcat.metrics.add_gauge(PLANNER_QUEUE_DEPTH, value, planner=planner)
@@ -1,34 +1,103 @@
 from __future__ import annotations
 
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
-from typing import Any, Dict, List, Mapping
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
 
 import boto3
 
+from botocore.exceptions import ClientError
+
+from .asyncio_scheduler import count_queued
+from ..exceptions import JobSubmissionError
 from ..logging import logger
 from ..session import BlackcatSession
 from ..typing import PlannerQueueEntry, Scheduler
 from ..utils import dump_json
 
-batch_client = boto3.client("batch")
-
 # dispatchをプロセス内で処理するならtrue
 OPTIONS_IN_PROCESS = "in_process"
 
+# 複数の(planner, args)をまとめた1つのJobのplanner名. argsは{"entries": [[planner, args], ...]}
+PACKED_PLANNER = "_packed"
+# 1つのJobにまとめるargsのJSONの上限. submit_jobのリクエストの上限(30KiB)に収まるようにする
+PACK_MAX_BYTES = 24 * 1024
+
+# submit_jobを投げ直すエラーコード
+THROTTLING_ERROR_CODES = frozenset(
+    ("TooManyRequestsException", "ThrottlingException", "Throttling", "RequestLimitExceeded")
+)
+# 投げ直すまでの待ち時間の基準(秒). 実際は0からbase * 2 ** retryのランダム
+SUBMIT_RETRY_BASE = 0.5
+SUBMIT_RETRY_MAX = 20.0
+
 
 class AWSBatchScheduler(Scheduler):
+    """
+    最初のplannerはこのプロセスで、それ以外はAWS BatchのJobとして処理する
+
+    submit_jobはevent loopを止めないようにバックグラウンドで、max_concurrent_submissions個まで並行して投げる.
+    throttlingされたらjitterをつけたexponential backoffで投げ直す.
+    同じsessionで同じjobName(planner, argsのmd5)のものは1回しか投げない.
+    runの最後に全てのsubmitを待ち、失敗したものはまとめてJobSubmissionErrorにする.
+
+    pack_sizeが2以上なら、dispatchをpack_size個(またはpack_wait秒)ずつまとめて1つのJobにし、
+    コンテナの起動などのコストを分け合う. まとめたJobの中身はそのJobのプロセス内で順に処理する
+    """
+
+    batch_client: Any
+    executor: ThreadPoolExecutor
+    failures: List[Tuple[str, BaseException]]
     first_plan_dispatched: bool
+    max_retries: int
+    pack: List[Tuple[str, Mapping[str, Any]]]
+    pack_bytes: int
+    pack_session_id: Optional[str]
+    pack_size: int
+    pack_timer: Optional[asyncio.TimerHandle]
+    pack_wait: float
     plans: List[PlannerQueueEntry]
+    submissions: List[asyncio.Future[None]]
+    submitted_job_names: Set[str]
 
-    def __init__(self, job_definition: str, job_queue: str):
+    def __init__(
+        self,
+        job_definition: str,
+        job_queue: str,
+        max_concurrent_submissions: int = 8,
+        max_retries: int = 8,
+        pack_size: int = 1,
+        pack_wait: float = 1.0,
+        batch_client: Optional[Any] = None,
+    ):
         if not job_definition:
             raise ValueError("job_definition required")
         if not job_queue:
             raise ValueError("job_queue required")
+        if max_concurrent_submissions < 1:
+            raise ValueError("max_concurrent_submissions must be >= 1")
+        if pack_size < 1:
+            raise ValueError("pack_size must be >= 1")
         self.job_definition = job_definition
         self.job_queue = job_queue
+        self.max_retries = max_retries
+        self.batch_client = batch_client or boto3.session.Session().client("batch")
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_submissions, thread_name_prefix="blkct-awsbatch-scheduler"
+        )
         self.first_plan_dispatched = False
         self.plans = []
+        self.submissions = []
+        self.submitted_job_names = set()
+        self.failures = []
+        self.pack_size = pack_size
+        self.pack_wait = pack_wait
+        self.pack = []
+        self.pack_bytes = 0
+        self.pack_session_id = None
+        self.pack_timer = None
 
     # override
     async def dispatch(
@@ -37,32 +106,128 @@ class AWSBatchScheduler(Scheduler):
         if not self.first_plan_dispatched:
             # 最初のJobはこのプロセス内で処理するJob
             self.first_plan_dispatched = True
-            self.plans.append((session, planner, args))
+            self.add_plan(session, planner, args)
             return
 
         logger.info("Dispatch job", planner=planner, args=args)
 
         if options.get(OPTIONS_IN_PROCESS):
-            self.plans.append((session, planner, args))
+            self.add_plan(session, planner, args)
+            return
+
+        json_data = dump_json(args)
+        job_name = f"{session.session_id}_{planner}_{md5(json_data.encode('utf-8')).hexdigest()}"
+        if job_name in self.submitted_job_names:
+            logger.debug("Job already submitted", job_name=job_name)
+            return
+        self.submitted_job_names.add(job_name)
+
+        if self.pack_size > 1:
+            self.add_to_pack(session.session_id, planner, args, len(json_data))
         else:
-            # TODO:blockしている
-            logger.info("Submit job", planner=planner, args=args)
-            json_data = dump_json(args)
-            response = batch_client.submit_job(
-                jobName=f"{session.session_id}_{planner}_{md5(json_data.encode('utf-8')).hexdigest()}",
-                jobQueue=self.job_queue,
-                jobDefinition=self.job_definition,
-                parameters={"planner": planner, "args": json_data},
-                containerOverrides={"environment": [{"name": "BLKCT_SESSION_ID", "value": session.session_id}]},
-            )
-            job_id = response["jobId"]
-            logger.info("Job submitted", job_id=job_id)
+            self.submit_in_background(session.session_id, job_name, planner, json_data)
 
     async def run(self) -> None:
         if not self.plans:
             raise Exception("No plans dispatched")
 
-        # submit other jobs
-        while self.plans:
-            session, planner, args = self.plans.pop(0)
-            await session.handle_planner(planner, args)
+        try:
+            while self.plans:
+                session, planner, args = self.plans.pop(0)
+                count_queued(session, planner, -1)
+                if planner == PACKED_PLANNER:
+                    # まとめたJobなので、中身をこのプロセスで順に処理する
+                    for p, a in args["entries"]:
+                        self.add_plan(session, p, a)
+                    continue
+                await session.handle_planner(planner, args)
+        finally:
+            await self.drain()
+            self.executor.shutdown(wait=True)
+
+        if self.failures:
+            for job_name, exc in self.failures:
+                logger.error("Job submission failed", job_name=job_name, error=repr(exc))
+            raise JobSubmissionError(
+                f"{len(self.failures)} of {len(self.submitted_job_names)} job submissions failed", self.failures
+            )
+
+    # private
+    def add_plan(self, session: BlackcatSession, planner: str, args: Mapping[str, Any]) -> None:
+        """このプロセス内で処理するplanを追加する"""
+        self.plans.append((session, planner, args))
+        count_queued(session, planner, 1)
+
+    async def drain(self) -> None:
+        """まとめ途中のものをsubmitし、バックグラウンドのsubmitが全て終わるまで待つ"""
+        self.flush_pack()
+        while self.submissions:
+            submissions, self.submissions = self.submissions, []
+            await asyncio.gather(*submissions)
+
+    def add_to_pack(self, session_id: str, planner: str, args: Mapping[str, Any], args_size: int) -> None:
+        if self.pack and self.pack_bytes + args_size > PACK_MAX_BYTES:
+            self.flush_pack()
+
+        self.pack.append((planner, args))
+        self.pack_bytes += args_size + len(planner) + 8
+        self.pack_session_id = session_id
+        if len(self.pack) >= self.pack_size:
+            self.flush_pack()
+        elif self.pack_timer is None:
+            self.pack_timer = asyncio.get_event_loop().call_later(self.pack_wait, self.flush_pack)
+
+    def flush_pack(self) -> None:
+        """まとめ途中のものを1つのJobとしてsubmitする"""
+        if self.pack_timer:
+            self.pack_timer.cancel()
+            self.pack_timer = None
+        if not self.pack:
+            return
+
+        entries, self.pack, self.pack_bytes = self.pack, [], 0
+        assert self.pack_session_id
+        json_data = dump_json({"entries": entries})
+        job_name = f"{self.pack_session_id}_{PACKED_PLANNER}_{md5(json_data.encode('utf-8')).hexdigest()}"
+        logger.info("Pack jobs", job_name=job_name, count=len(entries))
+        self.submit_in_background(self.pack_session_id, job_name, PACKED_PLANNER, json_data)
+
+    def submit_in_background(self, session_id: str, job_name: str, planner: str, json_data: str) -> None:
+        self.submissions.append(
+            asyncio.ensure_future(
+                self.submit_job(
+                    job_name,
+                    {"planner": planner, "args": json_data},
+                    [{"name": "BLKCT_SESSION_ID", "value": session_id}],
+                )
+            )
+        )
+
+    async def submit_job(self, job_name: str, parameters: Dict[str, str], environment: List[Dict[str, str]]) -> None:
+        loop = asyncio.get_event_loop()
+        for retry in range(self.max_retries + 1):
+            try:
+                response = await loop.run_in_executor(
+                    self.executor,
+                    lambda: self.batch_client.submit_job(
+                        jobName=job_name,
+                        jobQueue=self.job_queue,
+                        jobDefinition=self.job_definition,
+                        parameters=parameters,
+                        containerOverrides={"environment": environment},
+                    ),
+                )
+            except ClientError as exc:
+                if exc.response["Error"]["Code"] in THROTTLING_ERROR_CODES and retry < self.max_retries:
+                    delay = random.uniform(0, min(SUBMIT_RETRY_MAX, SUBMIT_RETRY_BASE * 2 ** retry))
+                    logger.debug("Job submission throttled", job_name=job_name, retry=retry, delay=delay)
+                    await asyncio.sleep(delay)
+                    continue
+                self.failures.append((job_name, exc))
+                return
+            except Exception as exc:
+                self.failures.append((job_name, exc))
+                return
+
+            logger.info("Job submitted", job_name=job_name, job_id=response["jobId"])
+            return
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+import traceback
+from typing import Any, Dict, List, Mapping, Optional, TYPE_CHECKING
+
+from .asyncio_scheduler import count_queued
+from ..context_store.file_context_store import FileContextStore
+from ..exceptions import CrawlerError
+from ..logging import logger
+from ..metrics import MetricsRegistry
+from ..ratelimit import SharedHostRateLimiter
+from ..session import BlackcatSession
+from ..typing import Scheduler
+from ..utils import dump_json
+
+if TYPE_CHECKING:
+    from multiprocessing.context import ForkProcess
+
+    from ..blackcat import Blackcat
+
+# 親プロセスがworkerプロセスの様子を見る間隔(秒)
+POLL_INTERVAL = 0.1
+# 終了を伝えてから、workerプロセスが終わるのを待つ時間(秒)
+SHUTDOWN_TIMEOUT = 30.0
+
+
+class MultiprocessScheduler(Scheduler):
+    """
+    forkしたnum_processes個のworkerプロセスでplannerを処理するスケジューラ
+
+    各プロセスは自分のevent loopとBlackcatSession(aiohttp session, Content Store, Context Store)を持ち、
+    num_workers個のplannerを並行に処理する.
+    dispatchはAWS Batchと同じく(planner, argsのJSON)として全プロセスで共有するQueueに入れる.
+    ホスト毎のアクセス間隔はSharedHostRateLimiterで全プロセスで共有する.
+    どれかのplannerが例外を投げたら、全プロセスを止めてCrawlerErrorを投げる.
+    各プロセスのメトリクスは終わる時に親に送り、親のBlackcat.metricsに足す.
+    profileは各プロセスがpid毎のファイルに書き、親がまとめる
+
+    forkは親がsessionのStoreやaiohttpのsession(executorのスレッドやboto3のclient)を作る前、startで行う.
+    Context Storeは各プロセスが自分で開くので、複数のプロセスから同時に開けないFileContextStoreは使えない
+    """
+
+    blackcat: Optional[Blackcat]
+    errors: Any  # multiprocessing.Queue
+    metrics: Any  # multiprocessing.Queue. 各プロセスのMetricsRegistry.to_json()
+    num_processes: int
+    num_workers: int
+    pending: Any  # multiprocessing.Value. Queueに入れてまだ終わっていない数
+    processes: List[ForkProcess]
+    queue: Any  # multiprocessing.Queue
+    session_id: Optional[str]
+    stopping: Any  # multiprocessing.Event
+
+    def __init__(self, num_processes: Optional[int] = None, num_workers: int = 1):
+        num_processes = num_processes or os.cpu_count() or 1
+        if num_processes < 1:
+            raise ValueError("num_processes must be >= 1")
+        if num_workers < 1:
+            raise ValueError("num_workers must be >= 1")
+        self.num_processes = num_processes
+        self.num_workers = num_workers
+
+        context = multiprocessing.get_context("fork")
+        self.queue = context.Queue()
+        self.errors = context.Queue()
+        self.metrics = context.Queue()
+        self.pending = context.Value("l", 0)
+        self.stopping = context.Event()
+        self.blackcat = None
+        self.session_id = None
+        self.processes = []
+
+    # override
+    async def start(self, blackcat: Blackcat, session_id: str) -> None:
+        self.blackcat = blackcat
+        self.session_id = session_id
+
+        # forkする前に作って、全プロセスで共有する
+        rate_limiter = SharedHostRateLimiter(
+            blackcat.request_interval,
+            blackcat.max_requests_per_host,
+            blackcat.host_limits,
+            **blackcat.throttle_options,
+        )
+
+        context = multiprocessing.get_context("fork")
+        self.processes = [
+            context.Process(
+                target=self.run_worker_process,
+                args=(session_id, rate_limiter),
+                name=f"blkct-worker-{i}",
+                daemon=True,
+            )
+            for i in range(self.num_processes)
+        ]
+        for process in self.processes:
+            process.start()
+        logger.info("Start worker processes", pids=[p.pid for p in self.processes])
+
+    async def dispatch(
+        self, session: BlackcatSession, planner: str, args: Mapping[str, Any], options: Dict[str, Any]
+    ) -> None:
+        if isinstance(session.context_store, FileContextStore):
+            raise CrawlerError("MultiprocessScheduler cannot be used with FileContextStore")
+        with self.pending.get_lock():
+            self.pending.value += 1
+        self.queue.put((planner, dump_json(args)))
+        # 取り出すのは別のプロセスだが、メトリクスは最後に親で足すので合う
+        count_queued(session, planner, 1)
+
+    async def run(self) -> None:
+        if not self.processes:
+            raise Exception("Worker processes are not started")
+
+        try:
+            await self.wait_processes(self.processes)
+        finally:
+            self.stop_processes()
+
+    async def close(self) -> None:
+        # runまで進まなかった場合
+        self.stop_processes()
+
+    # private (親プロセス)
+    async def wait_processes(self, processes: List[ForkProcess]) -> None:
+        """全てのplannerが終わるまで待つ. plannerの失敗やプロセスの異常終了は例外にする"""
+        while True:
+            await asyncio.sleep(POLL_INTERVAL)
+            if not self.errors.empty():
+                planner, args, error = self.errors.get()
+                logger.error("Planner failed", planner=planner, args=args, error=error)
+                raise CrawlerError(f"planner `{planner}` failed in a worker process")
+
+            for process in processes:
+                if process.exitcode is not None:
+                    raise CrawlerError(f"worker process {process.pid} exited with {process.exitcode}")
+
+            with self.pending.get_lock():
+                if self.pending.value == 0:
+                    return
+
+    def stop_processes(self) -> None:
+        processes, self.processes = self.processes, []
+        if not processes:
+            return
+
+        self.stopping.set()
+        for _ in range(self.num_processes * self.num_workers):
+            self.queue.put(None)
+
+        self.collect_metrics(processes)
+        for process in processes:
+            process.join(SHUTDOWN_TIMEOUT)
+            if process.exitcode is None:
+                logger.warning("Terminate worker process", pid=process.pid)
+                process.terminate()
+                process.join()
+
+    def collect_metrics(self, processes: List[ForkProcess]) -> None:
+        """各プロセスから送られてくるメトリクスを足す. 異常終了したプロセスの分は無い"""
+        assert self.blackcat
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        received = 0
+        while received < len(processes) and time.monotonic() < deadline:
+            try:
+                data = self.metrics.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if all(process.exitcode is not None for process in processes) and self.metrics.empty():
+                    return
+                continue
+            self.blackcat.metrics.merge(data)
+            received += 1
+
+    # private (workerプロセス)
+    def run_worker_process(self, session_id: str, rate_limiter: SharedHostRateLimiter) -> None:
+        # Ctrl-Cは親が受けて止めるので、親のevent loopに向いたhandlerを外す
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # 親のevent loopはforkで壊れているので、新しいloopで動かす
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.serve(session_id, rate_limiter))
+        finally:
+            loop.close()
+
+    async def serve(self, session_id: str, rate_limiter: SharedHostRateLimiter) -> None:
+        assert self.blackcat
+        blackcat = self.blackcat
+        # forkする前の親の分を数え直さないように、空から数える
+        blackcat.metrics = MetricsRegistry()
+        if blackcat.profiler:
+            blackcat.profiler.reset()
+        session = BlackcatSession(
+            blackcat, self, blackcat.content_store_factory(), blackcat.context_store_factory(), session_id=session_id
+        )
+        session.rate_limiter = rate_limiter
+        try:
+            await asyncio.gather(*[self.worker(session) for _ in range(self.num_workers)])
+        finally:
+            try:
+                await session.close()
+                await blackcat.close()
+            finally:
+                self.metrics.put(blackcat.metrics.to_json())
+                # summaryは親がまとめて書く
+                if blackcat.profiler:
+                    blackcat.profiler.stop()
+                    blackcat.profiler.write_stats(session_id)
+
+    async def worker(self, session: BlackcatSession) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            item = await loop.run_in_executor(None, self.queue.get)
+            if item is None:
+                return
+
+            planner, args = item
+            count_queued(session, planner, -1)
+            try:
+                # 止める時は残っているものを捨てる
+                if not self.stopping.is_set():
+                    await session.handle_planner(planner, json.loads(args))
+            except Exception:
+                self.errors.put((planner, args, traceback.format_exc()))
+            finally:
+                with self.pending.get_lock():
+                    self.pending.value -= 1
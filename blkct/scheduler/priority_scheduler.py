@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+from typing import Any, Dict, Iterator, Tuple, Union
+
+from .asyncio_scheduler import AsyncIOScheduler, count_queued
+from ..constants import CrawlPrioirty
+from ..typing import PlannerQueueEntry
+
+# dispatchのoptionで優先度を指定する. 値はCrawlPrioirty, int, もしくはCrawlPrioirtyの名前
+OPTIONS_PRIORITY = "priority"
+
+PriorityQueueEntry = Tuple[int, int, PlannerQueueEntry]
+
+
+class PriorityScheduler(AsyncIOScheduler):
+    """
+    dispatch時の`priority` optionの順にplannerを処理するスケジューラ
+
+    値が小さいほど先に処理する. 同じ優先度の中ではdispatchした順(FIFO)
+    """
+
+    sequence: Iterator[int]
+
+    def __init__(self, num_workers: int = 1):
+        super().__init__(num_workers)
+        self.planner_queue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+
+    # override
+    async def put_entry(self, entry: PlannerQueueEntry, options: Dict[str, Any]) -> None:
+        # heapの比較がentryまで行かないように、(優先度, 連番)をキーにする
+        session, planner, _ = entry
+        item: PriorityQueueEntry = (get_priority(options), next(self.sequence), entry)
+        await self.planner_queue.put(item)
+        count_queued(session, planner, 1)
+
+    async def get_entry(self) -> PlannerQueueEntry:
+        item: PriorityQueueEntry = await self.planner_queue.get()
+        return item[2]
+
+
+def get_priority(options: Dict[str, Any]) -> int:
+    """dispatchのoptionsから優先度を取り出す"""
+    priority: Union[None, int, str] = options.get(OPTIONS_PRIORITY)
+    if priority is None:
+        return int(CrawlPrioirty.default)
+    if isinstance(priority, str):
+        try:
+            return int(CrawlPrioirty[priority])
+        except KeyError:
+            raise ValueError(f"unknown priority `{priority}`")
+    return int(priority)
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from typing import Any, Dict, Mapping, Optional, Set, Tuple, cast
+
+from .asyncio_scheduler import AsyncIOScheduler, count_queued
+from ..logging import logger
+from ..session import BlackcatSession
+from ..typing import PlannerQueueEntry
+from ..utils import BlkctEncoder
+
+# planner_queueに入れるもの. (plansのrowid, entry)
+SQLiteQueueEntry = Tuple[int, PlannerQueueEntry]
+
+STATE_PENDING = "pending"
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plans (
+    id INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    planner TEXT NOT NULL,
+    args TEXT NOT NULL,
+    state TEXT NOT NULL,
+    UNIQUE (session_id, planner, args)
+);
+CREATE INDEX IF NOT EXISTS plans_session_state ON plans (session_id, state);
+"""
+
+
+class SQLiteScheduler(AsyncIOScheduler):
+    """
+    dispatchされた(planner, args)をSQLiteに記録しながら処理するスケジューラ
+
+    plan毎にpending, running, doneの状態を持つ. 同じsessionで全く同じ(planner, args)は2回目以降を無視する.
+    落ちた後に同じsession idで動かすと、最初のdispatchの時にdoneでないものを読み直して続きから処理する.
+    SQLiteはWALモードで、1件ずつcommitする. 書き込みは小さいのでevent loopの中で行う
+    """
+
+    connection: sqlite3.Connection
+    resumed_sessions: Set[str]
+
+    def __init__(self, db_path: str, num_workers: int = 1):
+        super().__init__(num_workers)
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WALならアプリが落ちても失われない. 電源断の場合は最後の方のcommitが失われうる
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.resumed_sessions = set()
+
+    async def run(self) -> None:
+        try:
+            await super().run()
+        finally:
+            self.connection.close()
+
+    # override
+    async def put_entry(self, entry: PlannerQueueEntry, options: Dict[str, Any]) -> None:
+        session, planner, args = entry
+        if session.session_id not in self.resumed_sessions:
+            self.resumed_sessions.add(session.session_id)
+            await self.resume(session)
+
+        row_id = self.insert(session.session_id, planner, args)
+        if row_id is None:
+            logger.debug("Plan already dispatched", planner=planner, args=args)
+            return
+        await self.planner_queue.put((row_id, entry))
+        count_queued(session, planner, 1)
+
+    # private
+    async def resume(self, session: BlackcatSession) -> None:
+        """前回doneにならなかったものを、queueに入れ直す"""
+        self.connection.execute(
+            "UPDATE plans SET state = ? WHERE session_id = ? AND state = ?",
+            (STATE_PENDING, session.session_id, STATE_RUNNING),
+        )
+        rows = self.connection.execute(
+            "SELECT id, planner, args FROM plans WHERE session_id = ? AND state = ? ORDER BY id",
+            (session.session_id, STATE_PENDING),
+        ).fetchall()
+        if rows:
+            logger.info("Resume plans", session_id=session.session_id, count=len(rows))
+        for row_id, planner, args in rows:
+            await self.planner_queue.put((row_id, (session, planner, json.loads(args))))
+            count_queued(session, planner, 1)
+
+    def insert(self, session_id: str, planner: str, args: Mapping[str, Any]) -> Optional[int]:
+        """planを記録してrowidを返す. 既にあればNone"""
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO plans (session_id, planner, args, state) VALUES (?, ?, ?, ?)",
+            (session_id, planner, json.dumps(args, sort_keys=True, cls=BlkctEncoder), STATE_PENDING),
+        )
+        return cursor.lastrowid if cursor.rowcount == 1 else None
+
+    def set_state(self, row_id: int, state: str) -> None:
+        self.connection.execute("UPDATE plans SET state = ? WHERE id = ?", (state, row_id))
+
+    async def worker(self) -> None:
+        while True:
+            row_id, (session, planner, args) = cast(SQLiteQueueEntry, await self.planner_queue.get())
+            count_queued(session, planner, -1)
+            try:
+                self.set_state(row_id, STATE_RUNNING)
+                await session.handle_planner(planner, args)
+                # doneにする前にcontextの変更を保存する. 落ちてもdoneのplanの変更は失われない
+                await session.flush_contexts()
+                # 失敗したものはrunningのまま残し、次に動かした時にやり直す
+                self.set_state(row_id, STATE_DONE)
+            finally:
+                self.planner_queue.task_done()
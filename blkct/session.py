@@ -1,31 +1,53 @@
 from __future__ import annotations
 
 import asyncio
-import time
+import contextlib
+import random
+import tempfile
 from typing import TYPE_CHECKING, TypeVar, cast
 
+import aiohttp
+
 from yarl import URL
 
 from .content_store.content import Content, FetchedContent
-from .exceptions import BadStatusCode, ContextNotFoundError, CrawlerError
+from .exceptions import BadStatusCode, ContentTooLarge, ContextNotFoundError, CrawlerError
 from .logging import logger
+from .metrics import (
+    CONTENT_STORE_LOOKUPS,
+    CONTENT_STORE_SECONDS,
+    CONTEXT_STORE_SECONDS,
+    HTTP_REQUESTS,
+    HTTP_REQUEST_SECONDS,
+    HTTP_RESPONSE_BYTES,
+    PARSE_SECONDS,
+    PLANNER_SECONDS,
+)
+from .ratelimit import RETRYABLE_STATUSES, parse_retry_after
 from .typing import BinaryData
 
 if TYPE_CHECKING:
-    from typing import Any, Dict, Mapping, Optional, Tuple, Union
-
-    import aiohttp
+    from typing import Any, AsyncIterator, Dict, IO, Mapping, Optional, Tuple, Union
 
     from .blackcat import Blackcat
+    from .ratelimit import HostRateLimiter
     from .typing import ContentParserType, ContentStore, ContextStore, Scheduler
 
+# HTTPのbodyを読む単位
+READ_CHUNK_SIZE = 64 * 1024
+# fetchを投げ直すまでの待ち時間の上限(秒)
+RETRY_MAX = 30.0
+
 
 class BlackcatSession:
     aio_session: aiohttp.ClientSession
     blackcat: Blackcat
     content_store: ContentStore
     context_store: ContextStore
-    last_request_time_per_host: Dict[Tuple[str, int], float]
+    content_users: Dict[asyncio.Future[Content], int]
+    contexts: Dict[str, asyncio.Future[SessionContext]]
+    inflight_contents: Dict[Tuple[URL, bool, bool], asyncio.Future[Content]]
+    rate_limiter: HostRateLimiter
     scheduler: Scheduler
     session_id: str
 
@@ -42,15 +64,26 @@ class BlackcatSession:
         self.context_store = context_store
         self.scheduler = scheduler
         self.aio_session = self.blackcat.make_aio_session()
-        self.last_request_time_per_host = {}
+        self.rate_limiter = self.blackcat.make_rate_limiter()
+        self.inflight_contents = {}
+        self.content_users = {}
+        self.contexts = {}
         self.session_id = session_id
 
     # public
     async def crawl(
-        self, url: Union[str, URL], *, parser: Optional[ContentParserType] = None, check_status: bool = True
+        self,
+        url: Union[str, URL],
+        *,
+        parser: Optional[ContentParserType] = None,
+        check_status: bool = True,
+        revalidate: Optional[bool] = None,
     ) -> Any:
         """
         URLをクロールして結果を返す
+
+        revalidateならContent Storeにあっても、ETag/Last-Modifiedで更新されていないかサーバに確かめる.
+        Noneの場合はBlackcatの設定に従う
         """
         url = URL(url) if isinstance(url, str) else url
 
@@ -62,22 +95,12 @@ class BlackcatSession:
         else:
             params = {}
 
-        content: Optional[Content] = await self.content_store.pull_content(self, url)
-        if content:
-            # Content Storeにみつかったので使う
-            pass
-        else:
-            # HTTPで落とす
-            logger.info("Crawl URL", url=url)
-
-            content = await self.fetch_content(url, check_status)
-            if not content:
-                raise CrawlerError("Fetch failed")
+        if revalidate is None:
+            revalidate = self.blackcat.revalidate
 
-            if content.status_code == 200:
-                await self.content_store.push_content(self, url, content)
-
-        return parser(url, params, content)
+        async with self.open_content(url, check_status, revalidate) as content:
+            with self.blackcat.metrics.time(PARSE_SECONDS, parser=getattr(parser, "__name__", "unknown")):
+                return parser(url, params, content)
 
     async def crawl_image(self, url: Union[URL, str], check_status: bool = True) -> BinaryData:
         rv = await self.crawl(url, parser=parse_image, check_status=check_status)
@@ -88,45 +111,234 @@ class BlackcatSession:
         await self.scheduler.dispatch(self, planner, args, options)
 
     async def get_context(self, context_name: str) -> "SessionContext":
-        context = SessionContext(self, self.context_store, context_name)
-        await context.load()
-        return context
+        """
+        context_nameのSessionContextを返す
+
+        session内では同じ名前のSessionContextは1つで、ContextStoreから読むのは最初の1回だけ
+        """
+        task = self.contexts.get(context_name)
+        if task is None:
+            task = self.contexts[context_name] = asyncio.ensure_future(self.load_context(context_name))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self.contexts.get(context_name) is task:
+                del self.contexts[context_name]
+            raise
 
     # internal
     async def close(self) -> None:
-        await self.aio_session.close()
-        await self.context_store.close()
+        try:
+            await self.flush_contexts()
+        finally:
+            await self.blackcat.close_aio_session(self.aio_session)
+            await self.content_store.close()
+            await self.context_store.close()
+
+    async def flush_contexts(self) -> None:
+        """変更の残っているSessionContextを全て保存する"""
+        for task in list(self.contexts.values()):
+            if task.done() and not task.cancelled() and not task.exception():
+                await task.result().flush()
 
     # private
+    async def load_context(self, context_name: str) -> SessionContext:
+        context = SessionContext(
+            self,
+            self.context_store,
+            context_name,
+            write_through=self.blackcat.context_write_through,
+            flush_interval=self.blackcat.context_flush_interval,
+            flush_threshold=self.blackcat.context_flush_threshold,
+        )
+        await context.load()
+        return context
+
     async def handle_planner(self, planner: str, args: Mapping[str, Any]) -> Any:
         logger.info("Handle planner", planner=planner, args=args)
 
         # TODO: check exists
         p = self.blackcat.planners[planner]
-        return await p(self, **args)
+        metrics = self.blackcat.metrics
+        coro = p(self, **args)
+        if self.blackcat.profiler:
+            coro = self.blackcat.profiler.profile(planner, coro)
+        with metrics.time(PLANNER_SECONDS, planner=planner):
+            return await coro
+
+    async def get_content(self, url: URL, check_status: bool, revalidate: bool = False) -> Content:
+        """URLのContentを、bodyをメモリに読んだ状態で返す"""
+        async with self.open_content(url, check_status, revalidate) as content:
+            if isinstance(content, FetchedContent):
+                content.load_body()
+            return content
+
+    @contextlib.asynccontextmanager
+    async def open_content(self, url: URL, check_status: bool, revalidate: bool = False) -> AsyncIterator[Content]:
+        """
+        URLのContentを取得して、抜けるまで使えるようにする
+
+        同じURLが同時に要求された場合は最初の1つだけが取得・保存し、残りはその結果を待って同じContentを使う.
+        HTTPで取ってきたbodyの一時ファイルは、使っている全員が抜けたら消す
+        """
+        key = (url, check_status, revalidate)
+        task = self.inflight_contents.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.load_content(url, check_status, revalidate))
+            self.inflight_contents[key] = task
+            task.add_done_callback(lambda _: self.on_content_loaded(key, task))
+        else:
+            logger.debug("Wait in-flight crawl", url=url)
 
-    async def fetch_content(self, url: URL, check_status: bool) -> Optional[FetchedContent]:
-        # ホストにアクセスする間隔についてwaitを入れる
+        self.content_users[task] = self.content_users.get(task, 0) + 1
+        try:
+            # 待っている側がcancelされても、他の待っている側のために取得は続ける
+            yield await asyncio.shield(task)
+        finally:
+            self.content_users[task] -= 1
+            if not self.content_users[task]:
+                del self.content_users[task]
+                if task.done():
+                    close_content(task)
+
+    def on_content_loaded(self, key: Tuple[URL, bool, bool], task: asyncio.Future[Content]) -> None:
+        self.inflight_contents.pop(key, None)
+        # 待っている側が全員cancelされていたら、誰も閉じないのでここで閉じる
+        if task not in self.content_users:
+            close_content(task)
+
+    async def load_content(self, url: URL, check_status: bool, revalidate: bool = False) -> Content:
+        metrics = self.blackcat.metrics
+        with metrics.time(CONTENT_STORE_SECONDS, operation="pull"):
+            content: Optional[Content] = await self.content_store.pull_content(self, url)
+        metrics.inc(CONTENT_STORE_LOOKUPS, result="hit" if content else "miss")
+        if content and revalidate and content.revalidation_headers:
+            # 更新されていなければ(304)、Content Storeのものを使う
+            logger.info("Revalidate URL", url=url)
+
+            fetched = await self.fetch_content(url, check_status, headers=content.revalidation_headers)
+            if fetched and fetched.status_code == 304:
+                logger.debug("Not modified", url=url)
+                fetched.close()
+                return content
+        elif content:
+            # Content Storeにみつかったので使う
+            return content
+        else:
+            # HTTPで落とす
+            logger.info("Crawl URL", url=url)
+
+            fetched = await self.fetch_content(url, check_status)
+
+        if not fetched:
+            raise CrawlerError("Fetch failed")
+
+        if fetched.status_code == 200:
+            try:
+                with metrics.time(CONTENT_STORE_SECONDS, operation="push"):
+                    await self.content_store.push_content(self, url, fetched)
+            except BaseException:
+                fetched.close()
+                raise
+
+        # 一時ファイルはparserが使い終わるまで残す. open_contentを抜けたら消す
+        return fetched
+
+    async def fetch_content(
+        self, url: URL, check_status: bool, headers: Optional[Mapping[str, str]] = None
+    ) -> Optional[FetchedContent]:
+        """
+        URLをHTTPで取得する
+
+        接続エラーや429/5xxなら、jitterをつけたexponential backoffでmax_retries回まで投げ直す.
+        Retry-Afterはrate_limiterが守る
+        """
         if url.scheme not in ("http", "https") or not url.host or not url.port:
             raise CrawlerError(f"url not supported: {url!r}")
 
-        now = time.time()
-        host_key = (url.host, url.port)
-        last_request = self.last_request_time_per_host.get(host_key, None)
-        if last_request:
-            wait_until = last_request + self.blackcat.request_interval
-            if wait_until > now:
-                logger.debug(f"sleep {wait_until - now} secs")
-                await asyncio.sleep(wait_until - now)
-        self.last_request_time_per_host[host_key] = now
+        max_retries = self.blackcat.max_retries
+        retry = 0
+        while True:
+            try:
+                fetched = await self.fetch_once(url, headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                if retry >= max_retries:
+                    raise
+                logger.info("Retry fetch", url=url, retry=retry, error=repr(exc))
+            else:
+                if fetched.status_code not in RETRYABLE_STATUSES or retry >= max_retries:
+                    break
+                logger.info("Retry fetch", url=url, retry=retry, status=fetched.status_code)
+                fetched.close()
+
+            await asyncio.sleep(random.uniform(0, min(RETRY_MAX, self.blackcat.retry_backoff * 2 ** retry)))
+            retry += 1
+
+        if check_status:
+            # 条件付きリクエストの304はエラーではない
+            if fetched.status_code != 200 and not (headers and fetched.status_code == 304):
+                fetched.close()
+                raise BadStatusCode(fetched.status_code, url)
+        return fetched
+
+    async def fetch_once(self, url: URL, headers: Optional[Mapping[str, str]]) -> FetchedContent:
+        loop = asyncio.get_event_loop()
+        metrics = self.blackcat.metrics
+        host = url.host or ""
+        # ホストにアクセスする間隔と同時接続数はrate_limiterで制限し、結果を伝えて間隔を調整させる
+        async with self.rate_limiter.acquire(url) as slot:
+            start = loop.time()
+            responded = False
+            try:
+                async with self.aio_session.get(url, headers=headers) as resp:
+                    responded = True
+                    latency = loop.time() - start
+                    slot.feedback(resp.status, latency, parse_retry_after(resp.headers.get("Retry-After")))
+                    metrics.inc(HTTP_REQUESTS, host=host, status=str(resp.status))
+                    metrics.observe(HTTP_REQUEST_SECONDS, latency, host=host)
+
+                    fetched = FetchedContent(resp.status, resp.headers, await self.read_body(url, resp))
+                    metrics.inc(HTTP_RESPONSE_BYTES, fetched.size, host=host)
+                    return fetched
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not responded:
+                    slot.feedback(None, loop.time() - start)
+                    metrics.inc(HTTP_REQUESTS, host=host, status="error")
+                raise
+
+    async def read_body(self, url: URL, resp: aiohttp.ClientResponse) -> IO[bytes]:
+        """
+        レスポンスのbodyを少しずつ読んで、一時ファイルに貯める
 
-        # crawl and parse
-        async with self.aio_session.get(url) as resp:
-            if check_status:
-                if resp.status != 200:
-                    raise BadStatusCode(resp.status, url)
+        spool_thresholdを超えるまではメモリ上、超えたらディスクに置く. max_body_sizeを超えたらContentTooLarge
+        """
+        max_body_size = self.blackcat.max_body_size
+        if max_body_size is not None and resp.content_length is not None and resp.content_length > max_body_size:
+            raise ContentTooLarge(resp.content_length, url)
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.blackcat.spool_threshold)
+        try:
+            size = 0
+            async for chunk in resp.content.iter_chunked(READ_CHUNK_SIZE):
+                size += len(chunk)
+                if max_body_size is not None and size > max_body_size:
+                    raise ContentTooLarge(size, url)
+                body.write(chunk)
+        except BaseException:
+            body.close()
+            raise
 
-            return FetchedContent(resp.status, resp.headers, await resp.read())
+        body.seek(0)
+        return cast("IO[bytes]", body)
+
+
+def close_content(task: asyncio.Future[Content]) -> None:
+    """取得したContentの一時ファイルを消す. メモリに読んだbodyはそのまま使える"""
+    if task.cancelled() or task.exception() is not None:
+        return
+    content = task.result()
+    if isinstance(content, FetchedContent):
+        content.close()
 
 
 # SessionContext
@@ -134,38 +346,110 @@ SessionAttrValueT = TypeVar("SessionAttrValueT")
 
 
 class SessionContext:
+    """
+    plannerの状態. ContextStoreに保存される
+
+    write_throughでなければ、setは変更を貯めるだけで、flush_interval秒毎かflush_threshold回変更されたら保存する.
+    sessionのclose時には必ず保存する. 保存は1つずつ行い、保存中のflushはそれが終わるのを待つ
+    """
+
     session: BlackcatSession
     store: ContextStore
     context_name: str
-    _data: Mapping[str, Any]
+    write_through: bool
+    flush_interval: Optional[float]
+    flush_threshold: int
+    dirty_count: int
+    flush_handle: Optional[asyncio.TimerHandle]
+    flush_lock: asyncio.Lock
+    _data: Dict[str, Any]
 
-    def __init__(self, session: BlackcatSession, store: ContextStore, context_name: str):
+    def __init__(
+        self,
+        session: BlackcatSession,
+        store: ContextStore,
+        context_name: str,
+        write_through: bool = True,
+        flush_interval: Optional[float] = None,
+        flush_threshold: int = 1,
+    ):
         self.session = session
         self.store = store
         self.context_name = context_name
+        self.write_through = write_through
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.dirty_count = 0
+        self.flush_handle = None
+        self.flush_lock = asyncio.Lock()
 
     # public
     async def get(self, attr: str, default: Optional[SessionAttrValueT] = None) -> SessionAttrValueT:
         rv = self._data.get(attr, default)
         return cast(SessionAttrValueT, rv)
 
-    async def set(self, attr: str, value: SessionAttrValueT) -> None:
-        self._data[attr] = value  # type: ignore
-        await self.save()
+    async def set(self, attr: str, value: SessionAttrValueT, *, flush: bool = False) -> None:
+        """値をセットする. flush=Trueならすぐに保存する"""
+        await self.update({attr: value}, flush=flush)
+
+    async def update(self, values: Mapping[str, Any], *, flush: bool = False) -> None:
+        """複数の値をまとめてセットする. flush=Trueならすぐに保存する"""
+        self._data.update(values)
+        self.dirty_count += 1
+
+        if flush or self.write_through or self.dirty_count >= self.flush_threshold:
+            await self.flush()
+        elif self.flush_interval is not None and self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush_in_background)
+
+    set_many = update
+
+    async def flush(self) -> None:
+        """変更があれば保存する"""
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        # バックグラウンドなどで保存中なら、それが終わってから残りを保存する.
+        # dirty_countが0でも保存中のものを待つので、close時に保存途中のままStoreを閉じない
+        async with self.flush_lock:
+            if not self.dirty_count:
+                return
+
+            dirty_count, self.dirty_count = self.dirty_count, 0
+            try:
+                await self.save()
+            except BaseException:
+                self.dirty_count += dirty_count
+                raise
 
     # internal
     async def load(self) -> None:
         try:
-            data = await self.store.load(self.session, self.context_name)
-            logger.info("Load context", context=self.context_name, data=repr(data))
+            with self.session.blackcat.metrics.time(CONTEXT_STORE_SECONDS, operation="load"):
+                data = await self.store.load(self.session, self.context_name)
+            logger.info("Load context", context=self.context_name)
+            logger.debug("Loaded context", context=self.context_name, data=repr(data))
         except ContextNotFoundError:
             data = {}
             logger.info("Context not found", context=self.context_name)
-        self._data = data
+        self._data = dict(data)
 
     async def save(self) -> None:
-        logger.info("Save context", context=self.context_name, data=repr(self._data))
-        await self.store.save(self.session, self.context_name, self._data)
+        logger.info("Save context", context=self.context_name)
+        logger.debug("Saved context", context=self.context_name, data=repr(self._data))
+        with self.session.blackcat.metrics.time(CONTEXT_STORE_SECONDS, operation="save"):
+            await self.store.save(self.session, self.context_name, dict(self._data))
+
+    # private
+    def flush_in_background(self) -> None:
+        self.flush_handle = None
+        task = asyncio.ensure_future(self.flush())
+        task.add_done_callback(self.log_flush_error)
+
+    def log_flush_error(self, task: asyncio.Future[None]) -> None:
+        if not task.cancelled() and task.exception():
+            logger.error("Flush context failed", context=self.context_name, exc_info=task.exception())
 
 
 # ContentParser
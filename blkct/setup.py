@@ -3,6 +3,8 @@ from __future__ import annotations
 import re
 from typing import NamedTuple, TYPE_CHECKING, TypeVar, cast
 
+from .router import ContentParserRouter
+
 if TYPE_CHECKING:
     from typing import Callable, List, Dict, Optional, Pattern, Tuple, Union
 
@@ -54,7 +56,7 @@ class BlackcatSetup:
         self.content_parsers.append(ContentParserEntry(pattern, f))
 
 
-def merge_setups(setups: List[BlackcatSetup]) -> Tuple[Dict[str, PlannerType], List[ContentParserEntry]]:
+def merge_setups(setups: List[BlackcatSetup]) -> Tuple[Dict[str, PlannerType], ContentParserRouter]:
     planners: Dict[str, PlannerType] = {}
     content_parsers: List[ContentParserEntry] = []
 
@@ -66,4 +68,4 @@ def merge_setups(setups: List[BlackcatSetup]) -> Tuple[Dict[str, PlannerType], L
         planners.update(setup.planners)
         content_parsers.extend(setup.content_parsers)
 
-    return planners, content_parsers
+    return planners, ContentParserRouter(content_parsers)
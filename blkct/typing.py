@@ -8,6 +8,7 @@ from yarl import URL
 from .content_store.content import Content, FetchedContent, StoredContent
 
 if TYPE_CHECKING:
+    from .blackcat import Blackcat
     from .session import BlackcatSession
 
 __all__ = (
@@ -42,6 +43,13 @@ class Scheduler(metaclass=abc.ABCMeta):
     async def run(self) -> None:
         raise NotImplementedError
 
+    async def start(self, blackcat: Blackcat, session_id: str) -> None:
+        """sessionのContent Store, Context Store, aiohttpのsessionを作る前に呼ばれる"""
+        pass
+
+    async def close(self) -> None:
+        pass
+
 
 class ContentStore(metaclass=abc.ABCMeta):
     """
@@ -56,6 +64,9 @@ class ContentStore(metaclass=abc.ABCMeta):
     async def push_content(self, session: BlackcatSession, url: URL, content: FetchedContent) -> None:
         raise NotImplementedError
 
+    async def close(self) -> None:
+        pass
+
 
 class ContextStore(metaclass=abc.ABCMeta):
     """
@@ -20,6 +20,7 @@ setup(
         ],
     },
     extras_require={
+        'zstd': ['zstandard'],
         'dev': [
             'coverage',
             'flake8',
@@ -29,6 +30,7 @@ setup(
             'pipenv',
             'autopep8',
             'isort',
+            'moto',
         ],
     }
 )
@@ -0,0 +1,58 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from blkct.metrics import PLANNER_QUEUE_DEPTH, MetricsRegistry
+from blkct.scheduler.asyncio_scheduler import AsyncIOScheduler
+
+
+class DummySession:
+    def __init__(self, scheduler):
+        self.blackcat = SimpleNamespace(metrics=MetricsRegistry())
+        self.scheduler = scheduler
+        self.handled = []
+        self.running = 0
+        self.max_running = 0
+
+    async def handle_planner(self, planner, args):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if planner == "index":
+                for i in range(args["fanout"]):
+                    await self.scheduler.dispatch(self, "detail", {"i": i}, {})
+            elif planner == "fail":
+                raise RuntimeError("fail")
+            self.handled.append((planner, dict(args)))
+        finally:
+            self.running -= 1
+
+
+def test_run_with_workers():
+    async def main():
+        scheduler = AsyncIOScheduler(num_workers=4)
+        session = DummySession(scheduler)
+        await scheduler.dispatch(session, "index", {"fanout": 10}, {})
+        await scheduler.run()
+        return session
+
+    session = asyncio.run(main())
+    assert len(session.handled) == 11
+    assert session.max_running == 4
+    assert session.blackcat.metrics.gauges == {
+        (PLANNER_QUEUE_DEPTH, (("planner", "detail"),)): 0,
+        (PLANNER_QUEUE_DEPTH, (("planner", "index"),)): 0,
+    }
+
+
+def test_run_reraises_planner_error():
+    async def main():
+        scheduler = AsyncIOScheduler(num_workers=2)
+        session = DummySession(scheduler)
+        await scheduler.dispatch(session, "fail", {}, {})
+        await scheduler.run()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main())
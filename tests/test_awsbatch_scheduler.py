@@ -0,0 +1,112 @@
+import asyncio
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from botocore.exceptions import ClientError
+
+from blkct.exceptions import JobSubmissionError
+from blkct.metrics import PLANNER_QUEUE_DEPTH, MetricsRegistry
+from blkct.scheduler import awsbatch_scheduler
+from blkct.scheduler.awsbatch_scheduler import PACKED_PLANNER, AWSBatchScheduler
+
+
+class DummyBatchClient:
+    def __init__(self, throttle=0, fail_planner=None):
+        self.throttle = throttle
+        self.fail_planner = fail_planner
+        self.submitted = []
+        self.parameters = []
+        self.lock = threading.Lock()
+
+    def submit_job(self, jobName, parameters, **kwargs):
+        with self.lock:
+            if self.throttle:
+                self.throttle -= 1
+                raise ClientError({"Error": {"Code": "TooManyRequestsException"}}, "SubmitJob")
+            if parameters["planner"] == self.fail_planner:
+                raise ClientError({"Error": {"Code": "ClientException"}}, "SubmitJob")
+            self.submitted.append(jobName)
+            self.parameters.append(parameters)
+        return {"jobId": jobName}
+
+
+class DummySession:
+    session_id = "test"
+
+    def __init__(self, scheduler, children):
+        self.blackcat = SimpleNamespace(metrics=MetricsRegistry())
+        self.scheduler = scheduler
+        self.children = children
+        self.handled = []
+
+    async def handle_planner(self, planner, args):
+        self.handled.append((planner, args))
+        if planner == "index":
+            for planner, args in self.children:
+                await self.scheduler.dispatch(self, planner, args, {})
+
+
+def test_submit_in_background(monkeypatch):
+    monkeypatch.setattr(awsbatch_scheduler, "SUBMIT_RETRY_BASE", 0.001)
+    client = DummyBatchClient(throttle=3)
+    scheduler = AWSBatchScheduler("definition", "queue", batch_client=client)
+    children = [("detail", {"i": i}) for i in range(50)] + [("detail", {"i": 0})]
+    session = DummySession(scheduler, children)
+
+    async def main():
+        await scheduler.dispatch(session, "index", {}, {})
+        await scheduler.run()
+
+    asyncio.run(main())
+    # 同じjobNameは1回だけ
+    assert len(client.submitted) == 50
+    assert len(set(client.submitted)) == 50
+
+
+def test_submission_failures_are_aggregated():
+    client = DummyBatchClient(fail_planner="bad")
+    scheduler = AWSBatchScheduler("definition", "queue", batch_client=client)
+    children = [("bad", {"i": i}) for i in range(3)] + [("good", {})]
+    session = DummySession(scheduler, children)
+
+    async def main():
+        await scheduler.dispatch(session, "index", {}, {})
+        await scheduler.run()
+
+    with pytest.raises(JobSubmissionError) as excinfo:
+        asyncio.run(main())
+    assert "3 of 4" in str(excinfo.value)
+    assert len(client.submitted) == 1
+
+
+def test_pack_jobs():
+    client = DummyBatchClient()
+    scheduler = AWSBatchScheduler("definition", "queue", pack_size=10, batch_client=client)
+    session = DummySession(scheduler, [("detail", {"i": i}) for i in range(25)])
+
+    async def main():
+        await scheduler.dispatch(session, "index", {}, {})
+        await scheduler.run()
+
+    asyncio.run(main())
+    assert len(client.submitted) == 3
+    assert all(p["planner"] == PACKED_PLANNER for p in client.parameters)
+
+    # まとめたJobは、中身をそのプロセスで処理する
+    args = json.loads(client.parameters[0]["args"])
+    scheduler = AWSBatchScheduler("definition", "queue", batch_client=DummyBatchClient())
+    session = DummySession(scheduler, [])
+
+    async def run_packed():
+        await scheduler.dispatch(session, PACKED_PLANNER, args, {})
+        await scheduler.run()
+
+    asyncio.run(run_packed())
+    assert session.handled == [("detail", {"i": i}) for i in range(10)]
+    # Jobとして投げたものは数えず、このプロセスで処理するものだけ数える
+    assert session.blackcat.metrics.gauges == {
+        (PLANNER_QUEUE_DEPTH, (("planner", PACKED_PLANNER),)): 0,
+        (PLANNER_QUEUE_DEPTH, (("planner", "detail"),)): 0,
+    }
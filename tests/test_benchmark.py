@@ -0,0 +1,49 @@
+from blkct.benchmark import SiteConfig, run_benchmark
+
+
+def test_site_links():
+    config = SiteConfig(pages=20, fanout=3)
+    assert config.get_links(0) == [1, 2, 3]
+    assert config.get_links(6) == [19]
+    assert config.get_links(7) == []
+
+
+def test_run_benchmark():
+    config = SiteConfig(pages=30, fanout=4, page_size=2048, latency=0, error_rate=0.02)
+    result = run_benchmark(config, ["asyncio", "multiprocess"], ["file"], ["file"], concurrency=4)
+
+    assert result["site"]["pages"] == 30
+    asyncio_case, multiprocess_case = result["cases"]
+    assert multiprocess_case["skipped"]
+
+    cold, warm = asyncio_case["cold"], asyncio_case["warm"]
+    assert cold["pages"] == warm["pages"] == 30
+    assert cold["requests"] == 30 + cold["failed_requests"]
+    assert cold["bytes_fetched"] >= 30 * 2048
+    assert cold["fetch_latency_p50"] <= cold["fetch_latency_p99"]
+    # 2回目はContent Storeから読む
+    assert warm["requests"] == 0
+    assert warm["content_store"]["hits"] == 30
+    assert asyncio_case["peak_rss"] > 0
+
+
+def test_skip_warm_run_with_process_local_stores():
+    config = SiteConfig(pages=10, fanout=3, page_size=256, latency=0)
+    result = run_benchmark(config, ["multiprocess"], ["memory"], ["memory"], concurrency=2)
+
+    (case,) = result["cases"]
+    assert case["cold"]["pages"] == 10
+    assert "warm" not in case
+    assert case["warm_skipped"]
+
+
+def test_run_benchmark_with_high_error_rate():
+    config = SiteConfig(pages=100, fanout=4, page_size=256, latency=0, error_rate=0.3, seed=1)
+    result = run_benchmark(config, ["asyncio"], ["memory"], ["memory"], concurrency=4, retry_backoff=0)
+
+    (case,) = result["cases"]
+    assert "error" not in case
+    cold = case["cold"]
+    # retryしても503だったページは数えて先に進む
+    assert cold["failed_pages"] > 0
+    assert cold["failed_requests"] > 0
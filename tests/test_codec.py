@@ -0,0 +1,32 @@
+import io
+
+import pytest
+
+from blkct.content_store.codec import CODECS, get_codec, is_compressible
+
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_roundtrip(name, tmp_path):
+    codec = get_codec(name, 1)
+    body = b"<html>" + b"blackcat " * 10000 + b"</html>"
+
+    path = tmp_path / "body"
+    with open(path, "wb") as fp:
+        assert codec.compress_stream(io.BytesIO(body), fp) == len(body)
+
+    assert codec.decompress(path.read_bytes()) == body
+    with codec.open_file(str(path)) as fp:
+        assert fp.read() == body
+
+
+def test_get_codec_unknown():
+    with pytest.raises(ValueError):
+        get_codec("unknown")
+
+
+def test_is_compressible():
+    assert is_compressible("text/html; charset=utf-8")
+    assert is_compressible("application/json")
+    assert is_compressible("image/svg+xml")
+    assert not is_compressible("image/jpeg")
+    assert not is_compressible("application/zip")
@@ -0,0 +1,19 @@
+from blkct.content_store.content import StoredContent
+
+HTML = b"<html><head><title>t</title></head><body><a href='/a'>a</a><p>p</p></body></html>"
+
+
+def test_parsed_html_is_cached():
+    content = StoredContent("text/html", HTML)
+    soup = content.parsed_html
+    assert soup is content.parsed_html
+    assert soup.title.string == "t"
+
+
+def test_parse_html_only():
+    content = StoredContent("text/html", HTML)
+    soup = content.parse_html(only=["a"])
+    assert [a["href"] for a in soup.find_all("a")] == ["/a"]
+    assert soup.find("p") is None
+    assert soup is content.parse_html(only=("a",))
+    assert soup is not content.parsed_html
@@ -0,0 +1,70 @@
+import asyncio
+
+import boto3
+import pytest
+
+from blkct.context_store.dynamodb_context_store import DynamoDBContextStore
+from blkct.exceptions import ContextNotFoundError
+
+moto = pytest.importorskip("moto")
+
+
+@pytest.fixture
+def dynamodb(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName="blkct-test",
+            KeySchema=[{"AttributeName": "key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        yield
+
+
+def test_save_and_load(dynamodb):
+    async def main():
+        store = DynamoDBContextStore("blkct-test", batch_window=0.01)
+        try:
+            with pytest.raises(ContextNotFoundError):
+                await store.load(None, "a")
+
+            await asyncio.gather(
+                *[store.save(None, "a", {"count": i}) for i in range(10)],
+                *[store.save(None, f"key{i}", {"value": "x"}) for i in range(40)],
+            )
+            assert await store.load(None, "a") == {"count": 9}
+            assert await store.load(None, "key39") == {"value": "x"}
+        finally:
+            await store.close()
+
+        # 書き込まれていることを別のstoreで確かめる
+        other = DynamoDBContextStore("blkct-test")
+        assert await other.load(None, "a") == {"count": 9}
+        await other.close()
+
+    asyncio.run(main())
+
+
+# 始まる前と、batch_windowを待っている間
+@pytest.mark.parametrize("delay", [0, 0.01])
+def test_cancel_flusher(dynamodb, delay):
+    async def main():
+        store = DynamoDBContextStore("blkct-test", batch_window=0.05)
+        try:
+            saving = asyncio.ensure_future(store.save(None, "a", {"count": 1}))
+            await asyncio.sleep(delay)
+            store.flusher.cancel()
+            # 書けなかったsaveは待ち続けずにcancelされる
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(saving, 1)
+
+            # 次のsaveは新しく書き込む
+            await store.save(None, "a", {"count": 2})
+            assert await store.load(None, "a") == {"count": 2}
+        finally:
+            await store.close()
+
+    asyncio.run(main())
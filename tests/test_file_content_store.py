@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from blkct.content_store.codec import get_codec
+from blkct.content_store.content import FetchedContent
+from blkct.content_store.file_content_store import INDEX_FILENAME, FileContentStore
+
+
+class DummySession:
+    session_id = "test"
+
+
+def make_content(content_type, body):
+    return FetchedContent(200, CIMultiDictProxy(CIMultiDict({"Content-Type": content_type})), body)
+
+
+def test_push_and_pull(tmp_path):
+    async def main():
+        store = FileContentStore(str(tmp_path))
+        session = DummySession()
+        url = URL("http://example.com/a/b?c=d")
+
+        assert await store.pull_content(session, url) is None
+        await store.push_content(session, url, make_content("text/html", b"<html></html>"))
+        content = await store.pull_content(session, url)
+        assert content.content_type == "text/html"
+        assert content.body == b"<html></html>"
+
+        # prefixが同じ別のURLにはマッチしない
+        assert await store.pull_content(session, URL("http://example.com/a")) is None
+
+        # 別のstore(プロセス)からも見える
+        other = FileContentStore(str(tmp_path))
+        content = await other.pull_content(session, url)
+        assert content.body == b"<html></html>"
+
+    asyncio.run(main())
+
+
+def test_rebuild_index(tmp_path):
+    async def main():
+        store = FileContentStore(str(tmp_path))
+        session = DummySession()
+        url = URL("http://example.com/image")
+        await store.push_content(session, url, make_content("image/png", b"png"))
+
+        os.remove(tmp_path / "test" / INDEX_FILENAME)
+        content = await FileContentStore(str(tmp_path)).pull_content(session, url)
+        assert content.content_type == "image/png"
+        assert content.body == b"png"
+
+    asyncio.run(main())
+
+
+def test_push_and_pull_compressed(tmp_path):
+    async def main():
+        store = FileContentStore(str(tmp_path), codec=get_codec("gzip"))
+        session = DummySession()
+        html, image = URL("http://example.com/html"), URL("http://example.com/image")
+        await store.push_content(session, html, make_content("text/html", b"<html></html>" * 100))
+        await store.push_content(session, image, make_content("image/png", b"png"))
+
+        assert os.path.exists(tmp_path / "test" / "http:example.com:80" / "html.html.gz")
+        assert os.path.exists(tmp_path / "test" / "http:example.com:80" / "image.png")
+
+        content = await FileContentStore(str(tmp_path)).pull_content(session, html)
+        assert content.body == b"<html></html>" * 100
+        content = await FileContentStore(str(tmp_path)).pull_content(session, image)
+        assert content.body == b"png"
+
+    asyncio.run(main())
+
+
+def test_content_addressed_read_through(tmp_path):
+    async def main():
+        store = FileContentStore(str(tmp_path), content_addressed=True, read_through_window=60)
+        first, second = DummySession(), DummySession()
+        second.session_id = "test2"
+        a, b = URL("http://example.com/a"), URL("http://example.com/b")
+
+        await store.push_content(first, a, make_content("text/html", b"same"))
+        await store.push_content(first, b, make_content("text/html", b"same"))
+        # 同じbodyは1つだけ置く
+        assert len(os.listdir(tmp_path / "_objects")) == 1
+
+        # 他のsessionで保存したものを使い、今のsessionのindexにも入れる
+        content = await store.pull_content(second, a)
+        assert content.body == b"same"
+        assert os.path.exists(tmp_path / "test2" / INDEX_FILENAME)
+
+        # windowを過ぎたものは使わない
+        stale = FileContentStore(str(tmp_path), content_addressed=True, read_through_window=0)
+        third = DummySession()
+        third.session_id = "test3"
+        assert await stale.pull_content(third, b) is None
+
+        # URL毎に最後に保存したものだけを指す. indexのように伸び続けない
+        fourth = DummySession()
+        fourth.session_id = "test4"
+        await store.push_content(fourth, b, make_content("text/html", b"updated"))
+        assert not os.path.exists(tmp_path / "_latest" / INDEX_FILENAME)
+        assert sorted(os.listdir(tmp_path / "_latest" / "http:example.com:80")) == ["a.json", "b.json"]
+        fifth = DummySession()
+        fifth.session_id = "test5"
+        content = await FileContentStore(str(tmp_path), read_through_window=60).pull_content(fifth, b)
+        assert content.body == b"updated"
+
+    asyncio.run(main())
@@ -0,0 +1,83 @@
+import asyncio
+import json
+import stat
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import unused_port
+
+from blkct.metrics import Histogram, MetricsExporter, MetricsRegistry
+
+
+def test_histogram_quantile():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.05, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    assert histogram.quantile(0.99) == float("inf")
+
+
+def test_prometheus_text():
+    registry = MetricsRegistry()
+    registry.inc("blkct_http_requests_total", host="a.test", status="200")
+    registry.inc("blkct_http_requests_total", host="a.test", status="200")
+    registry.set_gauge("blkct_planner_queue_depth", 3, planner='say "hi"')
+    registry.observe("blkct_http_request_seconds", 0.2, host="a.test")
+
+    text = registry.to_prometheus()
+    assert "# TYPE blkct_http_requests_total counter\n" in text
+    assert 'blkct_http_requests_total{host="a.test",status="200"} 2\n' in text
+    assert 'blkct_planner_queue_depth{planner="say \\"hi\\""} 3\n' in text
+    assert 'blkct_http_request_seconds_bucket{host="a.test",le="0.1"} 0\n' in text
+    assert 'blkct_http_request_seconds_bucket{host="a.test",le="0.25"} 1\n' in text
+    assert 'blkct_http_request_seconds_bucket{host="a.test",le="+Inf"} 1\n' in text
+    assert 'blkct_http_request_seconds_count{host="a.test"} 1\n' in text
+
+
+def test_merge_json():
+    a, b = MetricsRegistry(), MetricsRegistry()
+    for registry in (a, b):
+        registry.inc("requests", host="a.test")
+        registry.add_gauge("depth", -1, planner="p")
+        registry.observe("seconds", 0.2)
+
+    a.merge(json.loads(json.dumps(b.to_json())))
+    assert a.counters[("requests", (("host", "a.test"),))] == 2
+    assert a.gauges[("depth", (("planner", "p"),))] == -2
+    assert a.histograms[("seconds", ())].count == 2
+
+    with pytest.raises(ValueError):
+        other = MetricsRegistry()
+        other.histograms[("seconds", ())] = Histogram((1.0,))
+        other.merge(a.to_json())
+
+
+def test_exporter_serves_and_writes(tmp_path):
+    registry = MetricsRegistry()
+    registry.inc("blkct_http_requests_total", host="a.test", status="200")
+
+    async def main():
+        port = unused_port()
+        exporter = MetricsExporter(
+            registry,
+            prometheus_path=str(tmp_path / "metrics.prom"),
+            json_path=str(tmp_path / "metrics.json"),
+            port=port,
+        )
+        await exporter.start()
+        try:
+            async with aiohttp.ClientSession() as client:
+                async with client.get(f"http://127.0.0.1:{port}/metrics") as resp:
+                    text = await resp.text()
+        finally:
+            await exporter.stop()
+        return text
+
+    text = asyncio.run(main())
+    assert 'blkct_http_requests_total{host="a.test",status="200"} 1' in text
+    assert (tmp_path / "metrics.prom").read_text() == text
+    assert json.loads((tmp_path / "metrics.json").read_text())["counters"][0]["value"] == 1
+    # node_exporterなど別ユーザーからも読める
+    assert stat.S_IMODE((tmp_path / "metrics.prom").stat().st_mode) == 0o644
@@ -0,0 +1,84 @@
+import asyncio
+import os
+
+import pytest
+
+from blkct.blackcat import Blackcat
+from blkct.context_store.file_context_store import FileContextStore
+from blkct.exceptions import CrawlerError
+from blkct.metrics import PLANNER_QUEUE_DEPTH, PLANNER_SECONDS
+from blkct.scheduler.multiprocess_scheduler import MultiprocessScheduler
+from blkct.typing import ContentStore, ContextStore
+
+
+class NullContentStore(ContentStore):
+    async def pull_content(self, session, url):
+        return None
+
+    async def push_content(self, session, url, content):
+        pass
+
+
+class NullContextStore(ContextStore):
+    async def close(self):
+        pass
+
+    async def load(self, session, key):
+        return {}
+
+    async def save(self, session, key, data):
+        pass
+
+
+def make_blackcat(planners, num_processes):
+    return Blackcat(
+        planners=planners,
+        content_parsers=[],
+        scheduler_factory=lambda: MultiprocessScheduler(num_processes=num_processes, num_workers=2),
+        content_store_factory=NullContentStore,
+        context_store_factory=NullContextStore,
+    )
+
+
+def test_run_planners_in_worker_processes(tmp_path):
+    output = tmp_path / "handled"
+
+    async def index(session, fanout):
+        for i in range(fanout):
+            await session.dispatch("detail", {"i": i})
+
+    async def detail(session, i):
+        await asyncio.sleep(0.01)
+        with open(output, "a") as fp:
+            fp.write(f"{os.getpid()} {i}\n")
+
+    blackcat = make_blackcat({"index": index, "detail": detail}, 2)
+    asyncio.run(blackcat.run_with_session("index", {"fanout": 20}, "test"))
+
+    lines = [line.split() for line in output.read_text().splitlines()]
+    assert sorted(int(i) for _, i in lines) == list(range(20))
+    assert os.getpid() not in {int(pid) for pid, _ in lines}
+
+    # 各プロセスのメトリクスは親に集まる
+    planner_seconds = blackcat.metrics.histograms[(PLANNER_SECONDS, (("planner", "detail"),))]
+    assert planner_seconds.count == 20
+    assert blackcat.metrics.gauges[(PLANNER_QUEUE_DEPTH, (("planner", "detail"),))] == 0
+
+
+def test_planner_error_stops_processes():
+    async def fail(session):
+        raise RuntimeError("fail")
+
+    blackcat = make_blackcat({"fail": fail}, 2)
+    with pytest.raises(CrawlerError):
+        asyncio.run(blackcat.run_with_session("fail", {}, "test"))
+
+
+def test_reject_file_context_store(tmp_path):
+    async def index(session):
+        pass
+
+    blackcat = make_blackcat({"index": index}, 1)
+    blackcat.context_store_factory = lambda: FileContextStore(str(tmp_path / "context"))
+    with pytest.raises(CrawlerError, match="FileContextStore"):
+        asyncio.run(blackcat.run_with_session("index", {}, "test"))
@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from blkct import CrawlPrioirty
+from blkct.metrics import MetricsRegistry
+from blkct.scheduler.priority_scheduler import PriorityScheduler, get_priority
+
+
+class DummySession:
+    def __init__(self):
+        self.blackcat = SimpleNamespace(metrics=MetricsRegistry())
+        self.handled = []
+
+    async def handle_planner(self, planner, args):
+        self.handled.append(planner)
+
+
+def test_get_priority():
+    assert get_priority({}) == CrawlPrioirty.default
+    assert get_priority({"priority": CrawlPrioirty.image}) == CrawlPrioirty.image
+    assert get_priority({"priority": "high"}) == CrawlPrioirty.high
+    assert get_priority({"priority": 10}) == 10
+    with pytest.raises(ValueError):
+        get_priority({"priority": "unknown"})
+
+
+def test_run_in_priority_order():
+    async def main():
+        scheduler = PriorityScheduler()
+        session = DummySession()
+        await scheduler.dispatch(session, "image1", {}, {"priority": CrawlPrioirty.image})
+        await scheduler.dispatch(session, "default1", {}, {})
+        await scheduler.dispatch(session, "image2", {}, {"priority": CrawlPrioirty.image})
+        await scheduler.dispatch(session, "high", {}, {"priority": CrawlPrioirty.high})
+        await scheduler.dispatch(session, "default2", {}, {})
+        await scheduler.run()
+        return session
+
+    session = asyncio.run(main())
+    assert session.handled == ["high", "default1", "default2", "image1", "image2"]
@@ -0,0 +1,132 @@
+import asyncio
+import pstats
+import time
+
+from blkct import profiling
+from blkct.blackcat import Blackcat
+from blkct.profiling import PlannerProfiler
+from blkct.scheduler.asyncio_scheduler import AsyncIOScheduler
+from blkct.typing import ContentStore, ContextStore
+
+
+class NullContentStore(ContentStore):
+    async def pull_content(self, session, url):
+        return None
+
+    async def push_content(self, session, url, content):
+        pass
+
+
+class NullContextStore(ContextStore):
+    async def close(self):
+        pass
+
+    async def load(self, session, key):
+        return {}
+
+    async def save(self, session, key, data):
+        pass
+
+
+def make_garbage(n):
+    return [str(i) * 10 for i in range(n)]
+
+
+def spin(n):
+    return sum(i * i for i in range(n))
+
+
+kept = []
+
+
+def test_profile_per_planner(tmp_path):
+    async def index(session):
+        for i in range(3):
+            await session.dispatch("detail", {"i": i})
+        await session.dispatch("heavy", {})
+
+    async def detail(session, i):
+        # 待っている間に他のplannerが動いても、そちらの分は入らない
+        await asyncio.sleep(0.01)
+        spin(1000)
+
+    async def heavy(session):
+        await asyncio.sleep(0)
+        kept.append(make_garbage(10000))
+
+    blackcat = Blackcat(
+        planners={"index": index, "detail": detail, "heavy": heavy},
+        content_parsers=[],
+        scheduler_factory=lambda: AsyncIOScheduler(num_workers=4),
+        content_store_factory=NullContentStore,
+        context_store_factory=NullContextStore,
+        profile_dir=str(tmp_path),
+        profile_memory=True,
+    )
+
+    asyncio.run(blackcat.run_with_session("index", {}, "test"))
+
+    directory = tmp_path / "test"
+    functions = {}
+    for planner in ("index", "detail", "heavy"):
+        (path,) = directory.glob(f"{planner}.*.pstats")
+        functions[planner] = {name for _, _, name in pstats.Stats(str(path)).stats}
+    assert "spin" in functions["detail"]
+    assert "spin" not in functions["heavy"]
+    assert "make_garbage" in functions["heavy"]
+
+    summary = (directory / "summary.txt").read_text()
+    table = {line.split()[0]: line.split()[1:] for line in summary.splitlines()[1:4]}
+    assert table["detail"][0] == "3"
+    assert "== heavy: top allocation sites ==" in summary
+    assert "test_profiling.py" in summary.split("== heavy: top allocation sites ==")[1]
+
+
+def test_summary_does_not_mix_planners_with_same_prefix(tmp_path):
+    async def only_in_a():
+        spin(10)
+
+    async def only_in_a_b():
+        spin(10)
+
+    async def main():
+        profiler = PlannerProfiler(str(tmp_path))
+        await profiler.profile("a", only_in_a())
+        await profiler.profile("a.b", only_in_a_b())
+        profiler.write_stats("test")
+        return profiler.write_summary("test")
+
+    with open(asyncio.run(main())) as fp:
+        summary = fp.read()
+    section = summary.split("== a: top functions ==")[1].split("== a.b: top functions ==")[0]
+    assert "only_in_a" in section
+    assert "only_in_a_b" not in section
+
+
+def test_nested_planners_and_cpu_time(tmp_path):
+    async def inner():
+        # 寝ている間はCPU時間に入らない
+        time.sleep(0.05)
+        spin(10)
+
+    async def outer(profiler):
+        spin(10)
+        await profiler.profile("inner", inner())
+        await asyncio.sleep(0)
+        spin(10)
+
+    async def main():
+        profiler = PlannerProfiler(str(tmp_path))
+        await profiler.profile("outer", outer(profiler))
+        assert profiling.active_profile is None
+        profiler.write_stats("test")
+        return profiler.write_summary("test")
+
+    with open(asyncio.run(main())) as fp:
+        summary = fp.read()
+    table = {line.split()[0]: line.split()[1:] for line in summary.splitlines()[1:3]}
+    wall, cpu = float(table["inner"][1]), float(table["inner"][2])
+    assert wall >= 0.05
+    assert cpu < 0.04
+    section = summary.split("== inner: top functions ==")[1].split("== outer: top functions ==")[0]
+    assert "spin" in section
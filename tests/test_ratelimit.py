@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from yarl import URL
+
+from blkct.exceptions import HostUnavailable
+from blkct.ratelimit import (
+    AdaptiveThrottle,
+    CircuitBreaker,
+    HostLimit,
+    HostRateLimiter,
+    SharedHostRateLimiter,
+    parse_host_limit,
+    parse_retry_after,
+)
+
+
+def test_parse_host_limit():
+    assert parse_host_limit("Example.com=0.5") == ("example.com", HostLimit(0.5, None))
+    assert parse_host_limit("example.com:8080=1/4") == ("example.com:8080", HostLimit(1.0, 4))
+    assert parse_host_limit("example.com=/4") == ("example.com", HostLimit(None, 4))
+    with pytest.raises(ValueError):
+        parse_host_limit("example.com")
+    with pytest.raises(ValueError):
+        parse_host_limit("example.com=fast")
+
+
+def test_get_limit():
+    limiter = HostRateLimiter(
+        2.5, 1, {"example.com": HostLimit(0.5, None), "example.com:8080": HostLimit(None, 3)}
+    )
+    assert limiter.get_limit(("example.com", 80)) == HostLimit(0.5, 1)
+    assert limiter.get_limit(("example.com", 8080)) == HostLimit(2.5, 3)
+    assert limiter.get_limit(("example.org", 443)) == HostLimit(2.5, 1)
+
+
+def test_acquire_spaces_requests_per_host():
+    async def main():
+        limiter = HostRateLimiter(0.05, 4)
+        loop = asyncio.get_event_loop()
+        started = {}
+
+        async def request(url):
+            async with limiter.acquire(URL(url)):
+                started.setdefault(URL(url).host, []).append(loop.time())
+
+        await asyncio.gather(*[request(f"http://{host}/{i}") for host in ("a.test", "b.test") for i in range(3)])
+        return started
+
+    started = asyncio.run(main())
+    for times in started.values():
+        times.sort()
+        assert all(b - a >= 0.045 for a, b in zip(times, times[1:]))
+    # ホストが違えば待たない
+    assert abs(started["a.test"][0] - started["b.test"][0]) < 0.04
+
+
+def test_shared_slots_share_reservations():
+    limiter = SharedHostRateLimiter(1.0, 1)
+    # forkした先のプロセスでは、同じホストに別のslotができる
+    a = limiter.make_slot(("example.com", 80), 1.0, 1)
+    b = limiter.make_slot(("example.com", 80), 1.0, 1)
+    assert a.reserve(100.0) == 100.0
+    assert b.reserve(100.0) == 101.0
+    assert limiter.make_slot(("example.org", 80), 1.0, 1).reserve(100.0) == 100.0
+
+
+def test_adaptive_throttle_aimd():
+    throttle = AdaptiveThrottle(0.5, 10.0, step=0.5)
+    # 速く正常な応答なら少しずつ縮める
+    assert throttle.update(2.5, 200, 0.1) == 2.0
+    assert throttle.update(0.6, 404, 0.1) == 0.5
+    # 429/503, 接続エラーなら倍にする
+    assert throttle.update(2.0, 429, 0.1) == 4.0
+    assert throttle.update(8.0, None, 0.1) == 10.0
+    assert throttle.update(2.0, 500, 0.1) == 2.0
+    # 応答時間が急に増えたら広げる
+    assert throttle.update(2.0, 200, 3.0) == 4.0
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(2, 10.0)
+    breaker.record(False, 0.0)
+    assert breaker.allow(1.0)
+    breaker.record(False, 1.0)
+    assert breaker.is_open(5.0)
+    assert not breaker.allow(5.0)
+    # cooldown後は1つだけ通す
+    assert breaker.allow(11.0)
+    assert not breaker.allow(11.5)
+    breaker.record(True, 12.0)
+    assert breaker.allow(12.0)
+
+
+def test_feedback_honors_retry_after_and_breaker():
+    async def main():
+        limiter = HostRateLimiter(0, 1, breaker_threshold=1, breaker_cooldown=60.0)
+        url = URL("http://a.test/")
+        loop = asyncio.get_event_loop()
+        async with limiter.acquire(url) as slot:
+            slot.feedback(200, 0.01, retry_after=0.05)
+        start = loop.time()
+        async with limiter.acquire(url) as slot:
+            assert loop.time() - start >= 0.04
+            slot.feedback(503, 0.01)
+
+        with pytest.raises(HostUnavailable):
+            async with limiter.acquire(url):
+                pass
+
+    asyncio.run(main())
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("soon") is None
+    assert parse_retry_after(None) is None
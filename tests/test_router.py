@@ -0,0 +1,66 @@
+import re
+
+import pytest
+from yarl import URL
+
+from blkct.router import ContentParserRouter, pattern_authority
+from blkct.setup import BlackcatSetup, ContentParserEntry, merge_setups
+
+
+@pytest.mark.parametrize(
+    "pattern, authority",
+    [
+        (r"https?://example\.com/(?P<id>\d+)", "example.com"),
+        (r"^(?:http|https)://Example\.com:8080/", "example.com:8080"),
+        (r"https://[a-z]+\.example\.com/", None),
+        (r"https://example.com/", None),  # `.`はリテラルではない
+        (r"https://example\.com", None),
+        (r".*://example\.com/", None),
+    ],
+)
+def test_pattern_authority(pattern, authority):
+    assert pattern_authority(re.compile(pattern)) == authority
+
+
+def test_match():
+    def a(url, params, content):
+        pass
+
+    def b(url, params, content):
+        pass
+
+    def c(url, params, content):
+        pass
+
+    router = ContentParserRouter(
+        [
+            ContentParserEntry(re.compile(r"https?://a\.example\.com/(?P<id>\d+)$"), a),
+            ContentParserEntry(re.compile(r"https?://b\.example\.com/"), b),
+            ContentParserEntry(re.compile(r"https?://[a-z]+\.example\.com/(?P<name>[a-z]+)$"), c),
+        ]
+    )
+    assert router.match(URL("http://a.example.com/10")) == (a, {"id": "10"})
+    assert router.match(URL("http://c.example.com/foo")) == (c, {"name": "foo"})
+    with pytest.raises(Exception, match="No parser"):
+        router.match(URL("http://a.example.com/foo/bar"))
+    with pytest.raises(Exception, match="Multiple parser"):
+        router.match(URL("http://b.example.com/foo"))
+    # キャッシュしてもparamsは別のdict
+    router.match(URL("http://a.example.com/10"))[1]["id"] = "x"
+    assert router.match(URL("http://a.example.com/10")) == (a, {"id": "10"})
+    # キャッシュしても例外は毎回新しく作る
+    errors = []
+    for _ in range(2):
+        with pytest.raises(Exception, match="No parser") as excinfo:
+            router.match(URL("http://a.example.com/foo/bar"))
+        errors.append(excinfo.value)
+    assert errors[0] is not errors[1]
+
+
+def test_merge_setups_rejects_duplicated_pattern():
+    setups = [BlackcatSetup(), BlackcatSetup()]
+    for setup in setups:
+        setup.register_content_parser_func(r"https://example\.com/", 0, lambda url, params, content: None)
+
+    with pytest.raises(ValueError):
+        merge_setups(setups)
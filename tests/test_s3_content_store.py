@@ -0,0 +1,72 @@
+import asyncio
+
+import boto3
+import pytest
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from blkct.content_store.content import FetchedContent
+from blkct.content_store.s3_content_store import S3ContentStore
+
+moto = pytest.importorskip("moto")
+
+
+class DummySession:
+    session_id = "test"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        boto3.client("s3").create_bucket(Bucket="blkct-test")
+        yield
+
+
+def test_push_and_pull(s3):
+    async def main():
+        store = S3ContentStore("blkct-test", "contents/")
+        session = DummySession()
+        url = URL("http://example.com/a?b=c")
+        try:
+            assert await store.pull_content(session, url) is None
+
+            headers = CIMultiDictProxy(CIMultiDict({"Content-Type": "text/html"}))
+            await asyncio.gather(
+                *[store.push_content(session, url / str(i), FetchedContent(200, headers, b"x")) for i in range(8)],
+                store.push_content(session, url, FetchedContent(200, headers, b"<html></html>")),
+            )
+
+            content = await store.pull_content(session, url)
+            assert content.content_type == "text/html"
+            assert content.body == b"<html></html>"
+        finally:
+            await store.close()
+
+    asyncio.run(main())
+
+
+def test_content_addressed_read_through(s3):
+    async def main():
+        store = S3ContentStore("blkct-test", "contents/", content_addressed=True, read_through_window=60)
+        first, second = DummySession(), DummySession()
+        second.session_id = "test2"
+        headers = CIMultiDictProxy(CIMultiDict({"Content-Type": "text/html"}))
+        try:
+            await store.push_content(first, URL("http://example.com/a"), FetchedContent(200, headers, b"same"))
+            await store.push_content(first, URL("http://example.com/b"), FetchedContent(200, headers, b"same"))
+            objects = boto3.client("s3").list_objects_v2(Bucket="blkct-test", Prefix="contents/_objects/")
+            assert objects["KeyCount"] == 1
+
+            content = await store.pull_content(second, URL("http://example.com/a"))
+            assert content.body == b"same"
+            assert content.metadata["status"] == 200
+            # 今のsessionにもpointerを置く
+            key = store.make_key(second, URL("http://example.com/a"))
+            boto3.client("s3").head_object(Bucket="blkct-test", Key=key)
+        finally:
+            await store.close()
+
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+import asyncio
+import io
+import os
+
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+from blkct.content_store.codec import get_codec
+from blkct.content_store.content import FetchedContent
+from blkct.content_store.file_content_store import INDEX_FILENAME
+from blkct.content_store.segment_content_store import SegmentContentStore, list_segments
+
+
+class DummySession:
+    session_id = "test"
+
+
+def make_content(content_type, body):
+    headers = CIMultiDictProxy(CIMultiDict({"Content-Type": content_type, "ETag": '"x"'}))
+    return FetchedContent(200, headers, body)
+
+
+def test_push_and_pull_with_rotation(tmp_path):
+    async def main():
+        store = SegmentContentStore(str(tmp_path), segment_size=1024, codec=get_codec("gzip"))
+        session = DummySession()
+        urls = [URL(f"http://example.com/{i}") for i in range(20)]
+
+        assert await store.pull_content(session, urls[0]) is None
+        for i, url in enumerate(urls):
+            await store.push_content(session, url, make_content("text/html", os.urandom(100) + b"%d" % i))
+            # 書き込み中のsegmentからも読める
+            content = await store.pull_content(session, url)
+            assert content.body.endswith(b"%d" % i)
+        await store.push_content(session, URL("http://example.com/image"), make_content("image/png", b"png"))
+        await store.close()
+
+        assert len(list_segments(str(tmp_path / "test"))) > 1
+
+        # 別のstore(プロセス)から読む. indexが無くてもsegmentから作り直す
+        os.remove(tmp_path / "test" / INDEX_FILENAME)
+        other = SegmentContentStore(str(tmp_path))
+        content = await other.pull_content(session, urls[5])
+        assert content.body.endswith(b"5")
+        assert content.metadata["headers"]["ETag"] == '"x"'
+        content = await other.pull_content(session, URL("http://example.com/image"))
+        assert content.content_type == "image/png"
+        assert content.body == b"png"
+        await other.close()
+
+    asyncio.run(main())
+
+
+def test_export_and_import_warc(tmp_path):
+    async def main():
+        store = SegmentContentStore(str(tmp_path / "a"), codec=get_codec("gzip"))
+        session = DummySession()
+        url = URL("http://example.com/page")
+        await store.push_content(session, url, make_content("text/html", b"<html></html>"))
+        await store.close()
+
+        warc = io.BytesIO()
+        assert store.export_warc("test", warc) == 1
+        assert warc.getvalue()[:2] == b"\x1f\x8b"
+
+        warc.seek(0)
+        imported = SegmentContentStore(str(tmp_path / "b"))
+        assert imported.import_warc("test", warc) == 1
+        content = await imported.pull_content(session, url)
+        assert content.body == b"<html></html>"
+        assert content.content_type == "text/html"
+        assert content.metadata["status"] == 200
+        await imported.close()
+
+    asyncio.run(main())
@@ -0,0 +1,337 @@
+import asyncio
+import hashlib
+
+import pytest
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from blkct.blackcat import Blackcat
+from blkct.content_store.content import FetchedContent
+from blkct.exceptions import ContextNotFoundError
+from blkct.metrics import CONTENT_STORE_LOOKUPS
+from blkct.session import BlackcatSession
+from blkct.typing import ContentStore, ContextStore
+
+
+class MemoryContentStore(ContentStore):
+    def __init__(self):
+        self.contents = {}
+
+    async def pull_content(self, session, url):
+        return self.contents.get(url)
+
+    async def push_content(self, session, url, content):
+        self.contents[url] = content
+
+
+class MemoryContextStore(ContextStore):
+    def __init__(self):
+        self.data = {}
+        self.saved = []
+
+    async def close(self):
+        pass
+
+    async def load(self, session, key):
+        if key not in self.data:
+            raise ContextNotFoundError()
+        return self.data[key]
+
+    async def save(self, session, key, data):
+        self.data[key] = data
+        self.saved.append((key, data))
+
+
+def make_blackcat(**kwargs):
+    return Blackcat(
+        planners={},
+        content_parsers=[],
+        scheduler_factory=lambda: None,
+        content_store_factory=MemoryContentStore,
+        context_store_factory=MemoryContextStore,
+        **kwargs,
+    )
+
+
+def test_crawl_coalesces_same_url():
+    fetched = []
+
+    async def fetch_content(url, check_status):
+        fetched.append(url)
+        await asyncio.sleep(0.01)
+        return FetchedContent(200, CIMultiDictProxy(CIMultiDict({"Content-Type": "text/plain"})), b"body")
+
+    async def main():
+        blackcat = make_blackcat()
+        async with blackcat.start_session("test") as session:
+            session.fetch_content = fetch_content
+            parser = lambda url, params, content: content  # noqa: E731
+            results = await asyncio.gather(
+                *[session.crawl("http://example.com/", parser=parser) for _ in range(5)],
+                session.crawl("http://example.com/other", parser=parser),
+            )
+            # 取得済みのものはContent Storeから返る
+            results.append(await session.crawl("http://example.com/", parser=parser))
+        return blackcat, results
+
+    blackcat, results = asyncio.run(main())
+    assert len(fetched) == 2
+    lookups = blackcat.metrics.counters
+    assert lookups[(CONTENT_STORE_LOOKUPS, (("result", "miss"),))] == 2
+    assert lookups[(CONTENT_STORE_LOOKUPS, (("result", "hit"),))] == 1
+    assert all(r is results[0] for r in results[:5])
+    assert results[5] is not results[0]
+    assert results[6] is results[0]
+
+
+def test_context_buffers_sets_until_flush():
+    async def main():
+        blackcat = make_blackcat(context_flush_interval=None, context_flush_threshold=3)
+        async with blackcat.start_session("test") as session:
+            store = session.context_store
+            context = await session.get_context("ctx")
+            assert await session.get_context("ctx") is context
+
+            await context.set("a", 1)
+            await context.update({"b": 2, "c": 3})
+            assert store.saved == []
+
+            # 閾値に達したら保存する
+            await context.set("a", 4)
+            assert store.saved == [("ctx", {"a": 4, "b": 2, "c": 3})]
+
+            # flush=Trueならすぐに保存する
+            await context.set("d", 5, flush=True)
+            assert len(store.saved) == 2
+
+            await context.set("e", 6)
+        # closeで残りが保存される
+        return store
+
+    store = asyncio.run(main())
+    assert store.saved[-1] == ("ctx", {"a": 4, "b": 2, "c": 3, "d": 5, "e": 6})
+
+
+def test_context_flush_interval():
+    async def main():
+        blackcat = make_blackcat(context_flush_interval=0.01)
+        async with blackcat.start_session("test") as session:
+            context = await session.get_context("ctx")
+            await context.set("a", 1)
+            await context.set("a", 2)
+            assert session.context_store.saved == []
+            await asyncio.sleep(0.05)
+            assert session.context_store.saved == [("ctx", {"a": 2})]
+
+    asyncio.run(main())
+
+
+def test_close_waits_background_flush():
+    class SlowContextStore(MemoryContextStore):
+        saving = 0
+
+        async def close(self):
+            # 保存中に閉じない
+            assert self.saving == 0
+            self.closed = True
+
+        async def save(self, session, key, data):
+            self.saving += 1
+            await asyncio.sleep(0.05)
+            await super().save(session, key, data)
+            self.saving -= 1
+
+    async def main():
+        blackcat = make_blackcat(context_flush_interval=0.01)
+        blackcat.context_store_factory = SlowContextStore
+        async with blackcat.start_session("test") as session:
+            store = session.context_store
+            context = await session.get_context("ctx")
+            await context.set("a", 1)
+            # バックグラウンドの保存中にcloseする
+            await asyncio.sleep(0.03)
+            assert store.saving == 1
+        return store
+
+    store = asyncio.run(main())
+    assert store.closed
+    assert store.saved == [("ctx", {"a": 1})]
+
+
+def test_fetch_content_streams_body():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from yarl import URL
+
+    from blkct.exceptions import ContentTooLarge
+
+    async def handler(request):
+        return web.Response(body=b"x" * int(request.match_info["size"]), content_type="application/octet-stream")
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/{size}", handler)
+        async with TestServer(app) as server:
+            blackcat = make_blackcat(request_interval=0, max_body_size=10000, spool_threshold=100)
+            async with blackcat.start_session("test") as session:
+                small = await session.fetch_content(URL(str(server.make_url("/10"))), True)
+                large = await session.fetch_content(URL(str(server.make_url("/5000"))), True)
+                try:
+                    await session.fetch_content(URL(str(server.make_url("/20000"))), True)
+                except ContentTooLarge:
+                    too_large = True
+                else:
+                    too_large = False
+                # get_contentはbodyをメモリに読んで返す
+                loaded = await session.get_content(URL(str(server.make_url("/3000"))), True)
+            return small, large, too_large, loaded
+
+    small, large, too_large, loaded = asyncio.run(main())
+    assert small.body == b"x" * 10
+    assert large.size == 5000
+    with large.open_body() as fp:
+        assert fp.read() == b"x" * 5000
+    assert large.body == b"x" * 5000
+    assert too_large
+    assert loaded._body_file is None
+    assert loaded.body == b"x" * 3000
+
+
+def test_crawl_streams_large_body(tmp_path):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from blkct.content_store.file_content_store import FileContentStore
+
+    body = bytes(range(256)) * 400
+
+    async def handler(request):
+        await asyncio.sleep(0.01)
+        return web.Response(body=body, content_type="application/octet-stream")
+
+    def parser(url, params, content):
+        # 少しずつ読む
+        digest = hashlib.sha256()
+        with content.open_body() as fp:
+            for chunk in iter(lambda: fp.read(1024), b""):
+                digest.update(chunk)
+        return content, digest.hexdigest()
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/", handler)
+        async with TestServer(app) as server:
+            blackcat = Blackcat(
+                planners={},
+                content_parsers=[],
+                scheduler_factory=lambda: None,
+                content_store_factory=lambda: FileContentStore(str(tmp_path)),
+                context_store_factory=MemoryContextStore,
+                request_interval=0,
+                spool_threshold=1024,
+            )
+            async with blackcat.start_session("test") as session:
+                url = str(server.make_url("/"))
+                results = await asyncio.gather(*[session.crawl(url, parser=parser) for _ in range(3)])
+                assert session.content_users == {}
+        return results
+
+    results = asyncio.run(main())
+    content, digest = results[0]
+    assert all(r[0] is content for r in results)
+    assert all(r[1] == hashlib.sha256(body).hexdigest() for r in results)
+    # bodyは一度もメモリに載せず、parseが終わったら一時ファイルも消す
+    assert content._body is None
+    assert content._body_file is None
+
+
+def test_crawl_revalidates_with_etag(tmp_path):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from blkct.content_store.file_content_store import FileContentStore
+
+    requests = []
+
+    async def handler(request):
+        requests.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            return web.Response(status=304)
+        return web.Response(body=b"v1", content_type="text/plain", headers={"ETag": '"v1"'})
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/", handler)
+        async with TestServer(app) as server:
+            url = str(server.make_url("/"))
+            parser = lambda url, params, content: (content.body, content.metadata)  # noqa: E731
+            blackcat = Blackcat(
+                planners={},
+                content_parsers=[],
+                scheduler_factory=lambda: None,
+                content_store_factory=lambda: FileContentStore(str(tmp_path)),
+                context_store_factory=MemoryContextStore,
+                request_interval=0,
+            )
+            async with blackcat.start_session("test") as session:
+                first = await session.crawl(url, parser=parser)
+                cached = await session.crawl(url, parser=parser)
+                revalidated = await session.crawl(url, parser=parser, revalidate=True)
+            return first, cached, revalidated
+
+    first, cached, revalidated = asyncio.run(main())
+    assert requests == [None, '"v1"']
+    assert first[0] == cached[0] == revalidated[0] == b"v1"
+    assert revalidated[1]["status"] == 200
+    assert revalidated[1]["headers"]["ETag"] == '"v1"'
+
+
+def test_sessions_share_connection_pool():
+    async def main():
+        blackcat = make_blackcat(connection_limit=10, connect_timeout=5, read_timeout=None)
+        async with blackcat.start_session("a") as session:
+            first = session.aio_session
+            connector = first.connector
+            # 同じevent loopのsessionは、connection poolを共有する
+            other = BlackcatSession(blackcat, None, MemoryContentStore(), MemoryContextStore(), session_id="b")
+            second = other.aio_session
+            assert second.timeout.sock_connect == 5
+            assert second.timeout.sock_read is None
+            # cookieはsession毎で、connection poolは同じもの
+            assert second.cookie_jar is not first.cookie_jar
+            assert second.connector is connector
+            await other.close()
+            assert not connector.closed
+
+        # 最後のsessionを閉じるとconnection poolも閉じる
+        assert connector.limit == 10
+        assert connector.closed
+
+    asyncio.run(main())
+
+
+def test_fetch_retries_retryable_status():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+
+    from blkct.exceptions import BadStatusCode
+
+    statuses = {"/flaky": [503, 503, 200], "/down": [500, 500, 500, 500]}
+
+    async def handler(request):
+        return web.Response(status=statuses[request.path].pop(0), body=b"ok")
+
+    async def main():
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        async with TestServer(app) as server:
+            blackcat = make_blackcat(request_interval=0, retry_backoff=0.001, max_retries=2)
+            async with blackcat.start_session("test") as session:
+                fetched = await session.fetch_content(server.make_url("/flaky"), True)
+                with pytest.raises(BadStatusCode):
+                    await session.fetch_content(server.make_url("/down"), True)
+        return fetched
+
+    fetched = asyncio.run(main())
+    assert fetched.status_code == 200
+    assert fetched.body == b"ok"
+    assert statuses == {"/flaky": [], "/down": [500]}
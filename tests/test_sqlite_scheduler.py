@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+from blkct.blackcat import Blackcat
+from blkct.scheduler.sqlite_scheduler import SQLiteScheduler
+from blkct.typing import ContentStore, ContextStore
+
+
+class NullContentStore(ContentStore):
+    async def pull_content(self, session, url):
+        return None
+
+    async def push_content(self, session, url, content):
+        pass
+
+
+class NullContextStore(ContextStore):
+    async def close(self):
+        pass
+
+    async def load(self, session, key):
+        return {}
+
+    async def save(self, session, key, data):
+        pass
+
+
+def test_resume_unfinished_plans(tmp_path):
+    db_path = str(tmp_path / "queue.sqlite3")
+    handled = []
+    broken = {3}
+
+    async def index(session, fanout):
+        handled.append("index")
+        for i in range(fanout):
+            await session.dispatch("detail", {"i": i})
+        # 全く同じdispatchは無視する
+        await session.dispatch("detail", {"i": 0})
+
+    async def detail(session, i):
+        if i in broken:
+            raise RuntimeError("crash")
+        handled.append(i)
+
+    blackcat = Blackcat(
+        planners={"index": index, "detail": detail},
+        content_parsers=[],
+        scheduler_factory=lambda: SQLiteScheduler(db_path),
+        content_store_factory=NullContentStore,
+        context_store_factory=NullContextStore,
+    )
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(blackcat.run_with_session("index", {"fanout": 5}, "test"))
+    assert handled == ["index", 0, 1, 2]
+
+    # 同じsession idで動かし直すと、終わっていないものだけ処理する
+    handled.clear()
+    broken.clear()
+    asyncio.run(blackcat.run_with_session("index", {"fanout": 5}, "test"))
+    assert handled == [3, 4]
+
+    # 別のsessionは最初から
+    handled.clear()
+    asyncio.run(blackcat.run_with_session("index", {"fanout": 2}, "other"))
+    assert handled == ["index", 0, 1]
+
+
+def test_done_plans_keep_context_changes(tmp_path):
+    db_path = str(tmp_path / "queue.sqlite3")
+    saved = {}
+    broken = {3}
+    crashed = []
+
+    class CrashingContextStore(NullContextStore):
+        async def load(self, session, key):
+            return dict(saved.get(key, {}))
+
+        async def save(self, session, key, data):
+            # 落ちた後は何も保存できない
+            if crashed:
+                raise RuntimeError("dead")
+            saved[key] = dict(data)
+
+    async def index(session, fanout):
+        for i in range(fanout):
+            await session.dispatch("detail", {"i": i})
+
+    async def detail(session, i):
+        if i in broken:
+            crashed.append(i)
+            raise RuntimeError("crash")
+        context = await session.get_context("details")
+        await context.set(str(i), True)
+
+    blackcat = Blackcat(
+        planners={"index": index, "detail": detail},
+        content_parsers=[],
+        scheduler_factory=lambda: SQLiteScheduler(db_path),
+        content_store_factory=NullContentStore,
+        context_store_factory=CrashingContextStore,
+        context_flush_interval=None,
+        context_flush_threshold=100,
+    )
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(blackcat.run_with_session("index", {"fanout": 5}, "test"))
+    # doneになったplanの変更は保存されている
+    assert saved == {"details": {"0": True, "1": True, "2": True}}
+
+    broken.clear()
+    crashed.clear()
+    asyncio.run(blackcat.run_with_session("index", {"fanout": 5}, "test"))
+    assert saved == {"details": {str(i): True for i in range(5)}}